@@ -0,0 +1,53 @@
+"""
+Checks the triplets of an inference backend against the fp32 PyTorch model and reports latency.
+
+Run from the celery_worker directory:
+    python -m benchmarks.backend_parity --backend torch_int8 [--texts texts.jsonl] [--repeat 3]
+"""
+import argparse
+import json
+import time
+
+from celery_task_app.ml_model.re_model import RelationExtractionModel
+from .parser_benchmark import load_texts
+
+
+def extract(model, texts, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        relations = [[(r['head'], r['type'], r['tail']) for r in model.from_text_to_kb(text).relations]
+                     for text in texts]
+    return (time.perf_counter() - start) / repeat, relations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", default="torch_int8")
+    parser.add_argument("--texts", default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    texts = load_texts(args.texts)
+
+    reference_seconds, reference = extract(RelationExtractionModel(connect_backends=False, backend="torch"),
+                                           texts, args.repeat)
+    backend_seconds, candidate = extract(RelationExtractionModel(connect_backends=False, backend=args.backend),
+                                         texts, args.repeat)
+
+    reference_triplets = {(i, triplet) for i, relations in enumerate(reference) for triplet in relations}
+    candidate_triplets = {(i, triplet) for i, relations in enumerate(candidate) for triplet in relations}
+    common = len(reference_triplets & candidate_triplets)
+    print(json.dumps({
+        "backend": args.backend,
+        "documents": len(texts),
+        "identical": reference == candidate,
+        "precision_vs_fp32": round(common / max(len(candidate_triplets), 1), 4),
+        "recall_vs_fp32": round(common / max(len(reference_triplets), 1), 4),
+        "fp32_seconds": round(reference_seconds, 3),
+        "backend_seconds": round(backend_seconds, 3),
+        "speedup": round(reference_seconds / backend_seconds, 2),
+        "backend_docs_per_second": round(len(texts) / backend_seconds, 3),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
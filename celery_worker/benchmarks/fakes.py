@@ -0,0 +1,480 @@
+"""
+In-process stand-ins for the external services (py2neo GraphService, Elasticsearch, MongoClient) and for the
+REBEL tokenizer/model, so that the hot paths can be benchmarked without docker-compose or network access.
+Every call that would be a network round trip is counted, and can be slowed down by a simulated latency.
+"""
+import re
+import time
+
+import torch
+from py2neo import Node, Relationship
+
+
+class RoundTrips:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+
+# Neo4j
+
+MERGE_TYPE = re.compile(r'MERGE \(h\)-\[:`((?:[^`]|``)+)`\]->\(t\)')
+TAILS_TYPE = re.compile(r'-\[:`((?:[^`]|``)+)`\]->\(t\) RETURN t\.name AS tail')
+COUNT_TYPE = re.compile(r'MATCH \(\)-\[r:`((?:[^`]|``)+)`\]->\(\) RETURN count\(r\) AS count')
+
+
+class FakeCursor:
+    def __init__(self, rows=None, stats=None):
+        self.rows = rows or []
+        self.counters = stats or {}
+
+    def data(self):
+        return self.rows
+
+    def stats(self):
+        return self.counters
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def evaluate(self):
+        return next(iter(self.rows[0].values())) if self.rows else None
+
+
+class FakeGraph:
+    def __init__(self, round_trips, name="neo4j"):
+        self.round_trips = round_trips
+        self.name = name
+        # py2neo hashes bound entities with their graph's service
+        self.service = None
+        self.nodes = {}
+        self.relationships = {}
+
+    def node(self, name, key):
+        # entities are merged by normalised name, relationships are kept by the keys of their ends
+        created = key not in self.nodes
+        if created:
+            node = Node("ENTITY", name=name, name_key=key, aliases=[name])
+            node.graph, node.identity = self, len(self.nodes)
+            self.nodes[key] = node
+        return self.nodes[key], created
+
+    def relate(self, head, relation_type, tail):
+        tails = self.relationships.setdefault(head, {}).setdefault(relation_type, [])
+        if tail in tails:
+            return False
+        tails.append(tail)
+        return True
+
+    def merge_rows(self, relation_type, rows):
+        stats = {"nodes_created": 0, "relationships_created": 0}
+        for row in rows:
+            for name, key in ((row['head'], row['head_key']), (row['tail'], row['tail_key'])):
+                stats["nodes_created"] += self.node(name, key)[1]
+            stats["relationships_created"] += self.relate(row['head_key'], relation_type, row['tail_key'])
+        return stats
+
+    def tails(self, head_key, relation_type):
+        return [self.nodes[key]['name'] for key in self.relationships.get(head_key, {}).get(relation_type, [])]
+
+    def run(self, query, parameters=None, **kwparameters):
+        self.round_trips()
+        parameters = dict(parameters or {}, **kwparameters)
+        if query.startswith("CREATE CONSTRAINT") or query.startswith("CREATE INDEX") or \
+                query.startswith("CREATE FULLTEXT INDEX") or query.startswith("CALL db.index.fulltext.queryNodes") or \
+                query.startswith("UNWIND $rows AS row CALL db.index.fulltext.queryNodes"):
+            return FakeCursor()
+        match = MERGE_TYPE.search(query)
+        if match:
+            return FakeCursor(stats=self.merge_rows(match.group(1).replace("``", "`"), parameters['rows']))
+        match = TAILS_TYPE.search(query)
+        if match:
+            return FakeCursor([{"tail": tail} for tail in self.tails(parameters['key'],
+                                                                      match.group(1).replace("``", "`"))])
+        match = COUNT_TYPE.search(query)
+        if match:
+            relation_type = match.group(1).replace("``", "`")
+            return FakeCursor([{"count": sum(len(types.get(relation_type, []))
+                                             for types in self.relationships.values())}])
+        if query.startswith("CALL db.relationshipTypes()"):
+            return FakeCursor([{"type": relation_type} for relation_type in
+                               sorted({t for types in self.relationships.values() for t in types})])
+        if query.startswith("UNWIND $rows AS row OPTIONAL MATCH"):
+            return FakeCursor([{"idx": row['idx'], "tails": self.tails(row['key'], row['relation'])}
+                               for row in parameters['rows']])
+        if "RETURN type(r) AS type" in query:
+            for relation_type, tails in self.relationships.get(parameters['k1'], {}).items():
+                if parameters['k2'] in tails:
+                    return FakeCursor([{"type": relation_type}])
+            return FakeCursor()
+        raise NotImplementedError(f"FakeGraph does not support query: {query}")
+
+    def begin(self):
+        return FakeTransaction(self)
+
+
+class FakeTransaction:
+    def __init__(self, graph):
+        self.graph = graph
+
+    def run(self, query, parameters=None, **kwparameters):
+        return self.graph.run(query, parameters, **kwparameters)
+
+    def create(self, subgraph):
+        self.graph.round_trips()
+        if isinstance(subgraph, Relationship):
+            for node in (subgraph.start_node, subgraph.end_node):
+                node.graph, node.identity = self.graph, self.graph.node(node['name'], node['name_key'])[0].identity
+            self.graph.relationships.setdefault(subgraph.start_node['name_key'], {}).setdefault(
+                type(subgraph).__name__, []).append(subgraph.end_node['name_key'])
+            subgraph.graph, subgraph.identity = self.graph, len(self.graph.relationships)
+        else:
+            subgraph.graph, subgraph.identity = self.graph, self.graph.node(subgraph['name'],
+                                                                            subgraph['name_key'])[0].identity
+
+    def push(self, subgraph):
+        self.graph.round_trips()
+
+    def commit(self):
+        self.graph.round_trips()
+
+    def rollback(self):
+        self.graph.round_trips()
+
+
+class FakeNodeMatch:
+    def __init__(self, graph, key):
+        self.graph = graph
+        self.key = key
+
+    def exists(self):
+        self.graph.round_trips()
+        return self.key in self.graph.nodes
+
+    def first(self):
+        self.graph.round_trips()
+        return self.graph.nodes.get(self.key)
+
+
+class FakeNodeMatcher:
+    def __init__(self, graph):
+        self.graph = graph
+
+    def match(self, *labels, **properties):
+        return FakeNodeMatch(self.graph, properties.get('name_key'))
+
+
+class FakeRelationshipMatcher:
+    def __init__(self, graph):
+        self.graph = graph
+
+
+class FakeGraphService:
+    def __init__(self, round_trips):
+        self.round_trips = round_trips
+        self.graphs = {"neo4j": FakeGraph(round_trips)}
+        self.default_graph = self.graphs["neo4j"]
+
+    def __getitem__(self, graph_name):
+        self.round_trips()
+        return self.graphs[graph_name]
+
+    def __contains__(self, graph_name):
+        return graph_name in self.graphs
+
+    def keys(self):
+        self.round_trips()
+        return ["system"] + list(self.graphs)
+
+    @property
+    def system_graph(self):
+        return FakeSystemGraph(self)
+
+
+class FakeSystemGraph:
+    CREATE_DATABASE = re.compile(r'^CREATE DATABASE `([^`]+)` IF NOT EXISTS')
+
+    def __init__(self, graph_service):
+        self.graph_service = graph_service
+
+    def run(self, query, parameters=None, **kwparameters):
+        self.graph_service.round_trips()
+        match = self.CREATE_DATABASE.match(query)
+        if match is None:
+            raise NotImplementedError(f"FakeSystemGraph does not support query: {query}")
+        self.graph_service.graphs.setdefault(match.group(1), FakeGraph(self.graph_service.round_trips,
+                                                                        match.group(1)))
+        return FakeCursor()
+
+
+# Elasticsearch
+
+class FakeIndices:
+    def __init__(self, client):
+        self.client = client
+
+    def exists(self, index):
+        self.client.round_trips()
+        return index in self.client.docs
+
+    def create(self, index):
+        self.client.round_trips()
+        self.client.docs.setdefault(index, {})
+
+    def delete(self, index, ignore=None):
+        self.client.round_trips()
+        self.client.docs.pop(index, None)
+
+
+class FakeCat:
+    def __init__(self, client):
+        self.client = client
+
+    def count(self, index):
+        self.client.round_trips()
+        return len(self.client.docs.get(index, {}))
+
+
+class FakeElasticsearch:
+    def __init__(self, round_trips):
+        self.round_trips = round_trips
+        self.docs = {}
+        self.indices = FakeIndices(self)
+        self.cat = FakeCat(self)
+
+    def info(self):
+        self.round_trips()
+        return {"version": {"number": "fake"}}
+
+    def index(self, index, body, id):
+        self.round_trips()
+        self.docs.setdefault(index, {})[id] = body
+
+    def get(self, index, id, ignore=None):
+        self.round_trips()
+        if id in self.docs.get(index, {}):
+            return {"found": True, "_id": id, "_source": self.docs[index][id]}
+        return {"found": False, "_id": id}
+
+    def search(self, index, body):
+        # crude relevance: number of query words found in the field
+        self.round_trips()
+        query_type, query = next(iter(body['query'].items()))
+        field, text = next(iter(query.items()))
+        words = set(text.lower().split())
+        scored = []
+        for doc_id, doc in self.docs.get(index, {}).items():
+            value = str(doc.get(field, "")).lower()
+            if query_type == "match_phrase":
+                score = 1 if text.lower() in value else 0
+            else:
+                score = len(words & set(value.split()))
+            if score > 0:
+                scored.append((score, doc_id, doc))
+        scored.sort(key=lambda hit: -hit[0])
+        hits = [{"_id": doc_id, "_score": score, "_source": doc} for score, doc_id, doc in scored]
+        return {"hits": {"hits": hits[body.get('from', 0):body.get('from', 0) + body.get('size', 10)]}}
+
+
+class FakeElasticHelpers:
+    @staticmethod
+    def bulk(client, actions):
+        client.round_trips()
+        count = 0
+        for action in actions:
+            client.docs.setdefault(action['_index'], {})[action['_id']] = action['_source']
+            count += 1
+        return count, []
+
+    @staticmethod
+    def scan(client, index, query=None):
+        client.round_trips()
+        for doc_id, doc in list(client.docs.get(index, {}).items()):
+            yield {"_id": doc_id, "_source": doc}
+
+
+# Mongo
+
+def get_path(doc, path):
+    for key in path.split("."):
+        if not isinstance(doc, dict) or key not in doc:
+            return None
+        doc = doc[key]
+    return doc
+
+
+def set_path(doc, path, value):
+    keys = path.split(".")
+    for key in keys[:-1]:
+        doc = doc.setdefault(key, {})
+    doc[keys[-1]] = value
+
+
+def matches(doc, query):
+    for path, condition in query.items():
+        value = get_path(doc, path)
+        if isinstance(condition, dict):
+            for op, operand in condition.items():
+                if op == "$gt" and not (value is not None and value > operand):
+                    return False
+                if op == "$ne" and value == operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeUpdateResult:
+    def __init__(self, matched_count):
+        self.matched_count = matched_count
+
+
+class FakeCollection:
+    def __init__(self, round_trips):
+        self.round_trips = round_trips
+        self.docs = []
+
+    def create_index(self, *args, **kwargs):
+        self.round_trips()
+
+    def insert_one(self, doc):
+        self.round_trips()
+        self.docs.append(doc)
+
+    def apply_update(self, doc, update):
+        for path, value in update.get("$set", {}).items():
+            set_path(doc, path, value)
+        for path, value in update.get("$inc", {}).items():
+            set_path(doc, path, (get_path(doc, path) or 0) + value)
+
+    def update(self, query, update, upsert=False, many=False):
+        matched = [doc for doc in self.docs if matches(doc, query)]
+        if not many:
+            matched = matched[:1]
+        if not matched and upsert:
+            doc = {key: value for key, value in query.items() if not isinstance(value, dict)}
+            self.docs.append(doc)
+            matched = [doc]
+        for doc in matched:
+            self.apply_update(doc, update)
+        return matched
+
+    def update_one(self, query, update, upsert=False):
+        self.round_trips()
+        return FakeUpdateResult(len(self.update(query, update, upsert=upsert)))
+
+    def update_many(self, query, update, upsert=False):
+        self.round_trips()
+        return FakeUpdateResult(len(self.update(query, update, upsert=upsert, many=True)))
+
+    def find_one_and_update(self, query, update, upsert=False, return_document=None):
+        self.round_trips()
+        matched = self.update(query, update, upsert=upsert)
+        return dict(matched[0]) if matched else None
+
+    def bulk_write(self, requests, ordered=True):
+        self.round_trips()
+        for request in requests:
+            self.update(request._filter, request._doc, upsert=request._upsert)
+
+    def find(self, query=None, projection=None):
+        self.round_trips()
+        return [dict(doc) for doc in self.docs if matches(doc, query or {})]
+
+    def find_one(self, query=None, projection=None):
+        self.round_trips()
+        for doc in self.docs:
+            if matches(doc, query or {}):
+                return dict(doc)
+        return None
+
+
+class FakeDatabase:
+    def __init__(self, round_trips):
+        self.round_trips = round_trips
+        self.collections = {}
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection(self.round_trips))
+
+
+class FakeMongoClient:
+    def __init__(self, round_trips):
+        self.round_trips = round_trips
+        self.databases = {}
+
+    def __getitem__(self, name):
+        return self.databases.setdefault(name, FakeDatabase(self.round_trips))
+
+
+# REBEL tokenizer and model
+
+class FakeTokenizer:
+    """
+    Word level tokenizer with REBEL's special tokens, enough for span construction and output parsing
+    """
+    SPECIAL_TOKENS = ["<s>", "<pad>", "</s>", "<unk>", "<triplet>", "<subj>", "<obj>"]
+
+    def __init__(self):
+        self.vocab = {}
+        self.tokens = []
+        for token in self.SPECIAL_TOKENS:
+            self.token_id(token)
+        self.bos_token_id, self.pad_token_id, self.eos_token_id = 0, 1, 2
+
+    def token_id(self, token):
+        if token not in self.vocab:
+            self.vocab[token] = len(self.tokens)
+            self.tokens.append(token)
+        return self.vocab[token]
+
+    def convert_tokens_to_ids(self, token):
+        return self.vocab[token]
+
+    def encode(self, text, add_special_tokens=True):
+        ids = [self.token_id(token) for token in text.split()]
+        if add_special_tokens:
+            ids = [self.bos_token_id] + ids + [self.eos_token_id]
+        return ids
+
+    def __call__(self, text, return_tensors=None, add_special_tokens=True):
+        if isinstance(text, str):
+            ids = self.encode(text, add_special_tokens)
+            return {"input_ids": ids, "attention_mask": [1] * len(ids)}
+        ids = [self.encode(t, add_special_tokens) for t in text]
+        masks = [[1] * len(i) for i in ids]
+        if return_tensors == "pt":
+            return {"input_ids": torch.tensor(ids), "attention_mask": torch.tensor(masks)}
+        return {"input_ids": ids, "attention_mask": masks}
+
+    def decode(self, ids, skip_special_tokens=False):
+        if isinstance(ids, torch.Tensor):
+            ids = ids.tolist()
+        return " ".join(self.tokens[i] for i in ids
+                        if not (skip_special_tokens and self.tokens[i] in self.SPECIAL_TOKENS))
+
+    def batch_decode(self, sequences, skip_special_tokens=False):
+        return [self.decode(ids, skip_special_tokens) for ids in sequences]
+
+
+class RecordedModel:
+    """
+    Replays linearised REBEL outputs instead of running beam search
+    """
+    def __init__(self, tokenizer, outputs):
+        self.outputs = [tokenizer.encode(output, add_special_tokens=False) for output in outputs]
+        self.next_output = 0
+        self.pad_token_id = tokenizer.pad_token_id
+
+    def generate(self, input_ids, attention_mask=None, num_return_sequences=1, **kwargs):
+        sequences = []
+        for _ in range(len(input_ids) * num_return_sequences):
+            sequences.append(self.outputs[self.next_output % len(self.outputs)])
+            self.next_output += 1
+        max_length = max(len(sequence) for sequence in sequences)
+        return torch.tensor([sequence + [self.pad_token_id] * (max_length - len(sequence)) for sequence in sequences])
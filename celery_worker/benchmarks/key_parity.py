@@ -0,0 +1,62 @@
+"""
+Checks that the flask app and the worker normalise entity and graph names the same way. Both images are built
+from their own directory, so kg_explorer.py keeps a copy of entity_key, normalise_graph_name, GRAPH_NAME and
+SCHEMA_QUERIES from kg_ingestor.py: a key computed differently on each side makes the app miss every entity the
+worker wrote. Exits with status 1 listing the differences.
+
+Run from the celery_worker directory:
+    python -m benchmarks.key_parity
+"""
+import json
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(ROOT, "celery_worker"))
+sys.path.insert(0, os.path.join(ROOT, "flask_app"))
+
+from celery_task_app.kg_ingestor import kg_ingestor  # noqa: E402
+from kg_explorer import kg_explorer  # noqa: E402
+
+NAMES = ["Paris", " The United  States?", "the", "The The", "\"Barack Obama\"", "ＵＳＡ", "Straße", "İstanbul",
+         "...", "", "?!", "New\tYork\n", "the  Beatles", "ﬁnance", "'Allo 'Allo!", "Theatre", 42, None]
+GRAPH_NAMES = [None, "news", "News-2024", "a.b", "ab", "system", "SYSTEM", "1news", "news_2024", "x" * 63,
+               "x" * 64, "", 42]
+ALPHABET = "aAtThHeE  \t.?!'\"ßİﬁＡ-_"
+
+
+def random_names(count, seed=0):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 12))) for _ in range(count)]
+
+
+def graph_name_result(normalise, graph_name):
+    try:
+        return normalise(graph_name)
+    except ValueError:
+        return ValueError
+
+
+def main():
+    differences = []
+    if kg_ingestor.SCHEMA_QUERIES != kg_explorer.SCHEMA_QUERIES:
+        differences.append({"SCHEMA_QUERIES": [kg_ingestor.SCHEMA_QUERIES, kg_explorer.SCHEMA_QUERIES]})
+    if kg_ingestor.GRAPH_NAME.pattern != kg_explorer.GRAPH_NAME.pattern:
+        differences.append({"GRAPH_NAME": [kg_ingestor.GRAPH_NAME.pattern, kg_explorer.GRAPH_NAME.pattern]})
+    for name in NAMES + random_names(10000):
+        worker_key, app_key = kg_ingestor.entity_key(name), kg_explorer.entity_key(name)
+        if worker_key != app_key:
+            differences.append({"entity_key": [repr(name), worker_key, app_key]})
+    for graph_name in GRAPH_NAMES:
+        worker_name = graph_name_result(kg_ingestor.normalise_graph_name, graph_name)
+        app_name = graph_name_result(kg_explorer.normalise_graph_name, graph_name)
+        if worker_name != app_name:
+            differences.append({"normalise_graph_name": [repr(graph_name), repr(worker_name), repr(app_name)]})
+    print(json.dumps({"identical": len(differences) == 0, "differences": differences[:20]}, indent=2))
+    if differences:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+"""
+Offline benchmark suite for the extraction and question answering hot paths.
+
+Neo4j, Elasticsearch and Mongo are replaced by the in-process fakes of benchmarks/fakes.py and the REBEL model by
+replayed outputs in its linearised format (synthetic, generated from a fixed seed), so the suite runs on a laptop
+without docker-compose or network access. The fakes count every call that would be a network round trip;
+--latency-ms adds a simulated round trip time to each of them.
+
+Run from the celery_worker directory:
+    python -m benchmarks.offline_benchmarks --output results.json [--baseline previous.json]
+"""
+import argparse
+import contextlib
+import copy
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(ROOT, "celery_worker"))
+sys.path.insert(0, os.path.join(ROOT, "flask_app"))
+
+import pymongo  # noqa: E402
+
+from . import fakes  # noqa: E402
+from celery_task_app.kg_ingestor import kg_ingestor  # noqa: E402
+from celery_task_app.knowledge_base import knowledge_base  # noqa: E402
+from celery_task_app.ml_model import re_model  # noqa: E402
+from celery_task_app.mongo_logger import mongo_logger  # noqa: E402
+from kg_explorer import kg_explorer  # noqa: E402
+from template_explorer import template_explorer  # noqa: E402
+
+QUESTION_FORMATS = {
+    "mother": "who is the mother of {} ?",
+    "father": "who is the father of {} ?",
+    "place of birth": "what is the place of birth of {} ?",
+    "date of death": "when did {} die ?",
+    "capital of": "what is the capital of {} ?",
+    "owner of": "who is the owner of {} ?",
+    "continent": "{} is in which continent ?",
+    "country of citizenship": "{} is a citizen of which country ?",
+}
+
+
+class SyntheticCorpus:
+    """
+    Entities with a skewed (hub heavy) distribution, relation types from triplets_dedup.txt and linearised
+    REBEL outputs built from them
+    """
+    def __init__(self, seed=13, num_entities=500, num_outputs=600):
+        self.random = random.Random(seed)
+        with open(os.path.join(ROOT, "flask_app", "resources", "triplets_dedup.txt"), encoding='utf-8') as f:
+            self.relation_types = [line.strip() for line in f if line.strip()][:60] + list(QUESTION_FORMATS)
+        self.entities = ["Entity {} {}".format(i, self.random.choice(["Alpha", "Beta", "Gamma", "Delta"]))
+                         for i in range(num_entities)]
+        self.outputs = [self.output() for _ in range(num_outputs)]
+
+    def entity(self):
+        # pareto distributed index: a few hub entities appear in most relations
+        return self.entities[min(int(self.random.paretovariate(1.2)) - 1, len(self.entities) - 1)]
+
+    def relation(self):
+        return {"head": self.entity(), "type": self.random.choice(self.relation_types), "tail": self.entity()}
+
+    def output(self):
+        triplets = [self.relation() for _ in range(self.random.randint(1, 3))]
+        return "<s> " + " ".join("<triplet> {head} <subj> {tail} <obj> {type}".format(**r) for r in triplets) + " </s>"
+
+    def relations(self, count):
+        return [self.relation() for _ in range(count)]
+
+    def text(self, num_words):
+        words = [word for entity in self.entities[:50] for word in entity.split()] + ["the", "of", "was", "in"]
+        return " ".join(self.random.choice(words) for _ in range(num_words))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def measure(stage, fn, repeat, round_trips, items=1, setup=None):
+    durations = []
+    trips = 0
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        trips_before = round_trips.count
+        start = time.perf_counter()
+        fn(argument) if setup is not None else fn()
+        durations.append(time.perf_counter() - start)
+        trips += round_trips.count - trips_before
+    mean = statistics.mean(durations)
+    return {
+        "stage": stage,
+        "repeat": repeat,
+        "items_per_iteration": items,
+        "mean_ms": round(mean * 1000, 4),
+        "p50_ms": round(percentile(durations, 0.5) * 1000, 4),
+        "p95_ms": round(percentile(durations, 0.95) * 1000, 4),
+        "min_ms": round(min(durations) * 1000, 4),
+        "items_per_second": round(items / mean, 2) if mean > 0 else None,
+        "round_trips_per_iteration": round(trips / repeat, 2),
+    }
+
+
+@contextlib.contextmanager
+def offline_services(round_trips):
+    tokenizer = fakes.FakeTokenizer()
+    with contextlib.ExitStack() as stack:
+        for module in (kg_ingestor, kg_explorer):
+            stack.enter_context(mock.patch.object(module, "GraphService",
+                                                  lambda *args, **kwargs: fakes.FakeGraphService(round_trips)))
+            stack.enter_context(mock.patch.object(module, "NodeMatcher", fakes.FakeNodeMatcher))
+            stack.enter_context(mock.patch.object(module, "RelationshipMatcher", fakes.FakeRelationshipMatcher))
+        stack.enter_context(mock.patch.object(template_explorer, "Elasticsearch",
+                                              lambda *args, **kwargs: fakes.FakeElasticsearch(round_trips)))
+        stack.enter_context(mock.patch.object(template_explorer, "helpers", fakes.FakeElasticHelpers))
+        stack.enter_context(mock.patch.object(pymongo, "MongoClient",
+                                              lambda *args, **kwargs: fakes.FakeMongoClient(round_trips)))
+        stack.enter_context(mock.patch.object(re_model.AutoTokenizer, "from_pretrained",
+                                              lambda *args, **kwargs: tokenizer))
+        yield tokenizer
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def run(args):
+    round_trips = fakes.RoundTrips(args.latency_ms / 1000)
+    corpus = SyntheticCorpus(seed=args.seed)
+    results = []
+    with offline_services(round_trips) as tokenizer:
+        recorded_model = fakes.RecordedModel(tokenizer, corpus.outputs)
+        with mock.patch.object(re_model.backends, "load_model", lambda *args, **kwargs: recorded_model):
+            model = re_model.RelationExtractionModel(connect_backends=False)
+
+        # span construction in from_text_to_kb
+        text = corpus.text(args.document_words)
+
+        def build_spans():
+            _, tensor_ids, tensor_masks = model.tokenize_spans(text)
+            model.stack_spans(tensor_ids, tensor_masks)
+        results.append(measure("span_construction", build_spans, args.repeat, round_trips, items=1))
+
+        # output parsing
+        outputs = [tokenizer.decode(tokenizer.encode(output, add_special_tokens=False)) for output in corpus.outputs]
+        generated = recorded_model.generate(placeholder_inputs(len(corpus.outputs)), num_return_sequences=1)
+        results.append(measure("extract_relations_from_model_output",
+                               lambda: [model.extract_relations_from_model_output(o) for o in outputs],
+                               args.repeat, round_trips, items=len(outputs)))
+        results.append(measure("extract_relations_from_token_ids",
+                               lambda: model.extract_relations_from_token_ids(generated),
+                               args.repeat, round_trips, items=len(outputs)))
+
+        # knowledge base construction
+        relations = [dict(r, meta={"spans": [[128 * (i % 40), 128 * (i % 40 + 1)]]})
+                     for i, r in enumerate(corpus.relations(args.relations))]
+
+        def fill(kb):
+            for r in copy.deepcopy(relations):
+                kb.add_relation(r)
+        results.append(measure("KnowledgeBase.add_relation", fill, args.repeat, round_trips, items=len(relations),
+                               setup=knowledge_base.KnowledgeBase))
+        results.append(measure("IndexedKnowledgeBase.add_relation", fill, args.repeat, round_trips,
+                               items=len(relations), setup=knowledge_base.IndexedKnowledgeBase))
+
+        # Neo4j writes
+        def new_ingestor():
+            return kg_ingestor.KGIngestor("neo4j://offline:7687", "neo4j", "test")
+
+        def create_relationships(ingestor):
+            for r in relations[:args.write_relations]:
+                ingestor.create_relationship(r['head'], r['type'], r['tail'])
+        results.append(measure("KGIngestor.create_relationship", create_relationships, args.repeat, round_trips,
+                               items=args.write_relations, setup=new_ingestor))
+        results.append(measure("KGIngestor.ingest_relations",
+                               lambda ingestor: ingestor.ingest_relations(relations[:args.write_relations]),
+                               args.repeat, round_trips, items=args.write_relations, setup=new_ingestor))
+
+        # question answering
+        explorer_kg = kg_explorer.KGExplorer("neo4j://offline:7687", "neo4j", "test")
+        answerable = [r for r in corpus.relations(args.relations * 4) if r['type'] in QUESTION_FORMATS]
+        for r in answerable:
+            explorer_kg.default_graph.relate(r['head'], kg_explorer.transform_relation(r['type']), r['tail'])
+        with working_directory(os.path.join(ROOT, "flask_app")):
+            explorer = template_explorer.ElasticTemplateExplorer(explorer_kg, "http://offline:9200")
+        questions = [QUESTION_FORMATS[r['type']].format(r['head']) for r in answerable[:args.questions]]
+        results.append(measure("ElasticTemplateExplorer.search_template",
+                               lambda: [explorer.search_template(question) for question in questions],
+                               args.repeat, round_trips, items=len(questions)))
+    return results
+
+
+def placeholder_inputs(count):
+    # the recorded model only looks at the number of inputs
+    return [[0]] * count
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path, max_regression):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {stage["stage"]: stage for stage in json.load(f)["stages"]}
+    regressions = []
+    for stage in results:
+        previous = baseline.get(stage["stage"])
+        if previous is None or not previous["mean_ms"]:
+            continue
+        ratio = stage["mean_ms"] / previous["mean_ms"]
+        print(f"{stage['stage']:45s} {previous['mean_ms']:>12.3f} ms -> {stage['mean_ms']:>12.3f} ms  x{ratio:.2f}",
+              file=sys.stderr)
+        if ratio > 1 + max_regression:
+            regressions.append(stage["stage"])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    parser.add_argument("--baseline", default=None, help="results of a previous run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="exit with an error when a stage is this much slower than the baseline")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=13)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated round trip time of the fakes")
+    parser.add_argument("--document-words", type=int, default=20000)
+    parser.add_argument("--relations", type=int, default=3000)
+    parser.add_argument("--write-relations", type=int, default=500)
+    parser.add_argument("--questions", type=int, default=200)
+    args = parser.parse_args()
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "settings": vars(args),
+        "stages": run(args),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, mode='w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.baseline:
+        regressions = compare(report["stages"], args.baseline, args.max_regression)
+        if regressions:
+            print(f"regressions: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Compares the string based and the token-id based REBEL output parsers on real model outputs.
+
+Run from the celery_worker directory:
+    python -m benchmarks.parser_benchmark [--texts texts.jsonl] [--repeat 20]
+where texts.jsonl holds one {"data": "..."} document per line.
+"""
+import argparse
+import json
+import time
+
+from celery_task_app.ml_model.re_model import RelationExtractionModel
+
+SAMPLE_TEXTS = [
+    "Napoleon Bonaparte was a French military and political leader who rose to prominence during the French "
+    "Revolution. He was born on the island of Corsica and died in exile on Saint Helena in 1821.",
+    "The Amazon River in South America is the largest river by discharge volume of water in the world. "
+    "It flows through Brazil, Peru and Colombia before reaching the Atlantic Ocean.",
+    "Marie Curie was a Polish and naturalised-French physicist and chemist who conducted pioneering research on "
+    "radioactivity. She was the first woman to win a Nobel Prize and was married to Pierre Curie.",
+]
+
+
+def load_texts(path):
+    if path is None:
+        return SAMPLE_TEXTS
+    with open(path, mode='r', encoding='utf-8') as f:
+        return [json.loads(line)['data'] for line in f if line.strip()]
+
+
+def time_it(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        output = fn()
+    return (time.perf_counter() - start) / repeat, output
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--texts", default=None)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    model = RelationExtractionModel(connect_backends=False)
+    generated = []
+    for text in load_texts(args.texts):
+        _, tensor_ids, tensor_masks = model.tokenize_spans(text)
+        generated.append(model.model.generate(**model.stack_spans(tensor_ids, tensor_masks), **model.gen_kwargs))
+
+    def string_parser():
+        outputs = []
+        for generated_tokens in generated:
+            decoded_preds = model.tokenizer.batch_decode(generated_tokens, skip_special_tokens=False)
+            outputs += [model.extract_relations_from_model_output(pred) for pred in decoded_preds]
+        return outputs
+
+    def token_id_parser():
+        outputs = []
+        for generated_tokens in generated:
+            outputs += model.extract_relations_from_token_ids(generated_tokens)
+        return outputs
+
+    string_seconds, string_output = time_it(string_parser, args.repeat)
+    token_id_seconds, token_id_output = time_it(token_id_parser, args.repeat)
+    print(json.dumps({
+        "sequences": len(string_output),
+        "triplets": sum(len(relations) for relations in string_output),
+        "identical": string_output == token_id_output,
+        "string_parser_ms": round(string_seconds * 1000, 3),
+        "token_id_parser_ms": round(token_id_seconds * 1000, 3),
+        "speedup": round(string_seconds / token_id_seconds, 2),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
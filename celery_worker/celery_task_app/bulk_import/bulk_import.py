@@ -0,0 +1,241 @@
+"""
+Offline bulk import: extracts the relations of a corpus with the model and writes them as CSV files for Neo4j's
+bulk loaders instead of writing them to Neo4j.
+
+--input is a directory of .txt documents (read recursively, in path order) or a JSONL file with a "text" field
+per line. Documents are processed in chunks of --chunk-documents, every chunk adds numbered CSV files holding
+only the entities and relationships not written by earlier chunks. Progress and the keys seen so far are kept in
+a SQLite file in the output directory, an interrupted run started again with the same arguments resumes after
+the last complete chunk.
+
+--format admin writes files for neo4j-admin import (to an empty database, with the worker stopped), --format
+load_csv writes files and a Cypher script of LOAD CSV statements merging them into a live database.
+
+Run from the celery_worker directory:
+    python -m celery_task_app.bulk_import.bulk_import --input corpus.jsonl --output import/ [--format admin]
+"""
+import argparse
+import csv
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from .. import config
+from ..kg_ingestor.kg_ingestor import entity_key
+from ..ml_model.re_model import RelationExtractionModel
+
+FORMATS = ("admin", "load_csv")
+
+
+def iter_documents(path):
+    """
+    Yields the texts of the documents at `path`, always in the same order
+    """
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(path)
+                       for name in names if name.endswith(".txt"))
+        for document_path in paths:
+            with open(document_path, mode='r', encoding='utf-8') as f:
+                yield f.read()
+    else:
+        with open(path, mode='r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)["text"]
+
+
+def clean_name(name):
+    # one line per record, so that the loaders don't need multiline fields
+    return " ".join(str(name).split())
+
+
+def transform_relation(relation):
+    return relation.replace(" ", "_")
+
+
+class CsvExporter:
+    """
+    Writes the relations of each chunk of documents to numbered node and relationship CSV files. Entities
+    (by normalised name) and relationships (by head, type and tail) already written are skipped, the keys
+    seen and the number of documents done are committed to SQLite together once the chunk's files are written
+    """
+    def __init__(self, output_dir, file_format="admin"):
+        if file_format not in FORMATS:
+            raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.file_format = file_format
+        self.connection = sqlite3.connect(os.path.join(output_dir, "checkpoint.db"))
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entities (key TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS relationships (head TEXT, type TEXT, tail TEXT, "
+                                "PRIMARY KEY (head, type, tail)) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS progress (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                                "format TEXT NOT NULL, documents INTEGER NOT NULL, chunks INTEGER NOT NULL)")
+        self.connection.commit()
+        row = self.connection.execute("SELECT format, documents, chunks FROM progress").fetchone()
+        if row is None:
+            self.connection.execute("INSERT INTO progress (id, format, documents, chunks) VALUES (0, ?, 0, 0)",
+                                    (file_format,))
+            self.connection.commit()
+            row = (file_format, 0, 0)
+        if row[0] != file_format:
+            raise ValueError(f"{output_dir} holds an import in the {row[0]} format")
+        _, self.documents, self.chunks = row
+        if self.file_format == "admin":
+            self.write_admin_headers()
+
+    def path(self, name):
+        return os.path.join(self.output_dir, name)
+
+    def write_admin_headers(self):
+        with open(self.path("nodes-header.csv"), mode='w', encoding='utf-8', newline='') as f:
+            csv.writer(f).writerow(["name_key:ID", "name", "aliases:string[]", ":LABEL"])
+        with open(self.path("relationships-header.csv"), mode='w', encoding='utf-8', newline='') as f:
+            csv.writer(f).writerow([":START_ID", ":END_ID", ":TYPE"])
+
+    def new_rows(self, relations):
+        """
+        Node rows (key, name) and relationship rows (head key, type, tail key) of the relations not seen before,
+        inserted in the open transaction
+        """
+        nodes = []
+        relationships = []
+        for r in relations:
+            head, tail = clean_name(r["head"]), clean_name(r["tail"])
+            head_key, tail_key = entity_key(head), entity_key(tail)
+            if not head_key or not tail_key:
+                continue
+            for key, name in ((head_key, head), (tail_key, tail)):
+                if self.connection.execute("INSERT OR IGNORE INTO entities (key) VALUES (?)", (key,)).rowcount:
+                    nodes.append((key, name))
+            row = (head_key, transform_relation(r["type"]), tail_key)
+            if self.connection.execute("INSERT OR IGNORE INTO relationships (head, type, tail) VALUES (?, ?, ?)",
+                                       row).rowcount:
+                relationships.append(row)
+        return nodes, relationships
+
+    def write_chunk(self, relations, documents):
+        """
+        Writes the new entities and relationships of a chunk of `documents` documents and checkpoints it.
+        Returns the number of (nodes, relationships) written
+        """
+        chunk = self.chunks + 1
+        try:
+            nodes, relationships = self.new_rows(relations)
+            files = self.write_admin_chunk(chunk, nodes, relationships) if self.file_format == "admin" \
+                else self.write_load_csv_chunk(chunk, nodes, relationships)
+            # files of a chunk interrupted before its commit are written again, under the same names
+            for tmp_path, path in files:
+                os.replace(tmp_path, path)
+            self.connection.execute("UPDATE progress SET documents = documents + ?, chunks = ? WHERE id = 0",
+                                    (documents, chunk))
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        self.documents += documents
+        self.chunks = chunk
+        return len(nodes), len(relationships)
+
+    def write_csv(self, name, header, rows):
+        tmp_path = self.path(name + ".tmp")
+        with open(tmp_path, mode='w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            if header is not None:
+                writer.writerow(header)
+            writer.writerows(rows)
+        return tmp_path, self.path(name)
+
+    def write_admin_chunk(self, chunk, nodes, relationships):
+        # the headers are in their own files, aliases are ";" separated
+        return [
+            self.write_csv(f"nodes-{chunk:05d}.csv", None,
+                           ((key, name, name.replace(";", ","), "ENTITY") for key, name in nodes)),
+            self.write_csv(f"relationships-{chunk:05d}.csv", None,
+                           ((head, tail, relation_type) for head, relation_type, tail in relationships)),
+        ]
+
+    def write_load_csv_chunk(self, chunk, nodes, relationships):
+        # LOAD CSV can't take the relationship type from the file, the relationships of each type get a file
+        # and a statement of their own
+        files = [self.write_csv(f"nodes-{chunk:05d}.csv", ["name_key", "name"], nodes)]
+        statements = [f"USING PERIODIC COMMIT 10000 LOAD CSV WITH HEADERS FROM 'file:///nodes-{chunk:05d}.csv' "
+                      "AS row MERGE (x:ENTITY {name_key: row.name_key}) "
+                      "ON CREATE SET x.name = row.name, x.aliases = [row.name];"]
+        rows_by_type = {}
+        for head, relation_type, tail in relationships:
+            rows_by_type.setdefault(relation_type, []).append((head, tail))
+        for i, (relation_type, rows) in enumerate(sorted(rows_by_type.items())):
+            name = f"relationships-{chunk:05d}-{i:04d}.csv"
+            files.append(self.write_csv(name, ["head_key", "tail_key"], rows))
+            escaped_type = relation_type.replace("`", "``")
+            statements.append(f"USING PERIODIC COMMIT 10000 LOAD CSV WITH HEADERS FROM 'file:///{name}' AS row "
+                              "MATCH (h:ENTITY {name_key: row.head_key}), (t:ENTITY {name_key: row.tail_key}) "
+                              f"MERGE (h)-[:`{escaped_type}`]->(t);")
+        tmp_path = self.path(f"load-{chunk:05d}.cypher.tmp")
+        with open(tmp_path, mode='w', encoding='utf-8') as f:
+            f.write("\n".join(statements) + "\n")
+        files.append((tmp_path, self.path(f"load-{chunk:05d}.cypher")))
+        return files
+
+    def stats(self):
+        return {
+            "documents": self.documents,
+            "chunks": self.chunks,
+            "entities": self.connection.execute("SELECT COUNT(*) FROM entities").fetchone()[0],
+            "relationships": self.connection.execute("SELECT COUNT(*) FROM relationships").fetchone()[0],
+        }
+
+    def import_instructions(self):
+        if self.file_format == "admin":
+            return ("neo4j-admin import --database=neo4j "
+                    f"--nodes={self.path('nodes-header.csv')},{self.path('nodes-[0-9]+.csv')} "
+                    f"--relationships={self.path('relationships-header.csv')},"
+                    f"{self.path('relationships-[0-9]+.csv')}")
+        return (f"copy {self.output_dir}/*.csv to the import directory of Neo4j, then run "
+                f"{self.path('load-*.cypher')} in order with cypher-shell")
+
+
+def run(model, exporter, documents, chunk_documents=100, batch_size=16):
+    # documents of the chunks already exported are skipped
+    documents = itertools.islice(documents, exporter.documents, None)
+    while True:
+        texts = list(itertools.islice(documents, chunk_documents))
+        if len(texts) == 0:
+            break
+        start = time.perf_counter()
+        kbs = [model.link_entities(kb) for kb in model.from_texts_to_kbs(texts, batch_size=batch_size)]
+        nodes, relationships = exporter.write_chunk([r for kb in kbs for r in kb.relations], len(texts))
+        logging.info(f"chunk {exporter.chunks}: {len(texts)} documents, {nodes} new entities and "
+                     f"{relationships} new relationships in {time.perf_counter() - start:.1f}s "
+                     f"({exporter.documents} documents done)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", required=True, help="directory of .txt documents or JSONL file")
+    parser.add_argument("--output", required=True, help="directory of the CSV files and checkpoint")
+    parser.add_argument("--format", default="admin", choices=FORMATS)
+    parser.add_argument("--chunk-documents", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=16, help="spans per generate call")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    exporter = CsvExporter(args.output, file_format=args.format)
+    if exporter.documents:
+        logging.info(f"resuming after {exporter.documents} documents ({exporter.chunks} chunks)")
+    model = RelationExtractionModel(connect_backends=False)
+    if config.ENTITY_INDEX_PATH or config.ENTITY_RESOLVER_CACHE_PATH:
+        model.entity_linker = model.create_entity_linker()
+    run(model, exporter, iter_documents(args.input), chunk_documents=args.chunk_documents,
+        batch_size=args.batch_size)
+    print(json.dumps(exporter.stats()))
+    print(exporter.import_instructions())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import os
+
+# Inference backend of the relation extraction model: "torch" (fp32), "torch_int8" (dynamic quantisation)
+# or "onnx" (ONNX Runtime, requires optimum[onnxruntime])
+MODEL_BACKEND = os.environ.get("MODEL_BACKEND", "torch")
+
+# Number of prefork child processes of the Celery worker
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 1))
+# Load the model weights once in the parent worker process before it forks, so that every child shares
+# them copy-on-write instead of loading its own copy on its first task
+MODEL_PRELOAD = os.environ.get("MODEL_PRELOAD", "false").lower() in ("1", "true", "yes")
+# Intra-op threads per child process, defaults to an even share of the cores so children don't oversubscribe them
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", max(1, (os.cpu_count() or 1) // WORKER_CONCURRENCY)))
+
+# SQLite file memoising the relations decoded per span, empty to disable the span cache
+SPAN_CACHE_PATH = os.environ.get("SPAN_CACHE_PATH", "")
+SPAN_CACHE_MAX_ENTRIES = int(os.environ.get("SPAN_CACHE_MAX_ENTRIES", 100000))
+
+# Spans per subtask when a document is fanned out over the workers (RelationExtractionFanOut)
+FAN_OUT_SPANS_PER_GROUP = int(os.environ.get("FAN_OUT_SPANS_PER_GROUP", 32))
+# Threads writing to different graphs at the same time in a batch task
+GRAPH_WRITE_THREADS = int(os.environ.get("GRAPH_WRITE_THREADS", 4))
+
+# Entity linking of the extracted heads and tails to Wikipedia titles, disabled when ENTITY_INDEX_PATH is empty.
+# The title index is built with python -m celery_task_app.entity_linker.build_index and memory mapped, the linker
+# keeps up to ENTITY_LINKER_CACHE_SIZE recently linked names in memory
+ENTITY_INDEX_PATH = os.environ.get("ENTITY_INDEX_PATH", "")
+ENTITY_LINKER_CACHE_SIZE = int(os.environ.get("ENTITY_LINKER_CACHE_SIZE", 100000))
+# Names missing from the index are resolved with the Wikipedia API when ENTITY_RESOLVER_CACHE_PATH (a SQLite file
+# keeping the answers) is set, ENTITY_RESOLVER_THREADS requests at a time
+ENTITY_RESOLVER_CACHE_PATH = os.environ.get("ENTITY_RESOLVER_CACHE_PATH", "")
+ENTITY_RESOLVER_THREADS = int(os.environ.get("ENTITY_RESOLVER_THREADS", 8))
+# Drop the relations of entities without a title instead of keeping their extracted names
+ENTITY_LINKER_DROP_UNLINKED = os.environ.get("ENTITY_LINKER_DROP_UNLINKED", "false").lower() in ("1", "true", "yes")
+
+# Prometheus metrics (requires prometheus_client). The parent worker process serves the samples recorded by all of
+# its children on METRICS_PORT, the children write them to files in METRICS_DIR
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "false").lower() in ("1", "true", "yes")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9808))
+METRICS_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR", "/tmp/celery_worker_metrics")
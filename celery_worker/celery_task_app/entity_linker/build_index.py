@@ -0,0 +1,58 @@
+"""
+Builds the title index of the entity linker from a Wikipedia dump.
+
+--titles is a list of article titles, one per line, e.g. enwiki-latest-all-titles-in-ns0.gz.
+--redirects is a tab separated list of redirect title and target title, e.g. extracted from the redirect
+and page tables. Both may be gzipped. An article's own title wins over a redirect normalising to the same name.
+
+Run from the celery_worker directory:
+    python -m celery_task_app.entity_linker.build_index --titles titles.gz [--redirects redirects.tsv.gz] \
+        --output titles.idx
+"""
+import argparse
+import gzip
+import logging
+
+from ..kg_ingestor.kg_ingestor import entity_key
+from .entity_linker import write_index
+
+
+def read_lines(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, mode='rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line:
+                yield line
+
+
+def clean_title(title):
+    return title.replace("_", " ").strip()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--titles", required=True)
+    parser.add_argument("--redirects", default=None)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    titles = {}
+    for line in read_lines(args.titles):
+        title = clean_title(line)
+        if title == "page title":
+            continue
+        titles.setdefault(entity_key(title), title)
+    articles = len(titles)
+    if args.redirects:
+        for line in read_lines(args.redirects):
+            source, _, target = line.partition("\t")
+            if target:
+                titles.setdefault(entity_key(clean_title(source)), clean_title(target))
+    count = write_index(titles, args.output)
+    logging.info(f"{count} names written to {args.output}, {articles} of them article titles")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+import collections
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import wikipedia
+
+from ..kg_ingestor.kg_ingestor import entity_key
+from ..metrics import metrics
+
+WIKIPEDIA_URL = "https://en.wikipedia.org/wiki/"
+MISSING = object()
+
+
+def title_url(title):
+    return WIKIPEDIA_URL + quote(title.replace(" ", "_"))
+
+
+def write_index(titles, path):
+    """
+    Writes a dict of normalised name -> title in the format read by TitleIndex: magic, record count, the
+    count + 1 offsets of the records in the data section, then the records ("key\\0title", utf-8) sorted by key
+    """
+    records = sorted((key.encode('utf-8'), title.encode('utf-8')) for key, title in titles.items())
+    tmp_path = path + ".tmp"
+    with open(tmp_path, mode='wb') as f:
+        f.write(TitleIndex.MAGIC)
+        f.write(struct.pack("<Q", len(records)))
+        offset = 0
+        for key, title in records:
+            f.write(struct.pack("<Q", offset))
+            offset += len(key) + 1 + len(title)
+        f.write(struct.pack("<Q", offset))
+        for key, title in records:
+            f.write(key + b"\0" + title)
+    os.replace(tmp_path, path)
+    return len(records)
+
+
+class TitleIndex:
+    """
+    Read-only map of normalised name -> Wikipedia title, memory mapped from a file written by write_index.
+    A lookup is a binary search over the sorted keys touching a few pages of the file, so the index costs
+    no heap memory: the OS page cache keeps the hot pages and shares them between the worker processes
+    """
+    MAGIC = b"KGTITLE1"
+
+    def __init__(self, path):
+        self.file = open(path, mode='rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(self.MAGIC)] != self.MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a title index")
+        self.count = struct.unpack_from("<Q", self.mm, len(self.MAGIC))[0]
+        self.offsets_at = len(self.MAGIC) + 8
+        self.data_at = self.offsets_at + 8 * (self.count + 1)
+        logging.info(f"title index of {self.count} names opened at {path}")
+
+    def __len__(self):
+        return self.count
+
+    def get(self, key):
+        target = key.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start, end = struct.unpack_from("<QQ", self.mm, self.offsets_at + 8 * middle)
+            start += self.data_at
+            end += self.data_at
+            separator = self.mm.find(b"\0", start, end)
+            record_key = self.mm[start:separator]
+            if record_key < target:
+                low = middle + 1
+            elif record_key > target:
+                high = middle
+            else:
+                return self.mm[separator + 1:end].decode('utf-8')
+        return None
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+
+class WikipediaResolver:
+    """
+    Resolves names the title index doesn't know with the Wikipedia API, `max_workers` requests at a time.
+    Answers, including names without a page, are kept in a SQLite file shared by the worker processes so a
+    name is only ever requested once
+    """
+    def __init__(self, cache_path, max_workers=8):
+        self.connection = sqlite3.connect(cache_path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS titles "
+                                "(name TEXT PRIMARY KEY, title TEXT, resolved_at REAL NOT NULL)")
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        logging.info(f"wikipedia resolver cache opened at {cache_path}")
+
+    @staticmethod
+    def resolve_page(name):
+        try:
+            return wikipedia.page(name, auto_suggest=False).title
+        except (wikipedia.exceptions.PageError, wikipedia.exceptions.DisambiguationError):
+            return None
+        except Exception as e:
+            # network errors and the like are not cached, the name is requested again next time
+            logging.error(f"failed to resolve {name} on wikipedia error: {e}")
+            return MISSING
+
+    def resolve(self, names):
+        """
+        Returns a dict of name -> title (None when there is no page) for the names that could be resolved
+        """
+        names = list(set(names))
+        resolved = {}
+        with self.lock:
+            for start in range(0, len(names), 500):
+                chunk = names[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.connection.execute(f"SELECT name, title FROM titles WHERE name IN ({placeholders})",
+                                               chunk)
+                resolved.update(rows)
+        pending = [name for name in names if name not in resolved]
+        if len(pending) == 0:
+            return resolved
+        fetched = [(name, title) for name, title in zip(pending, self.executor.map(self.resolve_page, pending))
+                   if title is not MISSING]
+        now = time.time()
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO titles (name, title, resolved_at) VALUES (?, ?, ?)",
+                                        [(name, title, now) for name, title in fetched])
+            self.connection.commit()
+        resolved.update(fetched)
+        return resolved
+
+
+class EntityLinker:
+    """
+    Links entity names to canonical Wikipedia titles: a bounded LRU of the names linked recently first, then
+    the local title index and, for the names it doesn't know, the optional remote resolver. Names of a knowledge
+    base are linked in one batch. Unlinked names are kept as they are, or their relations dropped with
+    `drop_unlinked`
+    """
+    def __init__(self, index=None, resolver=None, cache_size=100000, drop_unlinked=False):
+        self.index = index
+        self.resolver = resolver
+        self.cache_size = cache_size
+        self.drop_unlinked = drop_unlinked
+        self.titles = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def cache_get(self, name):
+        with self.lock:
+            title = self.titles.get(name, MISSING)
+            if title is not MISSING:
+                self.titles.move_to_end(name)
+            return title
+
+    def cache_put(self, name, title):
+        if self.cache_size <= 0:
+            return
+        with self.lock:
+            self.titles[name] = title
+            self.titles.move_to_end(name)
+            while len(self.titles) > self.cache_size:
+                self.titles.popitem(last=False)
+
+    def link(self, names):
+        """
+        Returns a dict of name -> title, None for the names without one
+        """
+        titles = {}
+        unknown = []
+        for name in set(names):
+            title = self.cache_get(name)
+            if title is not MISSING:
+                titles[name] = title
+                metrics.ENTITIES_LINKED.labels("cache").inc()
+                continue
+            title = self.index.get(entity_key(name)) if self.index is not None else None
+            if title is not None:
+                titles[name] = title
+                self.cache_put(name, title)
+                metrics.ENTITIES_LINKED.labels("index").inc()
+            else:
+                unknown.append(name)
+        if self.resolver is not None and unknown:
+            resolved = self.resolver.resolve(unknown)
+        else:
+            resolved = dict.fromkeys(unknown)
+        for name in unknown:
+            title = resolved.get(name, MISSING)
+            if title is MISSING:
+                # not cached, the resolver failed
+                titles[name] = None
+                continue
+            titles[name] = title
+            self.cache_put(name, title)
+            metrics.ENTITIES_LINKED.labels("remote" if title is not None else "unlinked").inc()
+        return titles
+
+    def get_entity(self, name):
+        """
+        {"title", "url"} of the page of `name`, None when it isn't linked
+        """
+        title = self.link([name])[name]
+        if title is None:
+            return None
+        return {"title": title, "url": title_url(title)}
+
+    def link_relations(self, relations):
+        """
+        Returns copies of the relations with their heads and tails renamed to their titles, and the linked
+        entities as a dict of title -> {"url"}
+        """
+        titles = self.link([r["head"] for r in relations] + [r["tail"] for r in relations])
+        linked = []
+        for r in relations:
+            head, tail = titles[r["head"]], titles[r["tail"]]
+            if self.drop_unlinked and (head is None or tail is None):
+                continue
+            linked.append({**r, "head": head or r["head"], "tail": tail or r["tail"],
+                           "meta": {**r["meta"], "spans": list(r["meta"]["spans"])}})
+        entities = {title: {"url": title_url(title)} for title in titles.values() if title is not None}
+        return linked, entities
+
+    def stats(self):
+        return {"entries": len(self.titles), "max_entries": self.cache_size,
+                "index_size": len(self.index) if self.index is not None else 0}
@@ -0,0 +1,31 @@
+"""
+Sets the normalised name key and aliases of the entities ingested before they were maintained, run it once per
+graph after upgrading (the ingestor merges entities by key, keyless entities are not found).
+
+Run from the celery_worker directory:
+    python -m celery_task_app.kg_ingestor.backfill [--url neo4j://localhost:7687] [--graph-name name]
+"""
+import argparse
+import json
+import logging
+
+from .kg_ingestor import KGIngestor
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="neo4j://neo4j_container:7687")
+    parser.add_argument("--user", default="neo4j")
+    parser.add_argument("--password", default="test")
+    parser.add_argument("--graph-name", default=None, help="named graph to backfill, the default graph otherwise")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    ingestor = KGIngestor(args.url, args.user, args.password)
+    counts = ingestor.backfill_name_keys(graph_name=args.graph_name, batch_size=args.batch_size)
+    print(json.dumps(counts))
+
+
+if __name__ == '__main__':
+    main()
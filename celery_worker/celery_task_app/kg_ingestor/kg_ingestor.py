@@ -1,5 +1,77 @@
 from py2neo import Graph, Node, Relationship, NodeMatcher, RelationshipMatcher, GraphService
+from py2neo.errors import ConnectionBroken, ConnectionUnavailable, ServiceUnavailable, TransientError
 import logging
+import queue
+import random
+import re
+import threading
+import time
+import unicodedata
+
+from ..metrics import metrics
+
+# SCHEMA_QUERIES, GRAPH_NAME, entity_key and normalise_graph_name are copied in flask_app/kg_explorer/kg_explorer.py,
+# change both (benchmarks/key_parity.py checks that they are the same)
+UNIQUE_CONSTRAINT_QUERY = "CREATE CONSTRAINT IF NOT EXISTS ON (x:ENTITY) ASSERT x.name IS UNIQUE"
+# entities are merged and looked up by their normalised name, the constraint also backs it with an index
+NAME_KEY_CONSTRAINT_QUERY = "CREATE CONSTRAINT IF NOT EXISTS ON (x:ENTITY) ASSERT x.name_key IS UNIQUE"
+# fuzzy fallback of the explorer for names whose normalised form doesn't match
+ENTITY_NAMES_INDEX_QUERY = "CREATE FULLTEXT INDEX entity_names IF NOT EXISTS FOR (x:ENTITY) ON EACH [x.name]"
+SCHEMA_QUERIES = [UNIQUE_CONSTRAINT_QUERY, NAME_KEY_CONSTRAINT_QUERY, ENTITY_NAMES_INDEX_QUERY]
+KEYLESS_ENTITIES_QUERY = "MATCH (x:ENTITY) WHERE x.name_key IS NULL RETURN id(x) AS id, x.name AS name"
+KEYED_ENTITIES_QUERY = "UNWIND $keys AS key MATCH (x:ENTITY {name_key: key}) RETURN key, id(x) AS id"
+SET_NAME_KEYS_QUERY = ("UNWIND $rows AS row MATCH (x) WHERE id(x) = row.id "
+                       "SET x.name_key = row.key, x.aliases = coalesce(x.aliases, [x.name])")
+ADD_ALIASES_QUERY = ("UNWIND $rows AS row MATCH (x) WHERE id(x) = row.id AND NOT row.name IN coalesce(x.aliases, []) "
+                     "SET x.aliases = coalesce(x.aliases, []) + row.name")
+DUPLICATE_TYPES_QUERY = "UNWIND $ids AS id MATCH (x)-[r]-() WHERE id(x) = id RETURN DISTINCT type(r) AS type"
+DELETE_DUPLICATES_QUERY = "UNWIND $rows AS row MATCH (x) WHERE id(x) = row.id DETACH DELETE x"
+# errors after which a batch is written again: deadlocks and lock timeouts between concurrent workers
+# (Neo.TransientError.*) and dropped connections, the MERGE statements are idempotent
+TRANSIENT_ERRORS = (TransientError, ConnectionBroken, ConnectionUnavailable, ServiceUnavailable)
+# Neo4j database names: 3 to 63 ASCII letters, digits, dots and dashes starting with a letter, case insensitive
+GRAPH_NAME = re.compile(r'^[A-Za-z][A-Za-z0-9.\-]{2,62}$')
+
+
+def entity_key(name):
+    """
+    Normalised entity name: case, Unicode compatibility forms, spacing, surrounding quotes and punctuation
+    and a leading "the" are ignored, e.g. " The United  States?" -> "united states"
+    """
+    key = " ".join(unicodedata.normalize("NFKC", str(name)).casefold().split()).strip("'\"?!.,;: ")
+    if key.startswith("the ") and len(key) > 4:
+        key = key[4:].lstrip()
+    return key
+
+
+def normalise_graph_name(graph_name):
+    """
+    Lower-cased database name, None for the default graph. Raises ValueError for names Neo4j would reject
+    """
+    if graph_name is None:
+        return None
+    if not isinstance(graph_name, str) or not GRAPH_NAME.match(graph_name) or graph_name.lower() == "system":
+        raise ValueError(f"invalid graph name {graph_name!r}")
+    return graph_name.lower()
+
+
+def move_relationships_queries(relation_type):
+    """
+    Queries re-creating the outgoing and incoming `relation_type` relationships of the duplicate entities
+    (row.id) on the entities holding their key (row.owner), a duplicate's relationship to itself becomes one
+    of the owner
+    """
+    relation_type = relation_type.replace("`", "``")
+    outgoing = ("UNWIND $rows AS row "
+                f"MATCH (d)-[:`{relation_type}`]->(t) WHERE id(d) = row.id "
+                "MATCH (o) WHERE id(o) = row.owner "
+                "WITH o, CASE WHEN id(t) = row.id THEN o ELSE t END AS target "
+                f"MERGE (o)-[:`{relation_type}`]->(target)")
+    incoming = ("UNWIND $rows AS row "
+                f"MATCH (h)-[:`{relation_type}`]->(d) WHERE id(d) = row.id AND id(h) <> row.id "
+                "MATCH (o) WHERE id(o) = row.owner "
+                f"MERGE (h)-[:`{relation_type}`]->(o)")
+    return outgoing, incoming
 
 
 class KGIngestor:
@@ -9,80 +81,191 @@ class KGIngestor:
         self.default_graph = self.graph_service.default_graph
         self.default_node_matcher = NodeMatcher(self.default_graph)
         self.default_relation_matcher = RelationshipMatcher(self.default_graph)
+        # named graphs resolved so far (with their constraints created), resolving one lists the databases
+        self.graphs = {None: (self.default_graph, self.default_node_matcher, self.default_relation_matcher)}
+        self.graphs_lock = threading.Lock()
         self.create_unique_constraint()
 
     def transform_relation(self, relation):
         return relation.replace(" ", "_")
 
     def create_unique_constraint(self, graph_name=None):
-        if graph_name is None:
-            self.default_graph.run("CREATE CONSTRAINT IF NOT EXISTS ON (x:ENTITY) ASSERT x.name IS UNIQUE")
-        else:
-            self.graph_service[graph_name].run("CREATE CONSTRAINT IF NOT EXISTS ON (x:ENTITY) ASSERT x.name IS UNIQUE")
+        graph = self.get_graph(graph_name)
+        for query in SCHEMA_QUERIES:
+            graph.run(query)
 
+    def resolve_graph(self, graph_name=None):
+        """
+        (graph, node matcher, relationship matcher) of a named graph, None for the default graph.
+        Raises ValueError for invalid names and KeyError for graphs that don't exist. The schema (constraints
+        and indexes) is created on first use
+        """
+        graph_name = normalise_graph_name(graph_name)
+        resolved = self.graphs.get(graph_name)
+        if resolved is None:
+            with self.graphs_lock:
+                resolved = self.graphs.get(graph_name)
+                if resolved is None:
+                    graph = self.graph_service[graph_name]
+                    for query in SCHEMA_QUERIES:
+                        graph.run(query)
+                    resolved = (graph, NodeMatcher(graph), RelationshipMatcher(graph))
+                    self.graphs[graph_name] = resolved
+                    logging.info(f"graph {graph_name} resolved")
+        return resolved
+
+    def get_graph(self, graph_name=None):
+        return self.resolve_graph(graph_name)[0]
+
+    @metrics.timed("neo4j_create_relationship")
     def create_relationship(self, node1, relation, node2, graph_name=None):
         try:
-            if graph_name == None:
-                graph = self.graph_service.default_graph
-            else:
-                if graph_name not in self.graph_service:
-                    logging.error("Graph: {graph_name} does not exist."
-                                  " Please create the graph first.".format(graph_name=graph_name))
-                    return False
-                else:
-                    graph = self.default_graph
-            tx = graph.begin()
-            node1 = self._get_or_create_node(tx, node1)
-            node2 = self._get_or_create_node(tx, node2)
-            relation = self.transform_relation(relation)
-            n1n2 = Relationship(node1, relation, node2)
-            tx.create(n1n2)
-            tx.commit()
+            graph_name = normalise_graph_name(graph_name)
+            graph = self.get_graph(graph_name)
+        except (KeyError, ValueError) as e:
+            logging.error("Graph: {graph_name} does not exist."
+                          " Please create the graph first. error: {e}".format(graph_name=graph_name, e=e))
+            return False
+        if not entity_key(node1) or not entity_key(node2):
+            logging.error(f"relation {node1!r} -{relation}-> {node2!r} skipped, an entity name has no key")
+            return False
+        try:
+            try:
+                self._create_relationship(graph, node1, relation, node2, graph_name)
+            except Exception as e:
+                # another worker created one of the entities since we looked it up (unique constraint
+                # violation) or deleted it: retry once with fresh lookups
+                logging.info(f"retrying relation {node1} -{relation}-> {node2} error: {e}")
+                self._create_relationship(graph, node1, relation, node2, graph_name)
         except Exception as e:
             logging.error(f"failed to ingest relation {node1} -{relation}-> {node2} error: {e}")
+            return False
+        return True
+
+    def _create_relationship(self, graph, node1, relation, node2, graph_name=None):
+        tx = graph.begin()
+        try:
+            head = self._get_or_create_node(tx, node1, graph_name=graph_name)
+            same = entity_key(node2) == entity_key(node1)
+            tail = head if same else self._get_or_create_node(tx, node2, graph_name=graph_name)
+            n1n2 = Relationship(head, self.transform_relation(relation), tail)
+            tx.create(n1n2)
+            if n1n2.identity is None:
+                # the relationship is created by matching the node ids, nothing matched
+                raise LookupError(f"node of {node1} or {node2} no longer exists")
+        except Exception:
+            tx.rollback()
+            raise
+        tx.commit()
+
+    def merge_relations_query(self, relation_type):
+        relation_type = relation_type.replace("`", "``")
+        # the first name an entity is written with stays its name, other names normalising to the same key are
+        # appended to its aliases (only when new, so that hub entities aren't locked by every write)
+        return ("UNWIND $rows AS row "
+                "MERGE (h:ENTITY {name_key: row.head_key}) ON CREATE SET h.name = row.head, h.aliases = [row.head] "
+                "FOREACH (_ IN CASE WHEN row.head IN h.aliases THEN [] ELSE [1] END | "
+                "SET h.aliases = coalesce(h.aliases, []) + row.head) "
+                "MERGE (t:ENTITY {name_key: row.tail_key}) ON CREATE SET t.name = row.tail, t.aliases = [row.tail] "
+                "FOREACH (_ IN CASE WHEN row.tail IN t.aliases THEN [] ELSE [1] END | "
+                "SET t.aliases = coalesce(t.aliases, []) + row.tail) "
+                f"MERGE (h)-[:`{relation_type}`]->(t)")
+
+    def ingest_relations(self, relations, batch_size=500, graph_name=None, retries=3, retry_backoff=0.2):
+        """
+        Bulk counterpart of create_relationship. Relations are grouped by type and every batch
+        is written with a single UNWIND/MERGE statement, i.e. one round trip per batch.
+        Rows are sorted by entity keys so that concurrent workers lock the nodes they share in the same order,
+        a batch failing with a transient error (e.g. DeadlockDetected) is retried up to `retries` times after
+        a jittered exponential backoff starting at `retry_backoff` seconds.
+        Relations with an entity whose name normalises to an empty key (e.g. "?!") are skipped.
+        Returns one count dict per batch.
+        """
+        graph = self.get_graph(graph_name)
+        rows_by_type = {}
+        skipped = 0
+        for relation in relations:
+            head_key, tail_key = entity_key(relation['head']), entity_key(relation['tail'])
+            if not head_key or not tail_key:
+                # they would all be merged into a single entity with an empty key
+                skipped += 1
+                continue
+            relation_type = self.transform_relation(relation['type'])
+            rows_by_type.setdefault(relation_type, []).append({
+                "head": relation['head'], "head_key": head_key, "tail": relation['tail'], "tail_key": tail_key})
+        if skipped:
+            logging.warning(f"skipped {skipped} relations with an entity name that has no key")
+            metrics.RELATIONS_WRITTEN.labels("skipped").inc(skipped)
+        batch_counts = []
+        for relation_type, rows in rows_by_type.items():
+            query = self.merge_relations_query(relation_type)
+            rows.sort(key=lambda row: (row['head_key'], row['tail_key']))
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                counts = {"type": relation_type, "relations": len(batch),
+                          "nodes_created": 0, "relationships_created": 0}
+                try:
+                    stats = self.write_batch(graph, query, batch, retries, retry_backoff)
+                    counts["nodes_created"] = stats.get("nodes_created", 0)
+                    counts["relationships_created"] = stats.get("relationships_created", 0)
+                    metrics.RELATIONS_WRITTEN.labels("written").inc(len(batch))
+                except Exception as e:
+                    logging.error(f"failed to ingest batch of {len(batch)} {relation_type} relations error: {e}")
+                    counts["failed"] = True
+                    metrics.RELATIONS_WRITTEN.labels("failed").inc(len(batch))
+                batch_counts.append(counts)
+        return batch_counts
+
+    @staticmethod
+    def write_batch(graph, query, batch, retries=3, retry_backoff=0.2):
+        for attempt in range(retries + 1):
+            try:
+                with metrics.stage("neo4j_write"):
+                    return graph.run(query, rows=batch).stats()
+            except TRANSIENT_ERRORS as e:
+                if attempt == retries:
+                    raise
+                delay = retry_backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                logging.warning(f"retrying batch of {len(batch)} relations in {delay:.2f}s error: {e}")
+                time.sleep(delay)
 
     def _get_node(self, node_name, node_label="ENTITY", graph_name=None):
-        if graph_name is not None:
-            node_matcher = self.get_node_matcher(graph_name=graph_name)
-        else:
-            node_matcher = self.default_node_matcher
-        node_match = node_matcher.match(node_label, name=node_name)
-        if node_match.exists():
-            return node_match.first(), True
-        else:
-            return None, False
+        node = self._find_node(node_name, node_label, graph_name)
+        return node, node is not None
+
+    def _find_node(self, node_name, node_label="ENTITY", graph_name=None):
+        # a single lookup query, ENTITY nodes are found by normalised name
+        graph_name = normalise_graph_name(graph_name)
+        if node_label != "ENTITY":
+            return self.get_node_matcher(graph_name).match(node_label, name=node_name).first()
+        return self.get_node_matcher(graph_name).match(node_label, name_key=entity_key(node_name)).first()
 
     def _get_or_create_node(self, tx, node_name, node_label="ENTITY", graph_name=None):
-        if graph_name is not None:
-            node_matcher = self.get_node_matcher(graph_name)
-        else:
-            node_matcher = self.default_node_matcher
-        node_match = node_matcher.match(node_label, name=node_name)
-        if node_match.exists():
-            return node_match.first()
-        else:
-            nd = Node(node_label, name=node_name)
-            tx.create(nd)
-            return nd
+        node = self._find_node(node_name, node_label, graph_name)
+        if node is None:
+            if node_label == "ENTITY":
+                node = Node(node_label, name=node_name, name_key=entity_key(node_name), aliases=[node_name])
+            else:
+                node = Node(node_label, name=node_name)
+            tx.create(node)
+        elif node_label == "ENTITY" and node_name not in (node["aliases"] or []):
+            node["aliases"] = list(node["aliases"] or []) + [node_name]
+            tx.push(node)
+        return node
 
     def get_node_matcher(self, graph_name):
-        graph = self.graph_service[graph_name]
-        return NodeMatcher(graph)
+        return self.resolve_graph(graph_name)[1]
 
     def get_relation_matcher(self, graph_name):
-        graph = self.graph_service[graph_name]
-        return RelationshipMatcher(graph)
+        return self.resolve_graph(graph_name)[2]
 
     def find_relationship(self, n1, n2, graph_name=None):
-        if graph_name is not None:
-            relation_matcher = self.get_relation_matcher(graph_name)
-        else:
-            relation_matcher = self.default_relation_matcher
-        node1, exists = self._get_node(n1)
+        relation_matcher = self.get_relation_matcher(graph_name)
+        node1, exists = self._get_node(n1, graph_name=graph_name)
         if not exists:
             logging.error("No node found for {entity}".format(entity=n1))
             return
-        node2, exists = self._get_node(n2)
+        node2, exists = self._get_node(n2, graph_name=graph_name)
         if not exists:
             logging.error("No node found for {entity}".format(entity=n2))
             return
@@ -90,13 +273,108 @@ class KGIngestor:
         return type(match_output.first()).__name__
 
     def find_relation_tail(self, n1, relation, graph_name=None):
-        if graph_name is not None:
-            relation_matcher = self.get_relation_matcher(graph_name)
-        else:
-            relation_matcher = self.default_relation_matcher
-        node1, exists = self._get_node(n1)
+        relation_matcher = self.get_relation_matcher(graph_name)
+        node1, exists = self._get_node(n1, graph_name=graph_name)
         if not exists:
             logging.error("No node found for {entity}".format(entity=n1))
             return
         relationship = list(relation_matcher.match([node1], r_type=self.transform_relation(relation)))
         return relationship[0]
+
+    def backfill_name_keys(self, graph_name=None, batch_size=1000):
+        """
+        Sets the normalised name key and aliases of the entities written before they existed, in batches.
+        An entity whose key is already taken (e.g. "paris" next to "Paris") is merged into the entity holding
+        the key: its relationships are moved there, its name added to the aliases and the duplicate deleted.
+        Every step is idempotent, an interrupted backfill is finished by running it again. Returns the number
+        of entities of each kind
+        """
+        graph = self.get_graph(graph_name)
+        counts = {"keyed": 0, "merged": 0}
+        batch = []
+        # a single streamed read, the batches are written by other transactions while it is consumed
+        for record in graph.run(KEYLESS_ENTITIES_QUERY):
+            batch.append({"id": record["id"], "name": record["name"], "key": entity_key(record["name"])})
+            if len(batch) == batch_size:
+                self._backfill_batch(graph, batch, counts)
+                batch = []
+        if batch:
+            self._backfill_batch(graph, batch, counts)
+        logging.info(f"name keys backfilled {counts}")
+        return counts
+
+    def _backfill_batch(self, graph, batch, counts):
+        owners = {row["key"]: row["id"]
+                  for row in graph.run(KEYED_ENTITIES_QUERY, keys=list({row["key"] for row in batch})).data()}
+        keyed = []
+        duplicates = []
+        for row in batch:
+            if row["key"] in owners:
+                duplicates.append({"id": row["id"], "owner": owners[row["key"]], "name": row["name"]})
+            else:
+                owners[row["key"]] = row["id"]
+                keyed.append(row)
+        if keyed:
+            graph.run(SET_NAME_KEYS_QUERY, rows=keyed)
+        if duplicates:
+            types = graph.run(DUPLICATE_TYPES_QUERY, ids=[row["id"] for row in duplicates]).data()
+            for relation_type in sorted(row["type"] for row in types):
+                for query in move_relationships_queries(relation_type):
+                    graph.run(query, rows=duplicates)
+            graph.run(ADD_ALIASES_QUERY, rows=[{"id": row["owner"], "name": row["name"]} for row in duplicates])
+            # deleted last, a duplicate whose relationships weren't all moved is still found by the next run
+            graph.run(DELETE_DUPLICATES_QUERY, rows=duplicates)
+        counts["keyed"] += len(keyed)
+        counts["merged"] += len(duplicates)
+
+
+class RelationWriter(threading.Thread):
+    """
+    Background thread draining relations from a bounded queue into KGIngestor.ingest_relations,
+    so that Neo4j writes overlap with the producer (e.g. model inference).
+    Everything queued since the last write is coalesced into one ingest_relations call.
+    """
+    def __init__(self, ingestor, batch_size=500, max_pending=8, graph_name=None):
+        super().__init__(daemon=True)
+        self.ingestor = ingestor
+        self.batch_size = batch_size
+        self.graph_name = graph_name
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.batch_counts = []
+        self.error = None
+
+    def write(self, relations):
+        # blocks while max_pending writes are queued, applying back pressure to the producer
+        if relations:
+            self.queue.put(list(relations))
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.batch_counts
+
+    def run(self):
+        done = False
+        while not done:
+            relations = self.queue.get()
+            if relations is None:
+                break
+            while True:
+                try:
+                    pending = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if pending is None:
+                    done = True
+                    break
+                relations += pending
+            if self.error is not None:
+                continue
+            try:
+                self.batch_counts += self.ingestor.ingest_relations(relations, batch_size=self.batch_size,
+                                                                    graph_name=self.graph_name)
+            except Exception as e:
+                logging.error(f"relation writer failed to ingest {len(relations)} relations error: {e}")
+                self.error = e
@@ -2,9 +2,10 @@ import wikipedia
 
 
 class KnowledgeBase:
-    def __init__(self):
+    def __init__(self, entity_linker=None):
         self.entities = {}
         self.relations = []
+        self.entity_linker = entity_linker
 
     def are_relations_equal(self, r1, r2):
         return all(r1[attr] == r2[attr] for attr in ["head", "type", "tail"])
@@ -20,6 +21,10 @@ class KnowledgeBase:
         r2["meta"]["spans"] += spans_to_add
 
     def get_wikipedia_data(self, candidate_entity):
+        # the entity linker answers from its local title index, the Wikipedia API is one blocking request
+        # per entity
+        if self.entity_linker is not None:
+            return self.entity_linker.get_entity(candidate_entity)
         try:
             page = wikipedia.page(candidate_entity, auto_suggest=False)
             entity_data = {
@@ -35,21 +40,25 @@ class KnowledgeBase:
         self.entities[e["title"]] = {k: v for k, v in e.items() if k != "title"}
 
     def add_relation(self, r):
-        # check on wikipedia
-        #candidate_entities = [r["head"], r["tail"]]
-        #entities = [self.get_wikipedia_data(ent) for ent in candidate_entities]
+        if self.entity_linker is not None:
+            # check on wikipedia
+            candidate_entities = [r["head"], r["tail"]]
+            entities = [self.get_wikipedia_data(ent) for ent in candidate_entities]
 
-        # if one entity does not exist, stop
-        #if any(ent is None for ent in entities):
-         #   return
+            # if one entity does not exist, stop (or keep its name)
+            if any(ent is None for ent in entities) and self.entity_linker.drop_unlinked:
+                return
 
-        # manage new entities
-        #for e in entities:
-        #    self.add_entity(e)
+            # manage new entities
+            for e in entities:
+                if e is not None:
+                    self.add_entity(e)
 
-        # rename relation entities with their wikipedia titles
-        #r["head"] = entities[0]["title"]
-        #r["tail"] = entities[1]["title"]
+            # rename relation entities with their wikipedia titles
+            if entities[0] is not None:
+                r["head"] = entities[0]["title"]
+            if entities[1] is not None:
+                r["tail"] = entities[1]["title"]
 
         # manage new relation
         if not self.exists_relation(r):
@@ -64,3 +73,76 @@ class KnowledgeBase:
         print("Relations:")
         for r in self.relations:
             print(f"  {r}")
+
+
+class IndexedKnowledgeBase(KnowledgeBase):
+    """
+    KnowledgeBase keyed by (head, type, tail) with a span set per relation, so adding and merging
+    relations is O(1) instead of a scan over every known relation.
+    Exposes the same `relations` list as KnowledgeBase.
+    """
+    def __init__(self):
+        self.entities = {}
+        self._relations = {}
+        self._spans = {}
+        # entities are linked in one batch by link_entities rather than relation by relation
+        self.entity_linker = None
+
+    @property
+    def relations(self):
+        return list(self._relations.values())
+
+    def __len__(self):
+        return len(self._relations)
+
+    @staticmethod
+    def relation_key(r):
+        return r["head"], r["type"], r["tail"]
+
+    def exists_relation(self, r1):
+        return self.relation_key(r1) in self._relations
+
+    def merge_relations(self, r1):
+        key = self.relation_key(r1)
+        known_spans = self._spans[key]
+        spans = self._relations[key]["meta"]["spans"]
+        for span in r1["meta"]["spans"]:
+            span_key = tuple(span)
+            if span_key not in known_spans:
+                known_spans.add(span_key)
+                spans.append(span)
+
+    def add_relation(self, r):
+        key = self.relation_key(r)
+        if key not in self._relations:
+            self._relations[key] = r
+            self._spans[key] = {tuple(span) for span in r["meta"]["spans"]}
+        else:
+            self.merge_relations(r)
+
+    def merge(self, other):
+        """
+        Merge another knowledge base (e.g. the result of another chunk) into this one.
+        """
+        for e_title, e_data in other.entities.items():
+            self.entities.setdefault(e_title, e_data)
+        for r in other.relations:
+            self.add_relation({**r, "meta": {**r["meta"], "spans": list(r["meta"]["spans"])}})
+        return self
+
+    def link_entities(self, entity_linker):
+        """
+        Knowledge base with the heads and tails renamed to their titles, all names linked in one batch.
+        Relations that end up the same are merged
+        """
+        relations, entities = entity_linker.link_relations(self.relations)
+        kb = IndexedKnowledgeBase.from_relations(relations)
+        kb.entities = {**self.entities, **entities}
+        return kb
+
+    @classmethod
+    def from_relations(cls, relations):
+        kb = cls()
+        for r in relations:
+            kb.add_relation(r)
+        return kb
@@ -0,0 +1,106 @@
+import contextlib
+import logging
+import os
+
+from .. import config
+
+prometheus_client = None
+if config.METRICS_ENABLED:
+    # tasks run in the prefork children, so samples go through the multiprocess files that the parent
+    # aggregates. The directory has to be known before prometheus_client is imported
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = config.METRICS_DIR
+    os.makedirs(config.METRICS_DIR, exist_ok=True)
+    try:
+        import prometheus_client
+        from prometheus_client import multiprocess
+    except ImportError:
+        logging.warning("METRICS_ENABLED is set but prometheus_client is not installed, metrics are disabled")
+
+ENABLED = prometheus_client is not None
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class NoopMetric:
+    """
+    Stands in for every metric when metrics are disabled
+    """
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, amount):
+        pass
+
+    def time(self):
+        return NULL_CONTEXT
+
+
+NOOP = NoopMetric()
+NULL_CONTEXT = contextlib.nullcontext()
+
+
+def histogram(name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+    if not ENABLED:
+        return NOOP
+    return prometheus_client.Histogram(name, documentation, labelnames, buckets=buckets)
+
+
+def counter(name, documentation, labelnames=()):
+    if not ENABLED:
+        return NOOP
+    return prometheus_client.Counter(name, documentation, labelnames)
+
+
+STAGE_SECONDS = histogram("kg_worker_stage_seconds", "Time spent in each ingestion stage", ["stage"])
+INGESTIONS = counter("kg_worker_ingestions_total", "Ingestions by final status", ["status"])
+TOKENS = counter("kg_worker_tokens_total", "Tokens produced by the tokenizer")
+SPANS = counter("kg_worker_spans_total", "Spans processed, generated by the model or read from the span cache",
+                ["source"])
+RELATIONS_EXTRACTED = counter("kg_worker_relations_extracted_total", "Relations decoded from the model output")
+RELATIONS_WRITTEN = counter("kg_worker_relations_written_total", "Relations sent to Neo4j", ["outcome"])
+ENTITIES_LINKED = counter("kg_worker_entities_linked_total", "Entity names linked, by where their title was found",
+                          ["source"])
+
+
+def stage(name):
+    """
+    Context manager timing a block into kg_worker_stage_seconds
+    """
+    if not ENABLED:
+        return NULL_CONTEXT
+    return STAGE_SECONDS.labels(name).time()
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function as stage `name`, the function is returned as is when
+    metrics are disabled
+    """
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+        return STAGE_SECONDS.labels(name).time()(fn)
+    return decorator
+
+
+def start_server(port):
+    """
+    Serve the samples of every worker process, meant to run once in the parent worker process
+    """
+    if not ENABLED:
+        return
+    # samples left by the processes of a previous run
+    for file_name in os.listdir(config.METRICS_DIR):
+        if file_name.endswith(".db"):
+            os.remove(os.path.join(config.METRICS_DIR, file_name))
+    registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    prometheus_client.start_http_server(port, registry=registry)
+    logging.info(f"metrics served on port {port}")
+
+
+def mark_process_dead(pid):
+    if ENABLED:
+        multiprocess.mark_process_dead(pid)
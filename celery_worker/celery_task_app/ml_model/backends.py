@@ -0,0 +1,42 @@
+import logging
+import os
+
+import torch
+from transformers import AutoModelForSeq2SeqLM
+
+MODEL_NAME = "Babelscape/rebel-large"
+CACHE_DIR = "celery_task_app/ml_model/model_cache"
+BACKENDS = ("torch", "torch_int8", "onnx")
+
+
+def load_model(backend="torch", model_name=MODEL_NAME, cache_dir=CACHE_DIR):
+    """
+    Load the seq2seq model for the given inference backend. Every backend exposes `generate`
+    with the same arguments, so RelationExtractionModel does not depend on the choice.
+    """
+    if backend == "torch":
+        return AutoModelForSeq2SeqLM.from_pretrained(model_name, cache_dir=cache_dir)
+    if backend == "torch_int8":
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_name, cache_dir=cache_dir)
+        model.eval()
+        # int8 weights with dynamically quantised activations for every linear layer
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if backend == "onnx":
+        return load_onnx_model(model_name, cache_dir)
+    raise ValueError(f"Unknown model backend {backend}, expected one of {BACKENDS}")
+
+
+def load_onnx_model(model_name=MODEL_NAME, cache_dir=CACHE_DIR):
+    try:
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    except ImportError as e:
+        raise ImportError("The onnx backend requires optimum[onnxruntime] to be installed") from e
+    export_dir = os.path.join(cache_dir, "onnx", model_name.replace("/", "--"))
+    if os.path.isdir(export_dir):
+        return ORTModelForSeq2SeqLM.from_pretrained(export_dir, use_cache=True)
+    # export encoder, decoder and decoder-with-past once, later loads reuse the exported graphs
+    logging.info(f"Exporting {model_name} to ONNX in {export_dir}")
+    model = ORTModelForSeq2SeqLM.from_pretrained(model_name, from_transformers=True, use_cache=True,
+                                                 cache_dir=cache_dir)
+    model.save_pretrained(export_dir)
+    return model
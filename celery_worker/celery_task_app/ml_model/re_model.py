@@ -1,25 +1,45 @@
 import logging
 
-from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+from transformers import AutoTokenizer
+from . import backends
+from .. import config
+from ..entity_linker import entity_linker
 from ..knowledge_base import knowledge_base
 from ..kg_ingestor import kg_ingestor
+from ..metrics import metrics
 from ..mongo_logger import mongo_logger
+from ..span_cache import span_cache
+from concurrent.futures import ThreadPoolExecutor
 import math
 import torch
+import uuid
 
 
 class RelationExtractionModel:
-    def __init__(self):
-        self.tokenizer = AutoTokenizer.from_pretrained("Babelscape/rebel-large", cache_dir="celery_task_app/ml_model"
-                                                                                           "/model_cache")
-        self.model = AutoModelForSeq2SeqLM.from_pretrained("Babelscape/rebel-large", cache_dir="celery_task_app"
-                                                                                               "/ml_model/model_cache")
+    TRIPLET_MARKERS = ["<triplet>", "<subj>", "<obj>"]
+
+    def __init__(self, connect_backends=True, backend=None):
+        self.backend = backend or config.MODEL_BACKEND
+        self.tokenizer = AutoTokenizer.from_pretrained(backends.MODEL_NAME, cache_dir=backends.CACHE_DIR)
+        self.model = backends.load_model(self.backend)
+        logging.info(f"loaded {backends.MODEL_NAME} with the {self.backend} backend")
         self.gen_kwargs = {
             "max_length": 256,
             "length_penalty": 0,
             "num_beams": 3,
             "num_return_sequences": 3,
         }
+        self.marker_token_ids = {self.tokenizer.convert_tokens_to_ids(marker): marker
+                                 for marker in self.TRIPLET_MARKERS}
+        self.skipped_token_ids = {self.tokenizer.bos_token_id, self.tokenizer.eos_token_id,
+                                  self.tokenizer.pad_token_id}
+        self.span_cache = None
+        self.entity_linker = None
+        self.backends_connected = False
+        if connect_backends:
+            self.connect_backends()
+
+    def connect_backends(self):
         scheme = "neo4j"  # Connecting to Aura, use the "neo4j+s" URI scheme
         host_name = "neo4j_container"
         port = 7687
@@ -28,37 +48,257 @@ class RelationExtractionModel:
         password = "test"
         self.kg_ingestor = kg_ingestor.KGIngestor(url, user, password)
         logging.info("connected to KG ingestor successfully")
-        self.mongo_logger = mongo_logger.MongoLogger("mongodb://mongodb_container:27017/", "ingestion_db",
-                                                     "ingestion_logs")
+        self.mongo_logger = mongo_logger.MongoLogger(mongo_logger.MONGO_URL, mongo_logger.DATABASE,
+                                                     mongo_logger.COLLECTION)
         logging.info("connected to mongo logger successfully")
+        if config.SPAN_CACHE_PATH:
+            self.span_cache = span_cache.SpanCache(config.SPAN_CACHE_PATH, config.SPAN_CACHE_MAX_ENTRIES)
+        if config.ENTITY_INDEX_PATH or config.ENTITY_RESOLVER_CACHE_PATH:
+            self.entity_linker = self.create_entity_linker()
+        self.backends_connected = True
 
-    def process_data(self, text: str, verbose=True):
-        # Plan
-        # Create KB out of it
-        # Iterate over KB to ingest relations
-        kb = self.from_text_to_kb(text)
-        relations = kb.relations
-        count = 0
-        ingestion_id = self.mongo_logger.push_sample_relations(relations)
-        for relation in relations:
-            count += 1
-            self.kg_ingestor.create_relationship(relation['head'], relation['type'], relation['tail'])
+    @staticmethod
+    def create_entity_linker():
+        index = entity_linker.TitleIndex(config.ENTITY_INDEX_PATH) if config.ENTITY_INDEX_PATH else None
+        resolver = None
+        if config.ENTITY_RESOLVER_CACHE_PATH:
+            resolver = entity_linker.WikipediaResolver(config.ENTITY_RESOLVER_CACHE_PATH,
+                                                       max_workers=config.ENTITY_RESOLVER_THREADS)
+        return entity_linker.EntityLinker(index=index, resolver=resolver, cache_size=config.ENTITY_LINKER_CACHE_SIZE,
+                                          drop_unlinked=config.ENTITY_LINKER_DROP_UNLINKED)
+
+    def link_entities(self, kb):
+        # renames the heads and tails of the KB to their Wikipedia titles when entity linking is enabled
+        if self.entity_linker is None:
+            return kb
+        with metrics.stage("entity_linking"):
+            return kb.link_entities(self.entity_linker)
+
+    def link_relations(self, relations):
+        if self.entity_linker is None or len(relations) == 0:
+            return relations
+        with metrics.stage("entity_linking"):
+            return self.entity_linker.link_relations(relations)[0]
+
+    def process_data(self, text: str, verbose=True, pipelined=False, long_document=False, max_batch_tokens=4096,
+                     task_id=None, graph_name=None):
+        task_id = task_id or str(uuid.uuid4())
+        ingestion_id = self.mongo_logger.start_ingestion(task_id, graph_name=graph_name)
+        progress = mongo_logger.SpanProgress(self.mongo_logger, task_id)
+        try:
+            # fail before inference when the graph doesn't exist
+            self.kg_ingestor.get_graph(graph_name)
+            if pipelined:
+                count = self.ingest_pipelined(text, ingestion_id, progress, max_batch_tokens=max_batch_tokens,
+                                              graph_name=graph_name)
+            else:
+                # Plan
+                # Create KB out of it
+                # Iterate over KB to ingest relations
+                if long_document:
+                    kb = self.from_long_text_to_kb(text, max_batch_tokens=max_batch_tokens, progress=progress)
+                else:
+                    kb = self.from_text_to_kb(text, progress=progress)
+                relations = self.link_entities(kb).relations
+                self.mongo_logger.push_sample_relations(relations, ingestion_id=ingestion_id)
+                count = self.ingest_kb_relations(relations, ingestion_id, graph_name=graph_name)
+        except Exception:
+            self.mongo_logger.finish_ingestion(task_id, status="FAILED")
+            metrics.INGESTIONS.labels("FAILED").inc()
+            raise
+        self.mongo_logger.finish_ingestion(task_id)
+        metrics.INGESTIONS.labels("DONE").inc()
         if verbose:
             print(f"{count} relationships have been ingested")
 
         return {"ingestion_id": ingestion_id}
 
-    def from_text_to_kb(self, text, span_length=128, verbose=False):
-        # tokenize whole text
-        inputs = self.tokenizer([text], return_tensors="pt")
+    def ingest_pipelined(self, text: str, ingestion_id, progress=None, max_batch_tokens=1536, graph_name=None):
+        # Generate span micro-batches, merge them into the KB as they come and hand relations seen for
+        # the first time to a background writer, so Neo4j writes overlap with inference.
+        # The graph ends up with the same relations as the sequential path since writes MERGE on
+        # (head, type, tail); the sample is logged once the KB is complete so spans match too.
+        writer = kg_ingestor.RelationWriter(self.kg_ingestor, graph_name=graph_name)
+        writer.start()
+        kb = knowledge_base.IndexedKnowledgeBase()
+        try:
+            for spans_boundaries, tensor_ids, tensor_masks in self.iter_span_batches(text,
+                                                                                  max_batch_tokens=max_batch_tokens,
+                                                                                  progress=progress):
+                span_relations = self.generate_span_relations(tensor_ids, tensor_masks)
+                new_relations = []
+                with metrics.stage("kb_merge"):
+                    for span_boundary, relations in zip(spans_boundaries, span_relations):
+                        new_relations += self.add_span_relations(kb, relations, span_boundary)
+                writer.write(self.link_relations(new_relations))
+        except Exception:
+            # stop the writer without masking the error of the inference with its own
+            try:
+                writer.close()
+            except Exception as e:
+                logging.error(f"failed to close the relation writer of ingestion {ingestion_id} error: {e}")
+            raise
+        batch_counts = writer.close()
+        # names linked for the writes are in the linker's cache
+        relations = self.link_entities(kb).relations
+        self.stamp_entities(relations)
+        self.stamp_relation_types(relations)
+        self.mongo_logger.push_sample_relations(relations, ingestion_id=ingestion_id)
+        count = sum(counts["relations"] for counts in batch_counts if not counts.get("failed"))
+        self.mongo_logger.add_relations_written(ingestion_id, count)
+        return count
 
-        # compute span boundaries
-        num_tokens = len(inputs["input_ids"][0])
+    def start_fan_out(self, text, task_id, graph_name=None, spans_per_group=32, span_length=128):
+        """
+        First step of a fanned out document: starts its ingestion and splits it into groups of spans for
+        extract_span_group, each with the token ids it covers. Returns (ingestion id, groups)
+        """
+        ingestion_id = self.mongo_logger.start_ingestion(task_id, graph_name=graph_name)
+        try:
+            self.kg_ingestor.get_graph(graph_name)
+            groups = self.plan_span_groups(text, spans_per_group=spans_per_group, span_length=span_length)
+            self.mongo_logger.update_progress(task_id, spans_total=sum(len(g["boundaries"]) for g in groups))
+        except Exception:
+            self.fail_fan_out(task_id)
+            raise
+        return ingestion_id, groups
+
+    def plan_span_groups(self, text, spans_per_group=32, span_length=128):
+        # same token ids and span boundaries as from_text_to_kb
+        with metrics.stage("tokenize"):
+            input_ids = self.tokenize_long_text(text)
+        metrics.TOKENS.inc(len(input_ids))
+        spans_boundaries = self.compute_span_boundaries(len(input_ids), span_length)
+        groups = []
+        for start in range(0, len(spans_boundaries), spans_per_group):
+            boundaries = spans_boundaries[start:start + spans_per_group]
+            offset = boundaries[0][0]
+            groups.append({"offset": offset, "token_ids": input_ids[offset:boundaries[-1][1]].tolist(),
+                           "boundaries": boundaries})
+        return groups
+
+    def extract_span_group(self, span_group, task_id=None, max_batch_tokens=4096, span_length=128):
+        """
+        Relations of the partial KB of a group of spans planned by plan_span_groups, generated in micro-batches
+        of `max_batch_tokens` like iter_span_batches
+        """
+        input_ids = torch.tensor(span_group["token_ids"], dtype=torch.long)
+        offset = span_group["offset"]
+        boundaries = span_group["boundaries"]
+        spans_per_batch = max(1, max_batch_tokens // (span_length * self.gen_kwargs["num_beams"]))
+        kb = knowledge_base.IndexedKnowledgeBase()
+        for start in range(0, len(boundaries), spans_per_batch):
+            batch_boundaries = boundaries[start:start + spans_per_batch]
+            tensor_ids = [input_ids[boundary[0] - offset:boundary[1] - offset] for boundary in batch_boundaries]
+            tensor_masks = [torch.ones_like(ids) for ids in tensor_ids]
+            span_relations = self.generate_span_relations(tensor_ids, tensor_masks)
+            with metrics.stage("kb_merge"):
+                for span_boundary, relations in zip(batch_boundaries, span_relations):
+                    self.add_span_relations(kb, relations, span_boundary)
+            if task_id is not None:
+                try:
+                    self.mongo_logger.add_spans_done(task_id, len(batch_boundaries))
+                except Exception as e:
+                    logging.error(f"failed to log progress of task_id: {task_id} error: {e}")
+        return kb.relations
+
+    def finish_fan_out(self, group_relations, task_id, ingestion_id, graph_name=None, verbose=True):
+        """
+        Chord callback step: merges the partial KBs of the span groups, in document order, and ingests the result
+        under the ingestion id of the fanned out document. Failures are recorded by the chord's error callback
+        """
+        with metrics.stage("kb_merge"):
+            kb = knowledge_base.IndexedKnowledgeBase.from_relations(
+                [relation for relations in group_relations for relation in relations])
+        relations = self.link_entities(kb).relations
+        self.mongo_logger.push_sample_relations(relations, ingestion_id=ingestion_id)
+        count = self.ingest_kb_relations(relations, ingestion_id, graph_name=graph_name)
+        self.mongo_logger.finish_ingestion(task_id)
+        metrics.INGESTIONS.labels("DONE").inc()
         if verbose:
-            print(f"Input has {num_tokens} tokens")
-        num_spans = math.ceil(num_tokens / span_length)
+            print(f"{count} relationships have been ingested from {len(group_relations)} span groups")
+        return {"ingestion_id": ingestion_id}
+
+    def fail_fan_out(self, task_id):
+        self.mongo_logger.finish_ingestion(task_id, status="FAILED")
+        metrics.INGESTIONS.labels("FAILED").inc()
+
+    def process_batch(self, texts, batch_size=16, verbose=True, task_id=None, graph_names=None):
+        # Build one KB per document, packing the spans of all documents into shared generate batches,
+        # then log and ingest every KB under its own ingestion id, into the graph named for the document
+        task_id = task_id or str(uuid.uuid4())
+        graph_names = graph_names or [None] * len(texts)
+        ingestion_ids = [self.mongo_logger.start_ingestion(task_id, graph_name=graph_name)
+                         for graph_name in graph_names]
+        try:
+            for graph_name in set(graph_names):
+                self.kg_ingestor.get_graph(graph_name)
+            kbs = self.from_texts_to_kbs(texts, batch_size=batch_size,
+                                         progress=mongo_logger.SpanProgress(self.mongo_logger, task_id))
+            kbs = [self.link_entities(kb) for kb in kbs]
+            kbs_by_graph = {}
+            for graph_name, ingestion_id, kb in zip(graph_names, ingestion_ids, kbs):
+                kbs_by_graph.setdefault(graph_name, []).append((ingestion_id, kb))
+            count = self.ingest_graph_kbs(kbs_by_graph)
+        except Exception:
+            self.mongo_logger.finish_ingestion(task_id, status="FAILED")
+            metrics.INGESTIONS.labels("FAILED").inc(len(texts))
+            raise
+        self.mongo_logger.finish_ingestion(task_id)
+        metrics.INGESTIONS.labels("DONE").inc(len(texts))
         if verbose:
-            print(f"Input has {num_spans} spans")
+            print(f"{count} relationships have been ingested for {len(texts)} documents")
+
+        return {"ingestion_ids": ingestion_ids}
+
+    def ingest_graph_kbs(self, kbs_by_graph):
+        """
+        Log and ingest (ingestion id, KB) pairs keyed by graph name. Graphs are separate databases that
+        don't share locks, so each graph is written by its own thread, the KBs of a graph one after the
+        other. Returns the number of relations written
+        """
+        def ingest(graph_name, items):
+            count = 0
+            for ingestion_id, kb in items:
+                relations = kb.relations
+                self.mongo_logger.push_sample_relations(relations, ingestion_id=ingestion_id)
+                count += self.ingest_kb_relations(relations, ingestion_id, graph_name=graph_name)
+            return count
+
+        if len(kbs_by_graph) == 1:
+            return ingest(*next(iter(kbs_by_graph.items())))
+        with ThreadPoolExecutor(max_workers=min(len(kbs_by_graph), config.GRAPH_WRITE_THREADS)) as executor:
+            futures = [executor.submit(ingest, graph_name, items) for graph_name, items in kbs_by_graph.items()]
+            return sum(future.result() for future in futures)
+
+    def ingest_kb_relations(self, relations, ingestion_id=None, graph_name=None):
+        # returns the number of relations written
+        batch_counts = self.kg_ingestor.ingest_relations(relations, graph_name=graph_name)
+        self.stamp_entities(relations)
+        self.stamp_relation_types(relations)
+        count = sum(counts["relations"] for counts in batch_counts if not counts.get("failed"))
+        if ingestion_id is not None:
+            self.mongo_logger.add_relations_written(ingestion_id, count)
+        return count
+
+    def stamp_entities(self, relations):
+        # lets the flask app invalidate answers cached for these entities, which it indexes by normalised name
+        keys = {kg_ingestor.entity_key(name) for r in relations for name in (r['head'], r['tail'])}
+        keys.discard("")
+        try:
+            self.mongo_logger.stamp_entity_versions(keys)
+        except Exception as e:
+            logging.error(f"failed to stamp entity versions error: {e}")
+
+    def stamp_relation_types(self, relations):
+        # lets the flask app refresh the edge counts of its relation catalogue
+        try:
+            self.mongo_logger.stamp_relation_types([self.kg_ingestor.transform_relation(r['type']) for r in relations])
+        except Exception as e:
+            logging.error(f"failed to stamp relation types error: {e}")
+
+    def compute_span_boundaries(self, num_tokens, span_length=128):
+        num_spans = math.ceil(num_tokens / span_length)
         overlap = math.ceil((num_spans * span_length - num_tokens) /
                             max(num_spans - 1, 1))
         spans_boundaries = []
@@ -67,7 +307,21 @@ class RelationExtractionModel:
             spans_boundaries.append([start + span_length * i,
                                      start + span_length * (i + 1)])
             start -= overlap
+        return spans_boundaries
+
+    def tokenize_spans(self, text, span_length=128, verbose=False):
+        # tokenize whole text
+        with metrics.stage("tokenize"):
+            inputs = self.tokenizer([text], return_tensors="pt")
+
+        # compute span boundaries
+        num_tokens = len(inputs["input_ids"][0])
+        metrics.TOKENS.inc(num_tokens)
+        if verbose:
+            print(f"Input has {num_tokens} tokens")
+        spans_boundaries = self.compute_span_boundaries(num_tokens, span_length)
         if verbose:
+            print(f"Input has {len(spans_boundaries)} spans")
             print(f"Span boundaries are {spans_boundaries}")
 
         # transform input with spans
@@ -75,36 +329,252 @@ class RelationExtractionModel:
                       for boundary in spans_boundaries]
         tensor_masks = [inputs["attention_mask"][0][boundary[0]:boundary[1]]
                         for boundary in spans_boundaries]
-        inputs = {
-            "input_ids": torch.stack(tensor_ids),
-            "attention_mask": torch.stack(tensor_masks)
+        return spans_boundaries, tensor_ids, tensor_masks
+
+    def tokenize_long_text(self, text, chunk_chars=20000):
+        """
+        Tokenize `text` chunk by chunk into a single id tensor, without the per-token bookkeeping the
+        tokenizer keeps for a whole-text encoding. Chunks are cut right before a space that follows a
+        non-space character, which is where the byte-level pre-tokenizer splits anyway, so the ids are
+        the same as for self.tokenizer([text])
+        """
+        chunk_ids = [torch.tensor([self.tokenizer.bos_token_id])]
+        start = 0
+        while start < len(text):
+            end = min(start + chunk_chars, len(text))
+            while end < len(text) and not (text[end] == " " and not text[end - 1].isspace()):
+                end += 1
+            ids = self.tokenizer(text[start:end], add_special_tokens=False)["input_ids"]
+            chunk_ids.append(torch.tensor(ids, dtype=torch.long))
+            start = end
+        chunk_ids.append(torch.tensor([self.tokenizer.eos_token_id]))
+        return torch.cat(chunk_ids)
+
+    def iter_span_batches(self, text, span_length=128, max_batch_tokens=4096, verbose=False, progress=None):
+        """
+        Lazily yield (spans_boundaries, tensor_ids, tensor_masks) micro-batches of spans, with the same
+        boundaries as tokenize_spans. A batch holds as many spans as fit in `max_batch_tokens` counted
+        over all beams, so generate memory is bounded by the budget rather than the text length.
+        """
+        with metrics.stage("tokenize"):
+            input_ids = self.tokenize_long_text(text)
+        metrics.TOKENS.inc(len(input_ids))
+        spans_boundaries = self.compute_span_boundaries(len(input_ids), span_length)
+        if verbose:
+            print(f"Input has {len(input_ids)} tokens and {len(spans_boundaries)} spans")
+        spans_per_batch = max(1, max_batch_tokens // (span_length * self.gen_kwargs["num_beams"]))
+        for start in range(0, len(spans_boundaries), spans_per_batch):
+            batch_boundaries = spans_boundaries[start:start + spans_per_batch]
+            # slices are views on input_ids, only the stacked batch is materialised by generate
+            tensor_ids = [input_ids[boundary[0]:boundary[1]] for boundary in batch_boundaries]
+            tensor_masks = [torch.ones_like(ids) for ids in tensor_ids]
+            yield batch_boundaries, tensor_ids, tensor_masks
+            if progress is not None:
+                progress(start + len(batch_boundaries), len(spans_boundaries))
+
+    def stack_spans(self, tensor_ids, tensor_masks):
+        # right-pad spans of different lengths (e.g. short documents) so they can share a batch
+        max_length = max(len(ids) for ids in tensor_ids)
+        input_ids = torch.full((len(tensor_ids), max_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(tensor_ids), max_length), dtype=torch.long)
+        for i, (ids, mask) in enumerate(zip(tensor_ids, tensor_masks)):
+            input_ids[i, :len(ids)] = ids
+            attention_mask[i, :len(mask)] = mask
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask
         }
-        generated_tokens = self.model.generate(
-            **inputs,
-            **self.gen_kwargs,
-        )
+
+    def generate_span_relations(self, tensor_ids, tensor_masks, verbose=False):
+        """
+        Run the model over a batch of spans and return, for every span, the relations parsed from
+        all of its returned sequences (in generation order).
+        Spans found in the span cache are not sent to the model.
+        """
+        if self.span_cache is None:
+            return self.generate_uncached_span_relations(tensor_ids, tensor_masks, verbose=verbose)
+        model_id = f"{backends.MODEL_NAME}:{self.backend}"
+        keys = [self.span_cache.make_key(ids, self.gen_kwargs, model_id) for ids in tensor_ids]
+        with metrics.stage("span_cache_read"):
+            cached = self.span_cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        metrics.SPANS.labels("cache").inc(len(keys) - len(missing))
+        if verbose:
+            print(f"{len(keys) - len(missing)} of {len(keys)} spans found in the span cache")
+        if missing:
+            generated = self.generate_uncached_span_relations([tensor_ids[i] for i in missing],
+                                                              [tensor_masks[i] for i in missing], verbose=verbose)
+            new_entries = {keys[i]: relations for i, relations in zip(missing, generated)}
+            with metrics.stage("span_cache_write"):
+                self.span_cache.put_many(new_entries.items())
+            cached.update(new_entries)
+        # copies, since the caller attaches span metadata to the relations
+        return [[dict(relation) for relation in cached[key]] for key in keys]
+
+    def generate_uncached_span_relations(self, tensor_ids, tensor_masks, verbose=False):
+        with metrics.stage("generate"):
+            generated_tokens = self.model.generate(
+                **self.stack_spans(tensor_ids, tensor_masks),
+                **self.gen_kwargs,
+            )
+        metrics.SPANS.labels("model").inc(len(tensor_ids))
 
         # decode relations
-        decoded_preds = self.tokenizer.batch_decode(generated_tokens,
-                                                    skip_special_tokens=False)
+        with metrics.stage("parse"):
+            sequence_relations = self.extract_relations_from_token_ids(generated_tokens)
+        metrics.RELATIONS_EXTRACTED.inc(sum(len(relations) for relations in sequence_relations))
         if verbose:
-            print(f"Decoded outputs length {len(decoded_preds)}")
+            print(f"Decoded outputs length {len(sequence_relations)}")
 
-        # create kb
-        kb = knowledge_base.KnowledgeBase()
-        i = 0
-        for sentence_pred in decoded_preds:
+        span_relations = [[] for _ in tensor_ids]
+        for i, relations in enumerate(sequence_relations):
             current_span_index = i // self.gen_kwargs["num_return_sequences"]
-            relations = self.extract_relations_from_model_output(sentence_pred)
-            for relation in relations:
-                relation["meta"] = {
-                    "spans": [spans_boundaries[current_span_index]]
-                }
-                kb.add_relation(relation)
-            i += 1
+            span_relations[current_span_index] += relations
+        return span_relations
+
+    @staticmethod
+    def add_span_relations(kb, relations, span_boundary):
+        # returns the relations that were not yet in the KB
+        new_relations = []
+        for relation in relations:
+            relation["meta"] = {
+                "spans": [span_boundary]
+            }
+            if not kb.exists_relation(relation):
+                new_relations.append(relation)
+            kb.add_relation(relation)
+        return new_relations
+
+    def from_text_to_kb(self, text, span_length=128, verbose=False, progress=None):
+        spans_boundaries, tensor_ids, tensor_masks = self.tokenize_spans(text, span_length, verbose=verbose)
+        span_relations = self.generate_span_relations(tensor_ids, tensor_masks, verbose=verbose)
+        if progress is not None:
+            progress(len(spans_boundaries), len(spans_boundaries))
+
+        # create kb
+        kb = knowledge_base.IndexedKnowledgeBase()
+        with metrics.stage("kb_merge"):
+            for span_boundary, relations in zip(spans_boundaries, span_relations):
+                self.add_span_relations(kb, relations, span_boundary)
+
+        return kb
+
+    def from_long_text_to_kb(self, text, span_length=128, max_batch_tokens=4096, verbose=False, progress=None):
+        """
+        Memory-bounded counterpart of from_text_to_kb for book-length inputs: spans are streamed
+        in micro-batches under a token budget instead of being generated all at once
+        """
+        kb = knowledge_base.IndexedKnowledgeBase()
+        for spans_boundaries, tensor_ids, tensor_masks in self.iter_span_batches(text, span_length, max_batch_tokens,
+                                                                              verbose=verbose, progress=progress):
+            span_relations = self.generate_span_relations(tensor_ids, tensor_masks, verbose=verbose)
+            with metrics.stage("kb_merge"):
+                for span_boundary, relations in zip(spans_boundaries, span_relations):
+                    self.add_span_relations(kb, relations, span_boundary)
 
         return kb
 
+    def from_texts_to_kbs(self, texts, span_length=128, batch_size=16, verbose=False, progress=None):
+        """
+        Batched counterpart of from_text_to_kb: spans of all texts are packed into generate calls of
+        `batch_size` spans, and the decoded relations are routed back to one KB per text.
+        """
+        spans = []
+        for doc_index, text in enumerate(texts):
+            spans_boundaries, tensor_ids, tensor_masks = self.tokenize_spans(text, span_length, verbose=verbose)
+            spans += [(doc_index, boundary, ids, mask)
+                      for boundary, ids, mask in zip(spans_boundaries, tensor_ids, tensor_masks)]
+        if verbose:
+            print(f"Packing {len(spans)} spans from {len(texts)} documents in batches of {batch_size}")
+
+        kbs = [knowledge_base.IndexedKnowledgeBase() for _ in texts]
+        for start in range(0, len(spans), batch_size):
+            batch = spans[start:start + batch_size]
+            span_relations = self.generate_span_relations([span[2] for span in batch], [span[3] for span in batch],
+                                                          verbose=verbose)
+            with metrics.stage("kb_merge"):
+                for (doc_index, span_boundary, _, _), relations in zip(batch, span_relations):
+                    self.add_span_relations(kbs[doc_index], relations, span_boundary)
+            if progress is not None:
+                progress(start + len(batch), len(spans))
+
+        return kbs
+
+    def extract_relations_from_token_ids(self, generated_tokens):
+        """
+        Token-id counterpart of extract_relations_from_model_output for a batch of generated sequences.
+        Sequences are split on the <triplet>/<subj>/<obj> ids, only the text runs between markers are
+        decoded (in a single batch_decode over all sequences) and the same state machine is applied.
+        Returns the relations of every sequence.
+        """
+        sequences_events = []
+        runs = []
+        for sequence in generated_tokens.tolist():
+            events = []
+            run = []
+            for token_id in sequence:
+                if token_id in self.marker_token_ids:
+                    if run:
+                        events.append(len(runs))
+                        runs.append(run)
+                        run = []
+                    events.append(self.marker_token_ids[token_id])
+                elif token_id not in self.skipped_token_ids:
+                    run.append(token_id)
+            if run:
+                events.append(len(runs))
+                runs.append(run)
+            sequences_events.append(events)
+        decoded_runs = self.tokenizer.batch_decode(runs, skip_special_tokens=False) if runs else []
+
+        sequences_relations = []
+        for events in sequences_events:
+            relations = []
+            relation, subject, object_ = '', '', ''
+            current = 'x'
+            for event in events:
+                if event == "<triplet>":
+                    current = 't'
+                    if relation != '':
+                        relations.append({
+                            'head': subject.strip(),
+                            'type': relation.strip(),
+                            'tail': object_.strip()
+                        })
+                        relation = ''
+                    subject = ''
+                elif event == "<subj>":
+                    current = 's'
+                    if relation != '':
+                        relations.append({
+                            'head': subject.strip(),
+                            'type': relation.strip(),
+                            'tail': object_.strip()
+                        })
+                    object_ = ''
+                elif event == "<obj>":
+                    current = 'o'
+                    relation = ''
+                else:
+                    words = decoded_runs[event].split()
+                    if not words:
+                        continue
+                    text = ' ' + ' '.join(words)
+                    if current == 't':
+                        subject += text
+                    elif current == 's':
+                        object_ += text
+                    elif current == 'o':
+                        relation += text
+            if subject != '' and relation != '' and object_ != '':
+                relations.append({
+                    'head': subject.strip(),
+                    'type': relation.strip(),
+                    'tail': object_.strip()
+                })
+            sequences_relations.append(relations)
+        return sequences_relations
+
     @staticmethod
     def extract_relations_from_model_output(text):
         relations = []
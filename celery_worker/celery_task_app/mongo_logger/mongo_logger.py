@@ -1,21 +1,131 @@
 import logging
 import pymongo
+import time
 import uuid
 
+from ..metrics import metrics
+
+MONGO_URL = "mongodb://mongodb_container:27017/"
+DATABASE = "ingestion_db"
+COLLECTION = "ingestion_logs"
+
 
 class MongoLogger:
     def __init__(self, url, database, collection):
         self.client = pymongo.MongoClient(url)
         self.db = self.client[database]
         self.collection = self.db[collection]
+        self.collection.create_index("task_id")
+        self.collection.create_index("ingestion_id")
+        self.db["entity_versions"].create_index("seq")
+        self.db["relation_versions"].create_index("seq")
 
-    def push_sample_relations(self, relations):
+    @metrics.timed("mongo_log")
+    def start_ingestion(self, task_id, graph_name=None):
+        """
+        Create the log document of an ingestion, the flask app serves its status and progress by task_id
+        """
         ingestion_id = str(uuid.uuid4())
-        if len(relations) > 10:
-            relations = relations[:10]
         data = {"ingestion_id": ingestion_id,
-                "relations": relations}
+                "task_id": task_id,
+                "graph_name": graph_name,
+                "status": "IN_PROGRESS",
+                "progress": {"spans_done": 0, "spans_total": 0, "relations_written": 0},
+                "relations": []}
         self.collection.insert_one(data)
+        logging.info(f"Ingestion {ingestion_id} started for task_id: {task_id}")
+        return ingestion_id
+
+    @metrics.timed("mongo_log")
+    def update_progress(self, task_id, **progress):
+        self.collection.update_many({"task_id": task_id},
+                                    {"$set": {f"progress.{key}": value for key, value in progress.items()}})
+
+    @metrics.timed("mongo_log")
+    def add_spans_done(self, task_id, count):
+        # progress of the subtasks of a fanned out document, which finish in any order
+        self.collection.update_many({"task_id": task_id}, {"$inc": {"progress.spans_done": count}})
+
+    @metrics.timed("mongo_log")
+    def add_relations_written(self, ingestion_id, count):
+        self.collection.update_one({"ingestion_id": ingestion_id}, {"$inc": {"progress.relations_written": count}})
+
+    @metrics.timed("mongo_log")
+    def finish_ingestion(self, task_id, status="DONE"):
+        self.collection.update_many({"task_id": task_id}, {"$set": {"status": status}})
+        logging.info(f"Ingestion for task_id: {task_id} finished with status {status}")
+
+    @metrics.timed("mongo_log")
+    def fail_task(self, task_id):
+        """
+        Sets the status of every ingestion of the task to FAILED, creating a status document when the task failed
+        before logging any. Returns False when the status was already FAILED
+        """
+        op = self.collection.update_many({"task_id": task_id}, {"$set": {"status": "FAILED"}}, upsert=True)
+        logging.info(f"task_id: {task_id} failed")
+        return op.modified_count > 0 or op.upserted_id is not None
+
+    @metrics.timed("mongo_log")
+    def push_sample_relations(self, relations, ingestion_id=None):
+        if len(relations) > 10:
+            relations = relations[:10]
+        if ingestion_id is not None:
+            self.collection.update_one({"ingestion_id": ingestion_id}, {"$set": {"relations": relations}})
+        else:
+            ingestion_id = str(uuid.uuid4())
+            data = {"ingestion_id": ingestion_id,
+                    "relations": relations}
+            self.collection.insert_one(data)
         logging.info(f"Sample data logged for ingestion_id: {ingestion_id}")
         return ingestion_id
 
+    @metrics.timed("mongo_stamp_entities")
+    def stamp_entity_versions(self, entities, collection="entity_versions"):
+        """
+        Stamp the entities with a new graph version so that caches built on them get invalidated
+        """
+        entities = set(entities)
+        seq = self.stamp_versions(entities, collection)
+        if seq is not None:
+            logging.info(f"{len(entities)} entities stamped with graph version {seq}")
+        return seq
+
+    @metrics.timed("mongo_stamp_relation_types")
+    def stamp_relation_types(self, relation_types, collection="relation_versions"):
+        """
+        Stamp the relationship types written to the graph so that the flask app re-counts their edges
+        """
+        return self.stamp_versions(relation_types, collection)
+
+    def stamp_versions(self, keys, collection):
+        keys = set(keys)
+        if len(keys) == 0:
+            return None
+        versions = self.db[collection]
+        seq = versions.find_one_and_update({"_id": "__graph__"}, {"$inc": {"seq": 1}}, upsert=True,
+                                           return_document=pymongo.ReturnDocument.AFTER)["seq"]
+        versions.bulk_write([pymongo.UpdateOne({"_id": key}, {"$set": {"seq": seq}}, upsert=True)
+                             for key in keys], ordered=False)
+        return seq
+
+
+class SpanProgress:
+    """
+    Progress callback recording the spans processed by a task, writing at most once per `min_interval`
+    seconds except for the final update
+    """
+    def __init__(self, mongo_logger, task_id, min_interval=1.0):
+        self.mongo_logger = mongo_logger
+        self.task_id = task_id
+        self.min_interval = min_interval
+        self.last_write = 0
+
+    def __call__(self, spans_done, spans_total):
+        now = time.monotonic()
+        if spans_done < spans_total and now - self.last_write < self.min_interval:
+            return
+        self.last_write = now
+        try:
+            self.mongo_logger.update_progress(self.task_id, spans_done=spans_done, spans_total=spans_total)
+        except Exception as e:
+            logging.error(f"failed to log progress of task_id: {self.task_id} error: {e}")
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+
+class SpanCache:
+    """
+    Persistent memo of the relations decoded for a span, keyed by a hash of the span's token ids,
+    the generation kwargs and the model id. Backed by a local SQLite file shared by the worker processes,
+    bounded to `max_entries` with least recently used eviction.
+    """
+    def __init__(self, path, max_entries=100000):
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS spans "
+                                "(key TEXT PRIMARY KEY, relations TEXT NOT NULL, last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS spans_last_used ON spans (last_used)")
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+        logging.info(f"span cache opened at {path}")
+
+    @staticmethod
+    def make_key(token_ids, gen_kwargs, model_id):
+        digest = hashlib.sha256()
+        digest.update(model_id.encode('utf-8'))
+        digest.update(json.dumps(gen_kwargs, sort_keys=True).encode('utf-8'))
+        digest.update(token_ids.numpy().astype('int64').tobytes())
+        return digest.hexdigest()
+
+    def get_many(self, keys):
+        """
+        Returns a dict of key -> span relations for the keys found in the cache
+        """
+        found = {}
+        unique_keys = list(set(keys))
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(f"SELECT key, relations FROM spans WHERE key IN ({placeholders})", chunk)
+            found.update((key, json.loads(relations)) for key, relations in rows)
+        if found:
+            now = time.time()
+            self.connection.executemany("UPDATE spans SET last_used = ? WHERE key = ?",
+                                        [(now, key) for key in found])
+            self.connection.commit()
+        hits = sum(1 for key in keys if key in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, items):
+        now = time.time()
+        self.connection.executemany("INSERT OR REPLACE INTO spans (key, relations, last_used) VALUES (?, ?, ?)",
+                                    [(key, json.dumps(relations), now) for key, relations in items])
+        self.connection.commit()
+        self.evict()
+
+    def evict(self):
+        size = self.connection.execute("SELECT COUNT(*) FROM spans").fetchone()[0]
+        if size <= self.max_entries:
+            return
+        # evict down to 90% of the bound so that eviction doesn't run on every insert
+        to_evict = size - int(self.max_entries * 0.9)
+        self.connection.execute("DELETE FROM spans WHERE key IN "
+                                "(SELECT key FROM spans ORDER BY last_used LIMIT ?)", (to_evict,))
+        self.connection.commit()
+        logging.info(f"evicted {to_evict} entries from the span cache")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0}
@@ -1,7 +1,10 @@
 import importlib
 import logging
 from abc import ABC
-from celery import Task
+from celery import Task, chord, group
+from . import config
+from .metrics import metrics
+from .mongo_logger import mongo_logger
 from .worker import app
 
 
@@ -10,6 +13,12 @@ class IngestionTask(Task, ABC):
     Abstraction of Celery's Task class to support loading ML model.
     """
     abstract = True
+    # models shared by every task of the worker process, keyed by path
+    models = {}
+    # tasks whose status the flask app serves by their task id
+    reports_status = False
+    # logs failures when the model couldn't be loaded, created on first use
+    failure_logger = None
 
     def __init__(self):
         super().__init__()
@@ -21,25 +30,153 @@ class IngestionTask(Task, ABC):
         Avoids the need to load model on each task request
         """
         if not self.model:
+            self.model = self.load_model(self.path)
+        return self.run(*args, **kwargs)
+
+    @classmethod
+    def load_model(cls, path, connect_backends=True):
+        """
+        Load the model behind `path` once per process so that tasks sharing a path share the model
+        """
+        if path not in cls.models:
             logging.info('Loading Model...')
-            module_import = importlib.import_module(self.path[0])
+            module_import = importlib.import_module(path[0])
             logging.info('module_import: {}'.format(module_import))
-            logging.info('self path[0]: {} path[1]: {}'.format(self.path[0], self.path[1]))
-            model_obj = getattr(module_import, self.path[1])
-            self.model = model_obj()
+            logging.info('self path[0]: {} path[1]: {}'.format(path[0], path[1]))
+            model_obj = getattr(module_import, path[1])
+            cls.models[path] = model_obj(connect_backends=connect_backends)
             logging.info('Model loaded')
-        return self.run(*args, **kwargs)
+        model = cls.models[path]
+        if connect_backends and not model.backends_connected:
+            # model preloaded by the parent process, database connections are opened by each child
+            model.connect_backends()
+        return model
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        """
+        Records FAILED for the task, including failures before its ingestion was logged (e.g. the model failing
+        to load), which would otherwise be reported as IN_PROGRESS forever
+        """
+        if not self.reports_status:
+            return
+        try:
+            if self.model is not None and self.model.backends_connected:
+                logger = self.model.mongo_logger
+            else:
+                if IngestionTask.failure_logger is None:
+                    IngestionTask.failure_logger = mongo_logger.MongoLogger(mongo_logger.MONGO_URL,
+                                                                            mongo_logger.DATABASE,
+                                                                            mongo_logger.COLLECTION)
+                logger = IngestionTask.failure_logger
+            if logger.fail_task(task_id):
+                metrics.INGESTIONS.labels("FAILED").inc()
+        except Exception as e:
+            logging.error(f"failed to record the failure of task_id: {task_id} error: {e}")
+
+    @classmethod
+    def preload_models(cls):
+        """
+        Load the models of every registered ingestion task without opening database connections,
+        meant to run in the parent worker process before it forks
+        """
+        for task in app.tasks.values():
+            if isinstance(task, IngestionTask):
+                cls.load_model(task.path, connect_backends=False)
 
 
 @app.task(ignore_result=False,
           bind=True,
           base=IngestionTask,
           path=('celery_task_app.ml_model.re_model', 'RelationExtractionModel'),
+          reports_status=True,
           name='{}.{}'.format(__name__, 'RelationExtraction'))
 def ingest_relations(self, *args):
     """
     Essentially the run method of IngestionTask
     """
     json_data = args[0]
-    output = self.model.process_data(json_data['data'])
+    output = self.model.process_data(json_data['data'],
+                                     pipelined=json_data.get('pipelined', False),
+                                     long_document=json_data.get('long_document', False),
+                                     max_batch_tokens=json_data.get('max_batch_tokens', 4096),
+                                     task_id=self.request.id,
+                                     graph_name=json_data.get('graph_name'))
     return output
+
+
+@app.task(ignore_result=False,
+          bind=True,
+          base=IngestionTask,
+          path=('celery_task_app.ml_model.re_model', 'RelationExtractionModel'),
+          reports_status=True,
+          name='{}.{}'.format(__name__, 'RelationExtractionBatch'))
+def ingest_relations_batch(self, *args):
+    """
+    Batched run method: extracts relations from many documents, packing their spans together
+    """
+    json_data = args[0]
+    # one graph for every document, or one graph per document
+    graph_names = json_data.get('graph_names') or [json_data.get('graph_name')] * len(json_data['documents'])
+    output = self.model.process_batch(json_data['documents'], batch_size=json_data.get('batch_size', 16),
+                                      task_id=self.request.id, graph_names=graph_names)
+    return output
+
+
+@app.task(ignore_result=False,
+          bind=True,
+          base=IngestionTask,
+          path=('celery_task_app.ml_model.re_model', 'RelationExtractionModel'),
+          reports_status=True,
+          name='{}.{}'.format(__name__, 'RelationExtractionFanOut'))
+def ingest_relations_fan_out(self, *args):
+    """
+    Coordinator of a large document: splits it into groups of spans that RelationExtractionSpanGroup subtasks
+    extract on any worker, then the RelationExtractionMerge chord callback merges and ingests their relations
+    under one ingestion id. Returns without waiting, the status is reported under this task's id
+    """
+    json_data = args[0]
+    task_id = self.request.id
+    graph_name = json_data.get('graph_name')
+    ingestion_id, span_groups = self.model.start_fan_out(
+        json_data['data'], task_id, graph_name=graph_name,
+        spans_per_group=json_data.get('spans_per_group', config.FAN_OUT_SPANS_PER_GROUP))
+    options = {"task_id": task_id, "ingestion_id": ingestion_id, "graph_name": graph_name,
+               "max_batch_tokens": json_data.get('max_batch_tokens', 4096)}
+    header = group(extract_span_group.s(span_group, options) for span_group in span_groups)
+    chord(header)(merge_span_groups.s(options).on_error(fan_out_failed.s(task_id)))
+    return {"ingestion_id": ingestion_id, "span_groups": len(span_groups)}
+
+
+@app.task(ignore_result=False,
+          bind=True,
+          base=IngestionTask,
+          path=('celery_task_app.ml_model.re_model', 'RelationExtractionModel'),
+          name='{}.{}'.format(__name__, 'RelationExtractionSpanGroup'))
+def extract_span_group(self, span_group, options):
+    return self.model.extract_span_group(span_group, task_id=options['task_id'],
+                                         max_batch_tokens=options['max_batch_tokens'])
+
+
+@app.task(ignore_result=False,
+          bind=True,
+          base=IngestionTask,
+          path=('celery_task_app.ml_model.re_model', 'RelationExtractionModel'),
+          name='{}.{}'.format(__name__, 'RelationExtractionMerge'))
+def merge_span_groups(self, group_relations, options):
+    """
+    Chord callback, `group_relations` holds the relations of every span group in document order
+    """
+    return self.model.finish_fan_out(group_relations, options['task_id'], options['ingestion_id'],
+                                     graph_name=options['graph_name'])
+
+
+@app.task(bind=True,
+          base=IngestionTask,
+          path=('celery_task_app.ml_model.re_model', 'RelationExtractionModel'),
+          name='{}.{}'.format(__name__, 'RelationExtractionFanOutFailed'))
+def fan_out_failed(self, failed_task_id, task_id):
+    """
+    Error callback of the chord, called with the id of the failed task when a span group or the merge fails
+    """
+    logging.error(f"task {failed_task_id} of the fanned out task_id: {task_id} failed")
+    self.model.fail_fan_out(task_id)
@@ -0,0 +1,193 @@
+import threading
+import time
+from collections import OrderedDict
+
+from kg_explorer.kg_explorer import entity_key
+from version_poller.version_poller import VersionPoller
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread safe LRU cache whose entries also expire `ttl` seconds after being stored. `on_evict(key, value)` is
+    called outside the cache's lock for every entry removed: evicted, expired, replaced, invalidated or cleared
+    """
+    def __init__(self, max_size=10000, ttl=300, on_evict=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def evicted(self, removed):
+        if self.on_evict is not None:
+            for key, (value, _) in removed:
+                self.on_evict(key, value)
+
+    def get(self, key):
+        removed = []
+        with self.lock:
+            entry = self.entries.get(key, MISSING)
+            if entry is not MISSING and entry[1] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not MISSING:
+                removed.append((key, self.entries.pop(key)))
+            self.misses += 1
+        self.evicted(removed)
+        return MISSING
+
+    def put(self, key, value):
+        removed = []
+        with self.lock:
+            previous = self.entries.pop(key, MISSING)
+            if previous is not MISSING:
+                removed.append((key, previous))
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            while len(self.entries) > self.max_size:
+                removed.append(self.entries.popitem(last=False))
+        self.evicted(removed)
+
+    def invalidate(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, MISSING)
+        if entry is not MISSING:
+            self.evicted([(key, entry)])
+
+    def clear(self):
+        with self.lock:
+            removed = list(self.entries.items())
+            self.entries.clear()
+        self.evicted(removed)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+
+class AnswerCache:
+    """
+    Caches answers by (graph name, normalised question) and (graph name, entity, relation) -> tail lookups.
+    The celery worker stamps the normalised name (entity_key) of every entity it ingests relations for with an
+    increasing sequence number in the `versions` collection; entries depending on an entity stamped since the
+    last poll are invalidated. Entries are indexed by the normalised names of their entities too, so "the Barack
+    Obama?" in a question depends on the stamp of "Barack Obama".
+    The collection is polled every `poll_interval` seconds in a background thread (see VersionPoller), so that
+    reads never wait on Mongo and are safe to call from an event loop.
+    The entity -> keys maps only hold the keys still in the caches: entries leaving them for any reason are
+    removed from the maps.
+    """
+    def __init__(self, versions, max_questions=10000, max_lookups=50000, ttl=300, poll_interval=5,
+                 seq_overlap=50, poll_in_background=True):
+        self.questions = TTLCache(max_questions, ttl, on_evict=self.question_evicted)
+        self.lookups = TTLCache(max_lookups, ttl, on_evict=self.lookup_evicted)
+        # reentrant: the caches' eviction callbacks run while put_* and invalidate_entity hold it
+        self.lock = threading.RLock()
+        self.questions_by_entity = {}
+        self.lookups_by_entity = {}
+        self.latency = {"hit": [0, 0.0], "miss": [0, 0.0]}
+        self.poller = VersionPoller(versions, self.invalidate_entities, poll_interval=poll_interval,
+                                    seq_overlap=seq_overlap, description="entity")
+        if poll_in_background:
+            self.poller.start(name="answer-cache-poller")
+
+    @staticmethod
+    def normalise_question(question: str):
+        return " ".join(question.split())
+
+    def close(self):
+        self.poller.close()
+
+    def refresh(self):
+        self.poller.poll()
+
+    def clear_questions(self):
+        """
+        Drops every cached answer, e.g. when a new template may answer questions differently. The lookups only
+        depend on the graph and are kept
+        """
+        self.questions.clear()
+
+    def invalidate_entities(self, entities):
+        for entity in entities:
+            self.invalidate_entity(entity)
+        return entities
+
+    @staticmethod
+    def forget(keys_by_entity, entity, key):
+        keys = keys_by_entity.get(entity)
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del keys_by_entity[entity]
+
+    def question_evicted(self, key, value):
+        with self.lock:
+            for entity in value[1]:
+                self.forget(self.questions_by_entity, entity, key)
+
+    def lookup_evicted(self, key, value):
+        with self.lock:
+            for entity in value[2]:
+                self.forget(self.lookups_by_entity, entity, key)
+
+    def invalidate_entity(self, entity):
+        entity = entity_key(entity)
+        with self.lock:
+            for key in list(self.questions_by_entity.get(entity, ())):
+                self.questions.invalidate(key)
+            for key in list(self.lookups_by_entity.get(entity, ())):
+                self.lookups.invalidate(key)
+
+    def get_answer(self, question: str, graph_name=None):
+        value = self.questions.get((graph_name, self.normalise_question(question)))
+        return value if value is MISSING else value[0]
+
+    def put_answer(self, question: str, answer, entities, graph_name=None):
+        # entity stamps aren't per graph, a stamp invalidates the entity's entries of every graph
+        key = (graph_name, self.normalise_question(question))
+        entities = tuple({entity_key(entity) for entity in entities})
+        with self.lock:
+            # the entry is stored with its entities so that they are known when it leaves the cache
+            self.questions.put(key, (answer, entities))
+            for entity in entities:
+                self.questions_by_entity.setdefault(entity, set()).add(key)
+
+    def get_lookup(self, entity, relation, graph_name=None):
+        """
+        (tail, resolved) stored by put_lookup, MISSING when not cached
+        """
+        value = self.lookups.get((graph_name, entity_key(entity), relation))
+        return value if value is MISSING else value[:2]
+
+    def put_lookup(self, entity, relation, tail, graph_name=None, resolved=None):
+        """
+        `resolved` is the entity name the tail was found under when it isn't `entity` (e.g. a fuzzy match), its
+        stamps invalidate the entry as well
+        """
+        key = (graph_name, entity_key(entity), relation)
+        entities = tuple({entity_key(name) for name in (entity, resolved) if name is not None})
+        with self.lock:
+            self.lookups.put(key, (tail, resolved, entities))
+            for name in entities:
+                self.lookups_by_entity.setdefault(name, set()).add(key)
+
+    def record_latency(self, hit, seconds):
+        latency = self.latency["hit" if hit else "miss"]
+        latency[0] += 1
+        latency[1] += seconds
+
+    def stats(self):
+        return {
+            "questions": self.questions.stats(),
+            "lookups": self.lookups.stats(),
+            "entities": {"questions": len(self.questions_by_entity), "lookups": len(self.lookups_by_entity)},
+            "latency_ms": {path: (total / count * 1000 if count else 0.0)
+                           for path, (count, total) in self.latency.items()},
+            "graph_version": self.poller.last_seq,
+        }
@@ -0,0 +1,164 @@
+"""
+Async serving path for the read endpoints (/search_template, /search_template_batch, /get_template,
+/get_sample_relations, /get_relation_list). Serve with an ASGI server, e.g.
+    hypercorn async_app:app --bind 0.0.0.0:8082
+Writes (/add_template, /extract_relations, ...) stay with the Flask app.
+"""
+import asyncio
+import json
+import logging
+import sys
+
+from quart import Quart, request, Response
+from quart_cors import cors
+
+import helper
+from answer_cache import answer_cache
+from kg_explorer import async_kg_explorer, kg_explorer
+from mongo_extractor import async_mongo_extractor, mongo_extractor
+from relation_catalogue import relation_catalogue
+from template_explorer import async_template_explorer
+
+logging.basicConfig(level=logging.INFO)
+root = logging.getLogger()
+handler = logging.StreamHandler(sys.stdout)
+root.addHandler(handler)
+app = cors(Quart(__name__), allow_origin="*")
+scheme = "neo4j"  # Connecting to Aura, use the "neo4j+s" URI scheme
+host_name = "neo4j_container"
+port = 7687
+url = "{scheme}://{host_name}:{port}".format(scheme=scheme, host_name=host_name, port=port)
+user = "neo4j"
+password = "test"
+mongo_url = "mongodb://mongodb_container:27017/"
+# clients are shared by every request of the process, each one pools its connections
+backends = helper.LazyBackends()
+backends.register("kg_explorer", lambda: async_kg_explorer.AsyncKGExplorer(url, user, password))
+backends.register("mongo_app", lambda: async_mongo_extractor.AsyncMongoExtractor(mongo_url, "ingestion_db",
+                                                                                 "ingestion_logs"))
+# the answer cache and the relation catalogue use the synchronous clients: they are created in a thread of the
+# default executor (see sync_backend) and poll their versions in background threads, off the event loop
+backends.register("mongo_versions",
+                  lambda: mongo_extractor.MongoExtractor(mongo_url, "ingestion_db", "ingestion_logs").db)
+backends.register("answer_cache", lambda: answer_cache.AnswerCache(backends.mongo_versions["entity_versions"]))
+backends.register("relation_catalogue", lambda: relation_catalogue.RelationCatalogue(
+    kg_explorer.KGExplorer(url, user, password), backends.mongo_versions["relation_versions"],
+    poll_in_background=True))
+SYNC_BACKENDS = ["mongo_versions", "answer_cache", "relation_catalogue"]
+backends.register("template_explorer",
+                  lambda: async_template_explorer.AsyncTemplateExplorer(backends.kg_explorer,
+                                                                        "http://elastic_container:9200",
+                                                                        answer_cache=backends.answer_cache))
+
+
+async def sync_backend(name):
+    """
+    Backend created by a blocking factory, created in the default executor when it isn't ready
+    """
+    if backends.is_ready(name):
+        return getattr(backends, name)
+    return await asyncio.get_running_loop().run_in_executor(None, getattr, backends, name)
+
+
+async def get_template_explorer():
+    # the template explorer's factory reads the answer cache
+    await sync_backend("answer_cache")
+    return backends.template_explorer
+
+
+@app.before_serving
+async def create_sync_backends():
+    await asyncio.get_running_loop().run_in_executor(None, backends.initialise, SYNC_BACKENDS)
+
+
+@app.after_serving
+async def close_backends():
+    for name in ["kg_explorer", "template_explorer"]:
+        if backends.is_ready(name):
+            await getattr(backends, name).close()
+    for name in ["answer_cache", "relation_catalogue"]:
+        if backends.is_ready(name):
+            getattr(backends, name).close()
+
+
+@app.route('/')
+async def health_check():
+    return "Hello from KG app"
+
+
+@app.route('/ready')
+async def readiness_check():
+    errors = await asyncio.get_running_loop().run_in_executor(None, backends.initialise, SYNC_BACKENDS)
+    errors.update(backends.initialise([name for name in backends.factories if name not in SYNC_BACKENDS]))
+    if errors.get("kg_explorer") is None:
+        try:
+            await backends.kg_explorer.verify_connectivity()
+        except Exception as e:
+            errors["kg_explorer"] = str(e)
+    ready = all(error is None for error in errors.values())
+    resp = {"ready": ready, "backends": {name: error or "ready" for name, error in errors.items()}}
+    return Response(json.dumps(resp), status=200 if ready else 503, mimetype='application/json')
+
+
+@app.route('/get_sample_relations')
+async def get_sample_relations():
+    task_id = request.args.get("task_id")
+    if task_id is None:
+        return Response(json.dumps({'message': 'task id not present in the input'}), status=400,
+                        mimetype='application/json')
+    output = await backends.mongo_app.get_sample_relations(task_id=task_id)
+    if 'task_id' not in output:
+        return Response(json.dumps({'message': 'no such task found'}), status=400, mimetype='application/json')
+    return Response(json.dumps(output['relations']), status=200, mimetype='application/json')
+
+
+@app.route('/search_template', methods=["POST"])
+async def search_template():
+    data = await request.get_json(force=True)
+    try:
+        graph_name = kg_explorer.normalise_graph_name(data.get('graph_name'))
+    except ValueError as e:
+        return Response(json.dumps({'message': str(e)}), status=400, mimetype='application/json')
+    try:
+        explorer = await get_template_explorer()
+        answer = await explorer.search_template(query=data['question'], graph_name=graph_name)
+    except Exception as e:
+        logging.error(f"{e}")
+        return Response(json.dumps("sorry I am not sure about that"), status=200, mimetype='application/json')
+    return Response(json.dumps(answer['answer']), status=200, mimetype='application/json')
+
+
+@app.route('/search_template_batch', methods=["POST"])
+async def search_template_batch():
+    data = await request.get_json(force=True)
+    if 'questions' not in data:
+        return Response(json.dumps({'message': 'questions not found in request'}), status=400,
+                        mimetype='application/json')
+    try:
+        graph_name = kg_explorer.normalise_graph_name(data.get('graph_name'))
+    except ValueError as e:
+        return Response(json.dumps({'message': str(e)}), status=400, mimetype='application/json')
+    try:
+        explorer = await get_template_explorer()
+        answers = await explorer.search_templates(data['questions'], graph_name=graph_name)
+    except Exception as e:
+        logging.error(f"{e}")
+        return Response(json.dumps(["sorry I am not sure about that"] * len(data['questions'])), status=200,
+                        mimetype='application/json')
+    return Response(json.dumps([answer['answer'] for answer in answers]), status=200, mimetype='application/json')
+
+
+@app.route('/get_relation_list')
+async def get_relation_list():
+    # the catalogue is refreshed by its poller thread, serving it never waits on Mongo or Neo4j
+    catalogue = await sync_backend("relation_catalogue")
+    return helper.conditional_json_response(request, catalogue.etag(), catalogue.get_relation_list,
+                                            response_class=Response)
+
+
+@app.route('/get_template')
+async def get_templates():
+    relation = request.args.get("relation")
+    explorer = await get_template_explorer()
+    templates = await explorer.get_templates(relation=relation)
+    return Response(json.dumps(templates), status=200, mimetype='application/json')
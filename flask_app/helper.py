@@ -1,6 +1,120 @@
+import json
+import logging
+import threading
+import time
+
+from flask import Response
+
+
 def create_groups(group_str: str):
     str_groups = group_str.split(',')
     groups = []
     for gp in str_groups:
         groups.append(int(gp))
-    return groups
\ No newline at end of file
+    return groups
+
+
+def conditional_json_response(request, etag, build, response_class=Response):
+    """
+    Response with the JSON string returned by `build` and its ETag, or an empty 304 when the request's
+    If-None-Match already holds the ETag (`build` is not called then). `response_class` is Quart's Response
+    in the async app
+    """
+    if request.if_none_match.contains(etag):
+        resp = response_class(status=304)
+    else:
+        resp = response_class(build(), status=200, mimetype='application/json')
+    resp.set_etag(etag)
+    # clients keep the response but revalidate it on every use
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+def paginated_response(rows, limit, stream=False):
+    """
+    Page of `rows` (dicts with a "cursor" key, at most `limit` of them) as {"results": [...], "next_cursor": ...},
+    next_cursor being None on the last page. With `stream` the rows are written as newline delimited JSON while
+    they are read from the database, followed by a {"next_cursor": ...} line
+    """
+    if not stream:
+        results = list(rows)
+        next_cursor = results[-1]["cursor"] if len(results) == limit else None
+        return Response(json.dumps({"results": results, "next_cursor": next_cursor}), status=200,
+                        mimetype='application/json')
+
+    def generate():
+        count = 0
+        last = None
+        for row in rows:
+            count += 1
+            last = row["cursor"]
+            yield json.dumps(row) + "\n"
+        yield json.dumps({"next_cursor": last if count == limit else None}) + "\n"
+    return Response(generate(), status=200, mimetype='application/x-ndjson')
+
+
+class LazyBackends:
+    """
+    Backend clients created on first use (thread safe), so that importing the app does not wait on
+    Neo4j, Elasticsearch or Mongo. Each backend has its own lock, so that a slow backend doesn't hold up the
+    others. A failed creation is remembered: uses within `retry_backoff` seconds fail right away with the same
+    error, the backoff doubling up to `max_retry_backoff` while the backend keeps failing
+    """
+    def __init__(self, retry_backoff=1.0, max_retry_backoff=30.0):
+        self.factories = {}
+        self.instances = {}
+        self.locks = {}
+        self.failures = {}
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+
+    def register(self, name, factory):
+        self.factories[name] = factory
+        # reentrant: a factory may use another backend, never its own
+        self.locks[name] = threading.RLock()
+
+    def __getattr__(self, name):
+        if name not in self.__dict__.get('factories', {}):
+            raise AttributeError(name)
+        instance = self.instances.get(name)
+        if instance is None:
+            with self.locks[name]:
+                instance = self.instances.get(name)
+                if instance is None:
+                    instance = self.create(name)
+        return instance
+
+    def create(self, name):
+        failure = self.failures.get(name)
+        if failure is not None and time.monotonic() < failure["retry_at"]:
+            raise failure["error"]
+        try:
+            instance = self.factories[name]()
+        except Exception as e:
+            backoff = min(failure["backoff"] * 2, self.max_retry_backoff) if failure else self.retry_backoff
+            self.failures[name] = {"error": e, "backoff": backoff, "retry_at": time.monotonic() + backoff}
+            raise
+        self.failures.pop(name, None)
+        self.instances[name] = instance
+        logging.info(f"{name} initialised")
+        return instance
+
+    def is_ready(self, name):
+        return name in self.instances
+
+    def initialise(self, names=None):
+        """
+        Create every backend (or the `names` ones), returns a dict of name -> error message (None when ready)
+        """
+        errors = {}
+        for name in (self.factories if names is None else names):
+            try:
+                getattr(self, name)
+                errors[name] = None
+            except Exception as e:
+                logging.error(f"failed to initialise {name} error: {e}")
+                errors[name] = str(e)
+        return errors
+
+    def warm_up(self):
+        threading.Thread(target=self.initialise, daemon=True).start()
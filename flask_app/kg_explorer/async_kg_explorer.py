@@ -0,0 +1,102 @@
+import logging
+
+from neo4j import AsyncGraphDatabase
+
+from .kg_explorer import ENTITY_SEARCH_BATCH_QUERY, ENTITY_SEARCH_QUERY, RELATION_TAILS_BATCH_QUERY, \
+    entity_key, entity_search_batch_rows, fuzzy_query, fuzzy_tails_batch_rows, relation_tails_batch_rows, \
+    relation_tails_query
+
+
+class AsyncKGExplorer:
+    """
+    asyncio counterpart of KGExplorer's read queries, backed by one pooled neo4j driver per process
+    """
+    def __init__(self, url, user, password, max_connection_pool_size=100):
+        self.driver = AsyncGraphDatabase.driver(url, auth=(user, password),
+                                                max_connection_pool_size=max_connection_pool_size)
+        logging.info("async neo4j driver created")
+
+    async def close(self):
+        await self.driver.close()
+
+    async def verify_connectivity(self):
+        await self.driver.verify_connectivity()
+
+    async def run(self, query, graph_name=None, **parameters):
+        async with self.driver.session(database=graph_name) as session:
+            result = await session.run(query, parameters)
+            return await result.data()
+
+    async def find_relation_tails(self, n1, relation, graph_name=None):
+        rows = await self.run(relation_tails_query(relation), graph_name=graph_name, key=entity_key(n1))
+        return [row['tail'] for row in rows]
+
+    async def find_relation_tail(self, n1, relation, graph_name=None):
+        return (await self.resolve_relation_tail(n1, relation, graph_name=graph_name))[0]
+
+    async def search_entity(self, name, graph_name=None):
+        """
+        Closest entity name in the full-text index as KGExplorer.search_entity, (name, key) or None
+        """
+        query = fuzzy_query(name)
+        if query is None:
+            return None
+        try:
+            rows = await self.run(ENTITY_SEARCH_QUERY, graph_name=graph_name, terms=query)
+        except Exception as e:
+            logging.error(f"failed to search entity {name} error: {e}")
+            return None
+        if len(rows) == 0:
+            return None
+        return rows[0]['name'], rows[0]['key']
+
+    async def resolve_relation_tail(self, n1, relation, graph_name=None):
+        """
+        (tail, resolved) as KGExplorer.resolve_relation_tail
+        """
+        resolved = None
+        tails = await self.find_relation_tails(n1, relation, graph_name=graph_name)
+        if len(tails) == 0:
+            # no relation for the normalised name, retry with the closest spelling in the graph
+            found = await self.search_entity(n1, graph_name=graph_name)
+            if found is not None and found[1] != entity_key(n1):
+                tails = await self.find_relation_tails(found[0], relation, graph_name=graph_name)
+                if len(tails) > 0:
+                    resolved = found[0]
+        if len(tails) == 0:
+            logging.error("No {relation} found for {entity}".format(relation=relation, entity=n1))
+            return None, None
+        return ", ".join(tails), resolved
+
+    async def find_relation_tails_batch(self, pairs, graph_name=None):
+        return (await self.resolve_relation_tails_batch(pairs, graph_name=graph_name))[0]
+
+    async def resolve_relation_tails_batch(self, pairs, graph_name=None):
+        """
+        (tails, resolved) as KGExplorer.resolve_relation_tails_batch
+        """
+        rows = relation_tails_batch_rows(pairs)
+        tails = [[] for _ in pairs]
+        resolved = [None for _ in pairs]
+        if len(rows) == 0:
+            return tails, resolved
+        for result in await self.run(RELATION_TAILS_BATCH_QUERY, graph_name=graph_name, rows=rows):
+            tails[result['idx']] = result['tails']
+        names, search_rows = entity_search_batch_rows(pairs, tails)
+        if len(search_rows) == 0:
+            return tails, resolved
+        try:
+            matches = {names[result['idx']]: (result['name'], result['key'])
+                       for result in await self.run(ENTITY_SEARCH_BATCH_QUERY, graph_name=graph_name,
+                                                    rows=search_rows)
+                       if result['key'] is not None}
+        except Exception as e:
+            logging.error(f"failed to search {len(search_rows)} entities error: {e}")
+            return tails, resolved
+        fuzzy_rows = fuzzy_tails_batch_rows(pairs, tails, matches)
+        if len(fuzzy_rows) > 0:
+            for result in await self.run(RELATION_TAILS_BATCH_QUERY, graph_name=graph_name, rows=fuzzy_rows):
+                if len(result['tails']) > 0:
+                    tails[result['idx']] = result['tails']
+                    resolved[result['idx']] = matches[pairs[result['idx']][0]][0]
+        return tails, resolved
@@ -2,6 +2,175 @@ from py2neo import Graph, Node, Relationship, NodeMatcher, RelationshipMatcher,
 import logging
 import json
 import re
+import threading
+import unicodedata
+from metrics import metrics
+
+# entities are matched by their normalised name (entity_key), backed by the name_key constraint's index
+RELATIONSHIP_QUERY = ("MATCH (:ENTITY {name_key: $k1})-[r]->(:ENTITY {name_key: $k2}) "
+                      "RETURN type(r) AS type LIMIT 1")
+RELATION_TAILS_BATCH_QUERY = ("UNWIND $rows AS row "
+                              "OPTIONAL MATCH (:ENTITY {name_key: row.key})-[r]->(t) WHERE type(r) = row.relation "
+                              "RETURN row.idx AS idx, collect(t.name) AS tails")
+RELATION_TYPES_QUERY = "CALL db.relationshipTypes() YIELD relationshipType RETURN relationshipType AS type"
+# SCHEMA_QUERIES, GRAPH_NAME, entity_key and normalise_graph_name are copies of the worker's (kg_ingestor.py), the
+# app image is built without the worker's code (celery_worker/benchmarks/key_parity.py checks that they are the same)
+UNIQUE_CONSTRAINT_QUERY = "CREATE CONSTRAINT IF NOT EXISTS ON (x:ENTITY) ASSERT x.name IS UNIQUE"
+NAME_KEY_CONSTRAINT_QUERY = "CREATE CONSTRAINT IF NOT EXISTS ON (x:ENTITY) ASSERT x.name_key IS UNIQUE"
+ENTITY_NAMES_INDEX_QUERY = "CREATE FULLTEXT INDEX entity_names IF NOT EXISTS FOR (x:ENTITY) ON EACH [x.name]"
+SCHEMA_QUERIES = [UNIQUE_CONSTRAINT_QUERY, NAME_KEY_CONSTRAINT_QUERY, ENTITY_NAMES_INDEX_QUERY]
+ENTITY_SEARCH_QUERY = ("CALL db.index.fulltext.queryNodes('entity_names', $terms) YIELD node, score "
+                       "RETURN node.name AS name, node.name_key AS key ORDER BY score DESC LIMIT 1")
+ENTITY_EXISTS_QUERY = "MATCH (e:ENTITY {name_key: $key}) RETURN count(e) > 0"
+ENTITY_SEARCH_BATCH_QUERY = ("UNWIND $rows AS row "
+                             "CALL db.index.fulltext.queryNodes('entity_names', row.terms) YIELD node, score "
+                             "WITH row, node ORDER BY score DESC WITH row, collect(node)[0] AS node "
+                             "RETURN row.idx AS idx, node.name AS name, node.name_key AS key")
+LUCENE_SPECIAL = re.compile(r'([+\-&|!(){}\[\]^"~*?:\\/])')
+# Neo4j database names: 3 to 63 ASCII letters, digits, dots and dashes starting with a letter, case insensitive
+GRAPH_NAME = re.compile(r'^[A-Za-z][A-Za-z0-9.\-]{2,62}$')
+# bounds of the exploration queries: variable-length patterns are expanded at most MAX_HOPS deep, every page
+# holds at most MAX_PAGE_SIZE rows and a request stops expanding after MAX_EXPANSION matched rows (paths or
+# relationships). Keyset pages are cut from those rows, so every page of a hub entity costs up to MAX_EXPANSION
+# rows of expansion plus their sort, and what lies past them is not returned
+MAX_HOPS = 4
+MAX_PAGE_SIZE = 500
+MAX_EXPANSION = 10000
+DIRECTIONS = {"out": ("-", "->"), "in": ("<-", "-"), "both": ("-", "-")}
+
+
+def entity_key(name):
+    """
+    Normalised entity name, the same as the worker's: case, Unicode compatibility forms, spacing, surrounding
+    quotes and punctuation and a leading "the" are ignored, e.g. " The United  States?" -> "united states"
+    """
+    key = " ".join(unicodedata.normalize("NFKC", str(name)).casefold().split()).strip("'\"?!.,;: ")
+    if key.startswith("the ") and len(key) > 4:
+        key = key[4:].lstrip()
+    return key
+
+
+def fuzzy_query(name):
+    """
+    Full-text query matching every word of `name` within a small edit distance, None when there's no word
+    """
+    terms = [LUCENE_SPECIAL.sub(r'\\\1', term) for term in entity_key(name).split()]
+    terms = [term + "~" for term in terms if term]
+    if len(terms) == 0:
+        return None
+    return " AND ".join(terms)
+
+
+def normalise_graph_name(graph_name):
+    """
+    Lower-cased database name, None for the default graph. Raises ValueError for names Neo4j would reject
+    """
+    if graph_name is None:
+        return None
+    if not isinstance(graph_name, str) or not GRAPH_NAME.match(graph_name) or graph_name.lower() == "system":
+        raise ValueError(f"invalid graph name {graph_name!r}")
+    return graph_name.lower()
+
+
+def transform_relation(relation):
+    return str(relation).replace(" ", "_")
+
+
+def relation_tails_query(relation):
+    r_type = "`{}`".format(transform_relation(relation).replace("`", "``"))
+    return "MATCH (:ENTITY {{name_key: $key}})-[:{r_type}]->(t) RETURN t.name AS tail".format(r_type=r_type)
+
+
+def relation_count_query(relation):
+    # a single typed pattern is answered from Neo4j's count store, without scanning the relationships
+    r_type = "`{}`".format(transform_relation(relation).replace("`", "``"))
+    return "MATCH ()-[r:{r_type}]->() RETURN count(r) AS count".format(r_type=r_type)
+
+
+def relation_types_pattern(relations):
+    """
+    Relationship type filter of a pattern, e.g. ":`place_of_birth`|`country`", empty for any type
+    """
+    if not relations:
+        return ""
+    return ":" + "|".join("`{}`".format(transform_relation(relation).replace("`", "``")) for relation in relations)
+
+
+def neighbourhood_query(relations=None, direction="both"):
+    left, right = DIRECTIONS[direction]
+    return ("MATCH (e:ENTITY {{name_key: $key}}){left}[r{types}]{right}(n) "
+            "WITH r LIMIT $max_expansion "
+            "WITH r WHERE id(r) > $after "
+            "RETURN id(r) AS cursor, startNode(r).name AS head, type(r) AS type, endNode(r).name AS tail "
+            "ORDER BY cursor LIMIT $limit").format(left=left, right=right, types=relation_types_pattern(relations))
+
+
+def k_hop_query(hops, relations=None, direction="both"):
+    # the LIMIT before DISTINCT stops the expansion after $max_expansion paths, however many nodes they reach
+    left, right = DIRECTIONS[direction]
+    return ("MATCH (e:ENTITY {{name_key: $key}}){left}[{types}*1..{hops}]{right}(n) WHERE n <> e "
+            "WITH n LIMIT $max_expansion "
+            "WITH DISTINCT n WHERE id(n) > $after "
+            "RETURN id(n) AS cursor, n.name AS name "
+            "ORDER BY cursor LIMIT $limit").format(left=left, right=right, hops=hops,
+                                                    types=relation_types_pattern(relations))
+
+
+def shortest_path_query(max_hops, relations=None):
+    return ("MATCH (a:ENTITY {{name_key: $source}}), (b:ENTITY {{name_key: $target}}) "
+            "MATCH p = shortestPath((a)-[{types}*..{max_hops}]-(b)) "
+            "RETURN [r IN relationships(p) | "
+            "{{head: startNode(r).name, type: type(r), tail: endNode(r).name}}] AS steps").format(
+        max_hops=max_hops, types=relation_types_pattern(relations))
+
+
+def follow_path_query(relations):
+    hops = "".join("-[{types}]->({node})".format(types=relation_types_pattern([relation]),
+                                                  node="t" if i == len(relations) - 1 else "")
+                   for i, relation in enumerate(relations))
+    return ("MATCH (e:ENTITY {{name_key: $key}}){hops} "
+            "WITH t LIMIT $max_expansion "
+            "WITH DISTINCT t WHERE id(t) > $after "
+            "RETURN id(t) AS cursor, t.name AS name "
+            "ORDER BY cursor LIMIT $limit").format(hops=hops)
+
+
+def check_exploration_bounds(hops=1, limit=1, cursor=-1, direction="both"):
+    if not 1 <= hops <= MAX_HOPS:
+        raise ValueError(f"hops must be between 1 and {MAX_HOPS}")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    if cursor < -1:
+        raise ValueError("invalid cursor")
+    if direction not in DIRECTIONS:
+        raise ValueError(f"direction must be one of {', '.join(DIRECTIONS)}")
+
+
+def relation_tails_batch_rows(pairs):
+    return [{"idx": i, "key": entity_key(entity), "relation": transform_relation(relation)}
+            for i, (entity, relation) in enumerate(pairs)]
+
+
+def entity_search_batch_rows(pairs, tails):
+    """
+    Distinct entity names of the pairs without tails and their rows for ENTITY_SEARCH_BATCH_QUERY
+    """
+    names = list(dict.fromkeys(entity for (entity, _), found in zip(pairs, tails) if len(found) == 0))
+    rows = [{"idx": i, "terms": fuzzy_query(name)} for i, name in enumerate(names)]
+    return names, [row for row in rows if row["terms"] is not None]
+
+
+def fuzzy_tails_batch_rows(pairs, tails, matches):
+    """
+    Rows of RELATION_TAILS_BATCH_QUERY looking up the pairs without tails under the closest spelling of their
+    entity, `matches` being entity name -> (name, key) of the search results
+    """
+    rows = []
+    for i, ((entity, relation), found) in enumerate(zip(pairs, tails)):
+        match = matches.get(entity)
+        if len(found) == 0 and match is not None and match[1] != entity_key(entity):
+            rows.append({"idx": i, "key": match[1], "relation": transform_relation(relation)})
+    return rows
 
 
 class KGExplorer:
@@ -11,9 +180,12 @@ class KGExplorer:
         self.default_graph = self.graph_service.default_graph
         self.default_node_matcher = NodeMatcher(self.default_graph)
         self.default_relation_matcher = RelationshipMatcher(self.default_graph)
+        # resolving a named graph lists the databases, resolved graphs are kept
+        self.graphs = {None: self.default_graph}
+        self.graphs_lock = threading.Lock()
 
     def transform_relation(self, relation):
-        return str(relation).replace(" ", "_")
+        return transform_relation(relation)
 
     def rev_transform_relation(self,relation):
         return str(relation).replace("_", " ")
@@ -23,50 +195,209 @@ class KGExplorer:
             node_matcher = self.get_node_matcher(graph_name=graph_name)
         else:
             node_matcher = self.default_node_matcher
-        node_match = node_matcher.match(node_label, name=node_name)
+        if node_label == "ENTITY":
+            node_match = node_matcher.match(node_label, name_key=entity_key(node_name))
+        else:
+            node_match = node_matcher.match(node_label, name=node_name)
         if node_match.exists():
             return node_match.first(), True
         else:
             return None, False
 
     def get_node_matcher(self, graph_name):
-        graph = self.graph_service[graph_name]
-        return NodeMatcher(graph)
+        return NodeMatcher(self.get_graph(graph_name))
 
     def get_relation_matcher(self, graph_name):
-        graph = self.graph_service[graph_name]
-        return RelationshipMatcher(graph)
+        return RelationshipMatcher(self.get_graph(graph_name))
+
+    def get_graph(self, graph_name=None):
+        """
+        Raises ValueError for invalid names and KeyError for graphs that don't exist
+        """
+        graph_name = normalise_graph_name(graph_name)
+        graph = self.graphs.get(graph_name)
+        if graph is None:
+            with self.graphs_lock:
+                graph = self.graphs.get(graph_name)
+                if graph is None:
+                    graph = self.graph_service[graph_name]
+                    self.graphs[graph_name] = graph
+        return graph
 
+    def create_graph(self, graph_name):
+        """
+        Create the database `graph_name` with the ENTITY constraints and indexes the worker relies on, nothing
+        happens when it exists. Several databases need Neo4j Enterprise. Returns the normalised name
+        """
+        graph_name = normalise_graph_name(graph_name)
+        if graph_name is None:
+            raise ValueError("graph name not found in request")
+        self.graph_service.system_graph.run(f"CREATE DATABASE `{graph_name}` IF NOT EXISTS WAIT")
+        graph = self.get_graph(graph_name)
+        for query in SCHEMA_QUERIES:
+            graph.run(query)
+        logging.info(f"graph {graph_name} created")
+        return graph_name
+
+    def list_graphs(self):
+        default_name = self.default_graph.name
+        return [{"graph_name": name, "default": name == default_name}
+                for name in self.graph_service.keys() if name != "system"]
+
+    @metrics.timed("graph_relationship")
     def find_relationship(self, n1, n2, graph_name=None):
-        if graph_name is not None:
-            relation_matcher = self.get_relation_matcher(graph_name)
-        else:
-            relation_matcher = self.default_relation_matcher
-        node1, exists = self._get_node(n1)
-        if not exists:
-            logging.error("No node found for {entity}".format(entity=n1))
-            return
-        node2, exists = self._get_node(n2)
-        if not exists:
-            logging.error("No node found for {entity}".format(entity=n2))
+        rows = self.get_graph(graph_name).run(RELATIONSHIP_QUERY, k1=entity_key(n1), k2=entity_key(n2)).data()
+        if len(rows) == 0:
+            logging.error("No relationship found between {n1} and {n2}".format(n1=n1, n2=n2))
             return
-        match_output = relation_matcher.match((node1, node2))
-        return type(match_output.first()).__name__
+        return rows[0]['type']
 
-    def find_relation_tail(self,n1,relation, graph_name=None):
-        print(f"entity {n1} relation: {relation}")
-        if graph_name is not None:
-            relation_matcher = self.get_relation_matcher(graph_name)
-        else:
-            relation_matcher = self.default_relation_matcher
-        node1, exists = self._get_node(n1)
-        if not exists:
-            logging.error("No node found for {entity}".format(entity=n1))
-            return
-        relationship = relation_matcher.match([node1], r_type=self.transform_relation(relation))
-        print(f"relationship: {relationship}")
-        rel_str = str(relationship.first())
-        pattern = re.compile('->\((.*)\)')
-        answer = pattern.findall(rel_str)[0]
-        return answer
+    @metrics.timed("graph_relation_tails")
+    def find_relation_tails(self, n1, relation, graph_name=None):
+        return [row['tail'] for row in
+                self.get_graph(graph_name).run(relation_tails_query(relation), key=entity_key(n1)).data()]
+
+    @metrics.timed("graph_entity_search")
+    def search_entity(self, name, graph_name=None):
+        """
+        Closest entity name in the full-text index when no entity has the normalised name of `name`, e.g.
+        "Barak Obama" -> "Barack Obama". Returns (name, key), None when nothing matches
+        """
+        query = fuzzy_query(name)
+        if query is None:
+            return None
+        try:
+            rows = self.get_graph(graph_name).run(ENTITY_SEARCH_QUERY, terms=query).data()
+        except Exception as e:
+            # e.g. a graph created before the full-text index
+            logging.error(f"failed to search entity {name} error: {e}")
+            return None
+        if len(rows) == 0:
+            return None
+        return rows[0]['name'], rows[0]['key']
+
+    def find_relation_tail(self, n1, relation, graph_name=None):
+        return self.resolve_relation_tail(n1, relation, graph_name=graph_name)[0]
+
+    def resolve_relation_tail(self, n1, relation, graph_name=None):
+        """
+        (tail, resolved) where `resolved` is the closest entity name in the graph when the answer was found
+        under that spelling instead of `n1`, None otherwise
+        """
+        resolved = None
+        tails = self.find_relation_tails(n1, relation, graph_name=graph_name)
+        if len(tails) == 0:
+            # no relation for the normalised name, retry with the closest spelling in the graph
+            found = self.search_entity(n1, graph_name=graph_name)
+            if found is not None and found[1] != entity_key(n1):
+                tails = self.find_relation_tails(found[0], relation, graph_name=graph_name)
+                if len(tails) > 0:
+                    resolved = found[0]
+        if len(tails) == 0:
+            logging.error("No {relation} found for {entity}".format(relation=relation, entity=n1))
+            return None, None
+        return ", ".join(tails), resolved
+
+    def find_relation_tails_batch(self, pairs, graph_name=None):
+        return self.resolve_relation_tails_batch(pairs, graph_name=graph_name)[0]
+
+    @metrics.timed("graph_relation_tails_batch")
+    def resolve_relation_tails_batch(self, pairs, graph_name=None):
+        """
+        Looks up the tails of many (entity, relation) pairs with a single UNWIND query, the pairs without tails
+        are looked up again under the closest spelling of their entity like find_relation_tail does (two more
+        queries). Returns one list of tails per pair and one resolved name per pair, None unless the tails were
+        found under another spelling
+        """
+        rows = relation_tails_batch_rows(pairs)
+        tails = [[] for _ in pairs]
+        resolved = [None for _ in pairs]
+        if len(rows) == 0:
+            return tails, resolved
+        graph = self.get_graph(graph_name)
+        for result in graph.run(RELATION_TAILS_BATCH_QUERY, rows=rows).data():
+            tails[result['idx']] = result['tails']
+        names, search_rows = entity_search_batch_rows(pairs, tails)
+        if len(search_rows) == 0:
+            return tails, resolved
+        try:
+            matches = {names[result['idx']]: (result['name'], result['key'])
+                       for result in graph.run(ENTITY_SEARCH_BATCH_QUERY, rows=search_rows).data()
+                       if result['key'] is not None}
+        except Exception as e:
+            # e.g. a graph created before the full-text index
+            logging.error(f"failed to search {len(search_rows)} entities error: {e}")
+            return tails, resolved
+        fuzzy_rows = fuzzy_tails_batch_rows(pairs, tails, matches)
+        if len(fuzzy_rows) > 0:
+            for result in graph.run(RELATION_TAILS_BATCH_QUERY, rows=fuzzy_rows).data():
+                if len(result['tails']) > 0:
+                    tails[result['idx']] = result['tails']
+                    resolved[result['idx']] = matches[pairs[result['idx']][0]][0]
+        return tails, resolved
+
+    def get_relation_types(self, graph_name=None):
+        return [row['type'] for row in self.get_graph(graph_name).run(RELATION_TYPES_QUERY).data()]
+
+    @metrics.timed("graph_relation_count")
+    def count_relations(self, relation, graph_name=None):
+        return self.get_graph(graph_name).run(relation_count_query(relation)).evaluate() or 0
+
+    def stream(self, query, graph_name=None, **parameters):
+        """
+        Runs the query right away and returns a generator of its records as dicts, read from the driver as
+        they are consumed
+        """
+        cursor = self.get_graph(graph_name).run(query, **parameters)
+        return (dict(record) for record in cursor)
+
+    @metrics.timed("graph_neighbourhood")
+    def neighbourhood(self, entity, relations=None, direction="both", limit=100, cursor=-1, graph_name=None):
+        """
+        Relationships of `entity` as head/type/tail dicts, `limit` at a time in relationship id order
+        after `cursor`. Only the first MAX_EXPANSION relationships expanded are paged
+        """
+        check_exploration_bounds(limit=limit, cursor=cursor, direction=direction)
+        return self.stream(neighbourhood_query(relations, direction), graph_name=graph_name,
+                           key=entity_key(entity), after=cursor, limit=limit, max_expansion=MAX_EXPANSION)
+
+    @metrics.timed("graph_k_hop")
+    def k_hop(self, entity, hops=2, relations=None, direction="both", limit=100, cursor=-1, graph_name=None):
+        """
+        Distinct entities reachable from `entity` in 1 to `hops` relationships, `limit` at a time in node
+        id order after `cursor`. Only the entities reached by the first MAX_EXPANSION paths expanded are paged
+        """
+        check_exploration_bounds(hops=hops, limit=limit, cursor=cursor, direction=direction)
+        return self.stream(k_hop_query(hops, relations, direction), graph_name=graph_name,
+                           key=entity_key(entity), after=cursor, limit=limit, max_expansion=MAX_EXPANSION)
+
+    @metrics.timed("graph_shortest_path")
+    def shortest_path(self, source, target, max_hops=MAX_HOPS, relations=None, graph_name=None):
+        """
+        Steps (head/type/tail dicts) of a shortest path between two entities ignoring directions, None
+        when there is no path of at most `max_hops` relationships. The path from an entity to itself is empty
+        """
+        check_exploration_bounds(hops=max_hops)
+        graph = self.get_graph(graph_name)
+        if entity_key(source) == entity_key(target):
+            # shortestPath fails when both ends are the same node
+            found = graph.run(ENTITY_EXISTS_QUERY, key=entity_key(source)).evaluate()
+            return [] if found else None
+        rows = graph.run(shortest_path_query(max_hops, relations),
+                         source=entity_key(source), target=entity_key(target)).data()
+        if len(rows) == 0:
+            return None
+        return rows[0]['steps']
 
+    @metrics.timed("graph_follow_path")
+    def follow_path(self, entity, relations, limit=100, cursor=-1, graph_name=None):
+        """
+        Answers chained questions: the entities at the end of `relations` followed in order from `entity`,
+        e.g. ["place of birth", "country", "continent"]. Only the ends of the first MAX_EXPANSION paths
+        expanded are paged
+        """
+        if not relations:
+            raise ValueError("at least one relation is needed")
+        check_exploration_bounds(hops=len(relations), limit=limit, cursor=cursor)
+        return self.stream(follow_path_query(relations), graph_name=graph_name, key=entity_key(entity),
+                           after=cursor, limit=limit, max_expansion=MAX_EXPANSION)
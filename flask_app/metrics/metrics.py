@@ -0,0 +1,89 @@
+import contextlib
+import logging
+import os
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "false").lower() in ("1", "true", "yes")
+
+prometheus_client = None
+if METRICS_ENABLED:
+    try:
+        import prometheus_client
+        from prometheus_client import multiprocess
+    except ImportError:
+        logging.warning("METRICS_ENABLED is set but prometheus_client is not installed, metrics are disabled")
+
+ENABLED = prometheus_client is not None
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class NoopMetric:
+    """
+    Stands in for every metric when metrics are disabled
+    """
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, amount):
+        pass
+
+    def time(self):
+        return NULL_CONTEXT
+
+
+NOOP = NoopMetric()
+NULL_CONTEXT = contextlib.nullcontext()
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    if not ENABLED:
+        return NOOP
+    return prometheus_client.Histogram(name, documentation, labelnames, buckets=buckets)
+
+
+def counter(name, documentation, labelnames=()):
+    if not ENABLED:
+        return NOOP
+    return prometheus_client.Counter(name, documentation, labelnames)
+
+
+REQUEST_SECONDS = histogram("kg_app_request_seconds", "Request latency per endpoint", ["endpoint", "status"])
+STAGE_SECONDS = histogram("kg_app_stage_seconds", "Time spent in each question answering stage", ["stage"])
+CACHE_REQUESTS = counter("kg_app_cache_requests_total", "Answer cache lookups", ["cache", "result"])
+QUESTIONS = counter("kg_app_questions_total", "Questions answered, by how the answer was found", ["source"])
+
+
+def stage(name):
+    """
+    Context manager timing a block into kg_app_stage_seconds
+    """
+    if not ENABLED:
+        return NULL_CONTEXT
+    return STAGE_SECONDS.labels(name).time()
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function as stage `name`, the function is returned as is when
+    metrics are disabled
+    """
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+        return STAGE_SECONDS.labels(name).time()(fn)
+    return decorator
+
+
+def exposition():
+    """
+    Returns (body, content type) of the Prometheus text format, aggregated over every process of the
+    server when PROMETHEUS_MULTIPROC_DIR is set (e.g. under gunicorn)
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
@@ -0,0 +1,17 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+
+
+class AsyncMongoExtractor:
+    """
+    asyncio counterpart of MongoExtractor's read queries, sharing one motor connection pool
+    """
+    def __init__(self, url, database, collection, max_pool_size=100):
+        self.client = AsyncIOMotorClient(url, maxPoolSize=max_pool_size)
+        self.db = self.client[database]
+        self.collection = self.db[collection]
+
+    async def get_sample_relations(self, task_id):
+        doc = await self.collection.find_one({"task_id": task_id}, {"_id": 0, "task_id": 1, "relations": 1})
+        if doc is None:
+            return {}
+        return doc
@@ -1,4 +1,3 @@
-import logging
 import pymongo
 
 
@@ -7,20 +6,17 @@ class MongoExtractor:
         self.client = pymongo.MongoClient(url)
         self.db = self.client[database]
         self.collection = self.db[collection]
+        self.collection.create_index("task_id")
+        self.collection.create_index("ingestion_id")
 
     def get_sample_relations(self, task_id):
-        query = {"task_id": task_id}
-        results = self.collection.find(query)
-        docs = []
-        for doc in results:
-            docs.append(doc)
-        if len(docs) == 0:
+        doc = self.collection.find_one({"task_id": task_id}, {"_id": 0, "task_id": 1, "relations": 1})
+        if doc is None:
             return {}
-        return docs[0]
+        return doc
 
-    def update_doc(self, task_id, ingestion_id):
-        op = self.collection.update_one({'ingestion_id': ingestion_id}, {"$set": {"task_id": task_id}}, upsert=False)
-        if op.matched_count == 0:
-            logging.error(f"failed to find any match for task_id: {task_id}")
-        else:
-            logging.info(f"updated task_id {task_id} for ingestion_id {ingestion_id}")
\ No newline at end of file
+    def get_ingestion_status(self, task_id):
+        """
+        Status and progress recorded by the worker, None when the task hasn't started yet
+        """
+        return self.collection.find_one({"task_id": task_id}, {"_id": 0, "status": 1, "progress": 1, "graph_name": 1})
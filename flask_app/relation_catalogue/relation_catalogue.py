@@ -0,0 +1,106 @@
+import bisect
+import json
+import logging
+import threading
+import uuid
+
+from version_poller.version_poller import VersionPoller
+
+
+class RelationCatalogue:
+    """
+    In-memory catalogue of relation names: the relations of triplets_dedup.txt merged with the relationship
+    types present in the graph, along with their edge counts.
+    The celery worker stamps the relationship types it writes with an increasing sequence number in the
+    `versions` collection; the counts of the types stamped since the last poll are read again from Neo4j's
+    count store, at most every `poll_interval` seconds (see VersionPoller): on `refresh`, or in a background
+    thread with `poll_in_background` so that reads never wait on Mongo or Neo4j. Every change bumps the
+    catalogue version, which is the ETag of the responses built from it.
+    """
+    def __init__(self, kg_explorer, versions, relation_list_path="resources/triplets_dedup.txt", poll_interval=5,
+                 seq_overlap=50, poll_in_background=False):
+        self.kg_explorer = kg_explorer
+        self.lock = threading.Lock()
+        with open(relation_list_path, mode='r', encoding='utf-8') as f:
+            self.listed_relations = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+        # ETags of another process (or of this one before a restart) never match
+        self.instance_id = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.poller = VersionPoller(versions, self.recount, poll_interval=poll_interval, seq_overlap=seq_overlap,
+                                    description="relation type")
+        self.counts = {relation_type: self.kg_explorer.count_relations(relation_type)
+                       for relation_type in self.kg_explorer.get_relation_types()}
+        self.rebuild()
+        logging.info(f"relation catalogue built with {len(self.relations)} relations, "
+                     f"{len(self.counts)} of them in the graph")
+        if poll_in_background:
+            self.poller.start(name="relation-catalogue-poller")
+
+    @staticmethod
+    def normalise(name: str):
+        return " ".join(name.replace("_", " ").split()).casefold()
+
+    def rebuild(self):
+        # relations in file order, followed by the graph-only types in name order
+        listed = set(self.listed_relations)
+        graph_relations = sorted(self.kg_explorer.rev_transform_relation(relation_type)
+                                 for relation_type in self.counts)
+        relations = self.listed_relations + [relation for relation in graph_relations if relation not in listed]
+        entries = sorted((self.normalise(relation), relation) for relation in relations)
+        with self.lock:
+            self.relations = relations
+            self.keys = [key for key, _ in entries]
+            self.sorted_relations = [relation for _, relation in entries]
+            self.relation_list_json = json.dumps(relations)
+            self.version += 1
+
+    def etag(self):
+        return f"{self.instance_id}-{self.version}"
+
+    def refresh(self):
+        self.poller.poll_if_due()
+
+    def close(self):
+        self.poller.close()
+
+    def recount(self, relation_types):
+        # called by the poller under its lock, the counts and the rebuild are never updated in two threads
+        counted = []
+        counts = dict(self.counts)
+        for relation_type in relation_types:
+            try:
+                counts[relation_type] = self.kg_explorer.count_relations(relation_type)
+            except Exception as e:
+                logging.error(f"failed to count {relation_type} relations error: {e}")
+                continue
+            counted.append(relation_type)
+        if counts != self.counts:
+            self.counts = counts
+            self.rebuild()
+        return counted
+
+    def count(self, relation):
+        return self.counts.get(self.kg_explorer.transform_relation(relation), 0)
+
+    def get_relation_list(self):
+        return self.relation_list_json
+
+    def search(self, prefix="", offset=0, limit=20):
+        """
+        Relations whose normalised name starts with the normalised prefix (case, underscores and extra
+        spaces are ignored), in name order, `limit` at a time from `offset`
+        """
+        key = self.normalise(prefix)
+        with self.lock:
+            keys, sorted_relations = self.keys, self.sorted_relations
+        start = bisect.bisect_left(keys, key)
+        end = bisect.bisect_left(keys, key + "\U0010ffff", lo=start)
+        page = sorted_relations[start + offset:min(start + offset + limit, end)]
+        next_offset = offset + limit if start + offset + limit < end else None
+        return {
+            "relations": [{"relation": relation, "count": self.count(relation)} for relation in page],
+            "total": end - start,
+            "offset": offset,
+            "limit": limit,
+            "next_offset": next_offset,
+        }
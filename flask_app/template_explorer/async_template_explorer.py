@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import time
+
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_scan
+
+from answer_cache.answer_cache import MISSING
+from .template_engine import TemplateEngine
+from .template_explorer import ElasticTemplateExplorer
+
+
+class AsyncTemplateExplorer:
+    """
+    asyncio counterpart of ElasticTemplateExplorer's read path. Questions are answered from the in-memory
+    template engine, the graph lookups of all matching templates run concurrently and Elasticsearch is only
+    queried as a fallback. Template ingestion stays with the Flask app: the engine reloads the stored
+    templates every `reload_interval` seconds to pick up templates added there.
+    """
+    def __init__(self, kg_explorer, elastic_url="http://localhost:9200", answer_cache=None, reload_interval=60):
+        self.es_cluster = AsyncElasticsearch([elastic_url])
+        self.kg_explorer = kg_explorer
+        self.answer_cache = answer_cache
+        self.template_engine = TemplateEngine()
+        self.reload_interval = reload_interval
+        self.last_reload = None
+
+    async def close(self):
+        await self.es_cluster.close()
+
+    async def load_templates(self, index="template_store"):
+        templates = [hit['_source'] async for hit in async_scan(self.es_cluster, index=index,
+                                                                query={"query": {"match_all": {}}})]
+        size = len(self.template_engine)
+        self.template_engine.add_templates(templates)
+        self.last_reload = time.monotonic()
+        if self.answer_cache is not None and len(self.template_engine) != size:
+            # templates added through the Flask app may answer the cached questions differently
+            self.answer_cache.clear_questions()
+        logging.info(f"{len(self.template_engine)} templates loaded in the template engine")
+
+    async def reload_templates(self):
+        if self.last_reload is None or time.monotonic() - self.last_reload > self.reload_interval:
+            try:
+                await self.load_templates()
+            except Exception as e:
+                logging.error(f"failed to load templates error: {e}")
+
+    async def search_template(self, query: str, index="template_store", graph_name=None):
+        if self.answer_cache is None:
+            return await self.answer_question(query, index=index, graph_name=graph_name)
+        start = time.perf_counter()
+        # in-memory reads, the answer cache polls entity versions in a background thread
+        answer = self.answer_cache.get_answer(query, graph_name=graph_name)
+        if answer is not MISSING:
+            self.answer_cache.record_latency(True, time.perf_counter() - start)
+            return answer
+        answer = await self.answer_question(query, index=index, graph_name=graph_name)
+        self.answer_cache.put_answer(query, answer, answer.get("entities", []), graph_name=graph_name)
+        self.answer_cache.record_latency(False, time.perf_counter() - start)
+        return answer
+
+    async def resolve_relation_tail(self, entity, relation, graph_name=None):
+        """
+        (tail, resolved) as AsyncKGExplorer.resolve_relation_tail, from the answer cache when it holds the lookup
+        """
+        if self.answer_cache is None:
+            return await self.kg_explorer.resolve_relation_tail(entity, relation, graph_name=graph_name)
+        cached = self.answer_cache.get_lookup(entity, relation, graph_name=graph_name)
+        if cached is not MISSING:
+            return cached
+        tail, resolved = await self.kg_explorer.resolve_relation_tail(entity, relation, graph_name=graph_name)
+        self.answer_cache.put_lookup(entity, relation, tail, graph_name=graph_name, resolved=resolved)
+        return tail, resolved
+
+    async def answer_question(self, query: str, index="template_store", graph_name=None):
+        await self.reload_templates()
+        candidates = self.template_engine.match(query)
+        if len(candidates) == 0:
+            return await self.search_elastic_template(query, index=index, graph_name=graph_name)
+        entities = [candidate['entity'] for candidate in candidates]
+        answers = await asyncio.gather(*[self.resolve_relation_tail(candidate['entity'], candidate['relation'],
+                                                                    graph_name=graph_name)
+                                         for candidate in candidates], return_exceptions=True)
+        for answer in answers:
+            if not isinstance(answer, Exception) and answer[0] is not None:
+                # the answer also depends on the entity it was found under
+                return {"answer": answer[0], "entities": entities + ([answer[1]] if answer[1] is not None else [])}
+        return {"answer": "sorry I don't know about that", "entities": entities}
+
+    async def search_templates(self, queries, graph_name=None):
+        """
+        Answers many questions at once: the candidates of every question not in the answer cache are looked
+        up with a single UNWIND query, questions matching no template fall back to Elasticsearch concurrently
+        """
+        await self.reload_templates()
+        answers = [None] * len(queries)
+        pending = []
+        for i, query in enumerate(queries):
+            if self.answer_cache is not None:
+                answer = self.answer_cache.get_answer(query, graph_name=graph_name)
+                if answer is not MISSING:
+                    answers[i] = answer
+                    continue
+            pending.append((i, self.template_engine.match(query)))
+        pairs = [(candidate['entity'], candidate['relation']) for _, candidates in pending for candidate in candidates]
+        tails, resolved = await self.kg_explorer.resolve_relation_tails_batch(pairs, graph_name=graph_name)
+        tails, resolved = iter(tails), iter(resolved)
+        fallbacks = []
+        for i, candidates in pending:
+            candidate_tails = [(next(tails), next(resolved)) for _ in candidates]
+            if len(candidates) == 0:
+                fallbacks.append(i)
+                continue
+            answers[i] = {"answer": "sorry I don't know about that",
+                          "entities": [candidate['entity'] for candidate in candidates]}
+            for found, name in candidate_tails:
+                if len(found) > 0:
+                    answers[i]["answer"] = ", ".join(found)
+                    if name is not None:
+                        answers[i]["entities"].append(name)
+                    break
+        fallback_answers = await asyncio.gather(*[self.search_elastic_template(queries[i], graph_name=graph_name)
+                                                  for i in fallbacks],
+                                                return_exceptions=True)
+        failed = set()
+        for i, answer in zip(fallbacks, fallback_answers):
+            if isinstance(answer, Exception):
+                logging.error(f"{answer}")
+                # not cached: the question is answered again once Elasticsearch is back
+                answer = {"answer": "sorry I am not sure about that", "entities": []}
+                failed.add(i)
+            answers[i] = answer
+        if self.answer_cache is not None:
+            for i in (i for i, _ in pending if i not in failed):
+                self.answer_cache.put_answer(queries[i], answers[i], answers[i].get("entities", []),
+                                             graph_name=graph_name)
+        return answers
+
+    async def search_elastic_template(self, query: str, index="template_store", graph_name=None):
+        search_query = {
+            "from": 0,
+            "size": 2,
+            "query": {
+                "match": {
+                    "template": query
+                }
+            }
+        }
+        res = await self.es_cluster.search(index=index, body=search_query)
+        if len(res['hits']['hits']) > 0:
+            template_obj = res['hits']['hits'][0]['_source']
+            entity = ElasticTemplateExplorer.extract_entity(template_obj['template'], template_obj['groups'], query)
+            answer, resolved = await self.resolve_relation_tail(entity, template_obj['relation'],
+                                                                graph_name=graph_name)
+            return {"answer": answer, "entities": [entity] + ([resolved] if resolved is not None else [])}
+        return {"answer": "sorry I don't know about that"}
+
+    async def get_templates(self, relation: str, index="template_store"):
+        search_query = {
+            "from": 0,
+            "size": 4,
+            "query": {
+                "match_phrase": {
+                    "relation": relation
+                }
+            }
+        }
+        res = await self.es_cluster.search(index=index, body=search_query)
+        return [temp['_source']['template'] for temp in res['hits']['hits']]
@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import re
+import threading
+
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+
+class TemplateEngine:
+    """
+    In-memory store of question templates compiled into one combined matcher.
+    Every template becomes an optional lookahead anchored at the start of the question, so a single
+    match call finds every template matching the question along with its captured groups.
+    """
+    def __init__(self):
+        self.templates = {}
+        self.lock = threading.Lock()
+        # (combined pattern, [(template, group offset)], templates matched one by one)
+        self.compiled = (None, [], [])
+
+    @staticmethod
+    def template_id(template):
+        return hashlib.md5(template.encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        return len(self.templates)
+
+    def add_template(self, relation, template, groups=None):
+        try:
+            pattern = re.compile(template)
+        except re.error as e:
+            logging.error(f"invalid template {template} error: {e}")
+            return False
+        with self.lock:
+            self.templates[self.template_id(template)] = {"relation": relation, "template": template,
+                                                          "groups": groups or [], "pattern": pattern}
+            self.compile()
+        return True
+
+    def add_templates(self, templates):
+        with self.lock:
+            for template_obj in templates:
+                try:
+                    pattern = re.compile(template_obj['template'])
+                except re.error as e:
+                    logging.error(f"invalid template {template_obj['template']} error: {e}")
+                    continue
+                self.templates[self.template_id(template_obj['template'])] = {
+                    "relation": template_obj['relation'], "template": template_obj['template'],
+                    "groups": template_obj.get('groups') or [], "pattern": pattern}
+            self.compile()
+
+    def get_templates(self, relation, limit=4):
+        # templates are kept in insertion order
+        return [template_obj['template'] for template_obj in list(self.templates.values())
+                if template_obj['relation'] == relation][:limit]
+
+    def compile(self):
+        parts = []
+        offsets = []
+        separate = []
+        group = 1
+        # longer templates are more specific, they are tried first when answering
+        for template_obj in sorted(self.templates.values(), key=lambda t: -len(t['template'])):
+            if BACKREFERENCE.search(template_obj['template']) or template_obj['pattern'].groupindex:
+                # group numbers and names would clash once combined
+                separate.append(template_obj)
+                continue
+            parts.append("(?:(?=[\\s\\S]*?(" + template_obj['template'] + ")))?")
+            offsets.append((template_obj, group))
+            group += 1 + template_obj['pattern'].groups
+        combined = re.compile("^" + "".join(parts)) if parts else None
+        self.compiled = (combined, offsets, separate)
+
+    @staticmethod
+    def extract_entity(template_obj, match_groups):
+        # match_groups[0] is the whole match, followed by the template's own groups
+        groups = template_obj['groups']
+        if len(groups) > 0:
+            entity = match_groups[groups[0] + 1]
+        elif template_obj['pattern'].groups > 0:
+            entity = match_groups[1]
+        else:
+            entity = match_groups[0]
+        if entity is None:
+            return None
+        return entity.strip()
+
+    def match(self, query: str):
+        """
+        Returns every template matching the query as dicts of relation, template and extracted entity,
+        most specific template first
+        """
+        combined, offsets, separate = self.compiled
+        candidates = []
+        if combined is not None:
+            m = combined.match(query)
+            for template_obj, group in offsets:
+                if m.group(group) is None:
+                    continue
+                match_groups = m.groups()[group - 1:group + template_obj['pattern'].groups]
+                entity = self.extract_entity(template_obj, match_groups)
+                if entity:
+                    candidates.append({"relation": template_obj['relation'], "template": template_obj['template'],
+                                       "entity": entity})
+        for template_obj in separate:
+            m = template_obj['pattern'].search(query)
+            if m is None:
+                continue
+            entity = self.extract_entity(template_obj, (m.group(0),) + m.groups())
+            if entity:
+                candidates.append({"relation": template_obj['relation'], "template": template_obj['template'],
+                                   "entity": entity})
+        return candidates
@@ -1,12 +1,17 @@
 import json
 import logging
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, helpers
 import hashlib
 import re
+import time
+from .template_engine import TemplateEngine
+from answer_cache.answer_cache import MISSING
+from metrics import metrics
 
 
 class ElasticTemplateExplorer:
-    def __init__(self, kg_explorer, elastic_url="http://localhost:9200"):
+    def __init__(self, kg_explorer, elastic_url="http://localhost:9200", answer_cache=None):
+        self.answer_cache = answer_cache
         self.es_cluster = Elasticsearch([elastic_url])
         logging.info("Elastic cluster client created")
         logging.info(self.es_cluster.info())
@@ -16,7 +21,9 @@ class ElasticTemplateExplorer:
         self.get_index_size()
         self.kg_explorer = kg_explorer
         logging.info("connected to KG explorer successfully")
-        self.ingest_standard_templates()
+        self.template_engine = TemplateEngine()
+        self.ingest_standard_templates(force=self.index_created)
+        self.load_templates()
 
     def get_relation_list(self):
         if self.relation_list is None:
@@ -31,20 +38,40 @@ class ElasticTemplateExplorer:
         logging.info(f"Deleting index {name}")
 
     def create_template_index(self, name="template_store"):
+        self.index_created = False
         if not self.es_cluster.indices.exists(index=name):
             self.es_cluster.indices.create(index=name)
+            self.index_created = True
 
-    def ingest_standard_templates(self,filepath="resources/standard_templates.jsonl"):
-        with open(filepath, mode='r',encoding='utf-8') as f:
-            count = 0
-            for line in f:
-                if len(line)<10:
-                    return
-                relation_obj = json.loads(line.strip('\n'))
-                relation = relation_obj['relation']
-                for template in relation_obj['templates']:
-                    count += 1
-                    self.ingest_template(relation, template['pattern'], template['groups'])
+    def read_standard_templates(self, filepath="resources/standard_templates.jsonl"):
+        with open(filepath, mode='rb') as f:
+            content = f.read()
+        templates = []
+        for line in content.decode('utf-8').splitlines(keepends=True):
+            if len(line) < 10:
+                break
+            relation_obj = json.loads(line.strip('\n'))
+            for template in relation_obj['templates']:
+                templates.append({"relation": relation_obj['relation'], "template": template['pattern'],
+                                  "groups": template['groups']})
+        return templates, hashlib.sha256(content).hexdigest()
+
+    def ingest_standard_templates(self, filepath="resources/standard_templates.jsonl", index="template_store",
+                                  meta_index="template_meta", force=False):
+        """
+        Bulk index the standard templates, skipped when the checksum stored by the last ingestion
+        matches the file
+        """
+        templates, checksum = self.read_standard_templates(filepath)
+        self.template_engine.add_templates(templates)
+        meta = self.es_cluster.get(index=meta_index, id=index, ignore=[404])
+        if not force and meta.get('found') and meta['_source'].get('checksum') == checksum:
+            logging.info(f"standard templates unchanged (checksum {checksum}), skipping ingestion")
+            return
+        actions = ({"_index": index, "_id": hashlib.md5(template['template'].encode('utf-8')).hexdigest(),
+                    "_source": template} for template in templates)
+        count, _ = helpers.bulk(self.es_cluster, actions)
+        self.es_cluster.index(index=meta_index, id=index, body={"checksum": checksum, "count": count})
         logging.info(f"{count} standard templates ingested")
 
     def ingest_template(self, relation, template, groups=None, index="template_store"):
@@ -53,8 +80,27 @@ class ElasticTemplateExplorer:
         doc = {"relation": relation, "template": template, "groups":groups}
         doc_id = hashlib.md5(template.encode('utf-8')).hexdigest()
         self.es_cluster.index(index=index, body=doc, id=doc_id)
+        self.template_engine.add_template(relation, template, groups)
+        if self.answer_cache is not None:
+            # cached answers, "don't know" ones included, may have been answered by another template
+            self.answer_cache.clear_questions()
+
+    def load_templates(self, index="template_store"):
+        # every stored template, including the ones added through /add_template by earlier processes
+        templates = [hit['_source'] for hit in helpers.scan(self.es_cluster, index=index,
+                                                            query={"query": {"match_all": {}}})]
+        self.template_engine.add_templates(templates)
+        logging.info(f"{len(self.template_engine)} templates loaded in the template engine")
 
     def get_templates(self, relation: str, index="template_store"):
+        # every stored template is loaded in the template engine, Elasticsearch's phrase match is only
+        # used for names that are not an exact relation
+        templates = self.template_engine.get_templates(relation)
+        if len(templates) > 0:
+            return templates
+        return self.search_relation_templates(relation, index=index)
+
+    def search_relation_templates(self, relation: str, index="template_store"):
         search_query = {
             "from": 0,
             "size": 4,
@@ -71,7 +117,109 @@ class ElasticTemplateExplorer:
                 templates.append(temp['_source']['template'])
         return templates
 
-    def search_template(self, query: str, index="template_store"):
+    def search_template(self, query: str, index="template_store", graph_name=None):
+        if self.answer_cache is None:
+            return self.answer_question(query, index=index, graph_name=graph_name)
+        start = time.perf_counter()
+        answer = self.answer_cache.get_answer(query, graph_name=graph_name)
+        if answer is not MISSING:
+            self.answer_cache.record_latency(True, time.perf_counter() - start)
+            metrics.CACHE_REQUESTS.labels("answer", "hit").inc()
+            metrics.QUESTIONS.labels("cache").inc()
+            return answer
+        metrics.CACHE_REQUESTS.labels("answer", "miss").inc()
+        answer = self.answer_question(query, index=index, graph_name=graph_name)
+        self.answer_cache.put_answer(query, answer, answer.get("entities", []), graph_name=graph_name)
+        self.answer_cache.record_latency(False, time.perf_counter() - start)
+        return answer
+
+    def find_relation_tail(self, entity, relation, graph_name=None):
+        return self.resolve_relation_tail(entity, relation, graph_name=graph_name)[0]
+
+    def resolve_relation_tail(self, entity, relation, graph_name=None):
+        """
+        (tail, resolved) as KGExplorer.resolve_relation_tail, from the answer cache when it holds the lookup
+        """
+        if self.answer_cache is None:
+            return self.kg_explorer.resolve_relation_tail(entity, relation, graph_name=graph_name)
+        cached = self.answer_cache.get_lookup(entity, relation, graph_name=graph_name)
+        if cached is not MISSING:
+            metrics.CACHE_REQUESTS.labels("lookup", "hit").inc()
+            return cached
+        metrics.CACHE_REQUESTS.labels("lookup", "miss").inc()
+        tail, resolved = self.kg_explorer.resolve_relation_tail(entity, relation, graph_name=graph_name)
+        self.answer_cache.put_lookup(entity, relation, tail, graph_name=graph_name, resolved=resolved)
+        return tail, resolved
+
+    def answer_question(self, query: str, index="template_store", graph_name=None):
+        # answer from the in-memory template engine, trying every matching template in turn,
+        # Elasticsearch is only used when no template matches the question
+        with metrics.stage("template_match"):
+            candidates = self.template_engine.match(query)
+        if len(candidates) == 0:
+            metrics.QUESTIONS.labels("elastic").inc()
+            return self.search_elastic_template(query, index=index, graph_name=graph_name)
+        metrics.QUESTIONS.labels("template_engine").inc()
+        entities = [candidate['entity'] for candidate in candidates]
+        for candidate in candidates:
+            try:
+                answer, resolved = self.resolve_relation_tail(candidate['entity'], candidate['relation'],
+                                                              graph_name=graph_name)
+            except Exception as e:
+                logging.info(f"no answer for template {candidate['template']} error: {e}")
+                continue
+            if answer is not None:
+                # the answer also depends on the entity it was found under
+                return {"answer": answer, "entities": entities + ([resolved] if resolved is not None else [])}
+        return {"answer": "sorry I don't know about that", "entities": entities}
+
+    def search_templates(self, queries, graph_name=None):
+        """
+        Answers many questions at once: the (entity, relation) candidates of every question not in the
+        answer cache are looked up in the graph with a single query
+        """
+        answers = [None] * len(queries)
+        pending = []
+        for i, query in enumerate(queries):
+            if self.answer_cache is not None:
+                answer = self.answer_cache.get_answer(query, graph_name=graph_name)
+                if answer is not MISSING:
+                    metrics.CACHE_REQUESTS.labels("answer", "hit").inc()
+                    metrics.QUESTIONS.labels("cache").inc()
+                    answers[i] = answer
+                    continue
+                metrics.CACHE_REQUESTS.labels("answer", "miss").inc()
+            with metrics.stage("template_match"):
+                pending.append((i, self.template_engine.match(query)))
+        pairs = [(candidate['entity'], candidate['relation']) for _, candidates in pending for candidate in candidates]
+        tails, resolved = self.kg_explorer.resolve_relation_tails_batch(pairs, graph_name=graph_name)
+        tails, resolved = iter(tails), iter(resolved)
+        for i, candidates in pending:
+            candidate_tails = [(next(tails), next(resolved)) for _ in candidates]
+            metrics.QUESTIONS.labels("template_engine" if candidates else "elastic").inc()
+            if len(candidates) == 0:
+                try:
+                    answer = self.search_elastic_template(queries[i], graph_name=graph_name)
+                except Exception as e:
+                    logging.error(f"{e}")
+                    # not cached: the question is answered again once Elasticsearch is back
+                    answers[i] = {"answer": "sorry I am not sure about that", "entities": []}
+                    continue
+            else:
+                answer = {"answer": "sorry I don't know about that",
+                          "entities": [candidate['entity'] for candidate in candidates]}
+                for found, name in candidate_tails:
+                    if len(found) > 0:
+                        answer["answer"] = ", ".join(found)
+                        if name is not None:
+                            answer["entities"].append(name)
+                        break
+            answers[i] = answer
+            if self.answer_cache is not None:
+                self.answer_cache.put_answer(queries[i], answer, answer.get("entities", []), graph_name=graph_name)
+        return answers
+
+    def search_elastic_template(self, query: str, index="template_store", graph_name=None):
         search_query = {
             "from": 0,
             "size": 2,
@@ -81,15 +229,17 @@ class ElasticTemplateExplorer:
                 }
             }
         }
-        res = self.es_cluster.search(index=index, body=search_query)
+        with metrics.stage("elastic_search"):
+            res = self.es_cluster.search(index=index, body=search_query)
         if len(res['hits']['hits']) > 0:
             template_obj = res['hits']['hits'][0]['_source']
             entity = self.extract_entity(template_obj['template'], template_obj['groups'], query)
-            answer = self.kg_explorer.find_relation_tail(entity, template_obj['relation'])
-            return {"answer": answer}
+            answer, resolved = self.resolve_relation_tail(entity, template_obj['relation'], graph_name=graph_name)
+            return {"answer": answer, "entities": [entity] + ([resolved] if resolved is not None else [])}
         return {"answer": "sorry I don't know about that"}
 
-    def extract_entity(self, template,groups, query):
+    @staticmethod
+    def extract_entity(template, groups, query):
         p = re.compile(template)
         if groups is None or len(groups) == 0:
             entity = p.findall(query)[0]
@@ -0,0 +1,95 @@
+import logging
+import threading
+import time
+
+
+class VersionPoller:
+    """
+    Follows a Mongo collection of version stamps written by the celery worker: one document per stamped name
+    holding the increasing sequence number of its last write, and a `__graph__` document holding the last
+    sequence number given out. Every poll reads the stamps newer than the last one seen, re-reading the last
+    `seq_overlap` sequence numbers to catch writers that were still stamping during the previous poll, and
+    passes the names stamped since to `handle`. `handle(names)` returns the names it handled, the others are
+    passed again on the next poll. Polls hold a lock, so that `handle` never runs in two threads at once.
+    """
+    GRAPH_VERSION_ID = "__graph__"
+
+    def __init__(self, versions, handle, poll_interval=5, seq_overlap=50, description="versions"):
+        self.versions = versions
+        self.handle = handle
+        self.poll_interval = poll_interval
+        self.seq_overlap = seq_overlap
+        self.description = description
+        self.lock = threading.Lock()
+        self.last_seq = self.current_seq()
+        self.handled_stamps = {}
+        self.last_poll = time.monotonic()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def current_seq(self):
+        try:
+            doc = self.versions.find_one({"_id": self.GRAPH_VERSION_ID})
+        except Exception as e:
+            logging.error(f"failed to read {self.description} version error: {e}")
+            return 0
+        return doc["seq"] if doc else 0
+
+    def poll_if_due(self):
+        """
+        Polls unless the last poll was less than `poll_interval` seconds ago or another thread is polling
+        """
+        if time.monotonic() - self.last_poll < self.poll_interval:
+            return
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            self._poll()
+        finally:
+            self.lock.release()
+
+    def poll(self):
+        with self.lock:
+            self._poll()
+
+    def _poll(self):
+        self.last_poll = time.monotonic()
+        query = {"seq": {"$gt": self.last_seq - self.seq_overlap}, "_id": {"$ne": self.GRAPH_VERSION_ID}}
+        try:
+            stamped = list(self.versions.find(query, {"seq": 1}))
+        except Exception as e:
+            logging.error(f"failed to poll {self.description} versions error: {e}")
+            return
+        # stamps inside the overlap are read again on the next polls, only act on them once
+        new_stamps = {doc["_id"]: doc["seq"] for doc in stamped
+                      if self.handled_stamps.get(doc["_id"], 0) < doc["seq"]}
+        if new_stamps:
+            handled = set(self.handle(list(new_stamps)))
+            for name in handled:
+                self.handled_stamps[name] = new_stamps[name]
+            # handled_stamps still holds the names handled above a cap of the previous polls
+            seq = max([self.last_seq] + list(self.handled_stamps.values()))
+            unhandled = [stamp for name, stamp in new_stamps.items() if name not in handled]
+            if unhandled:
+                # stay below the names left unhandled so that the next polls still read them
+                seq = min(seq, min(unhandled) - 1)
+            self.last_seq = max(self.last_seq, seq)
+        self.handled_stamps = {name: seq for name, seq in self.handled_stamps.items()
+                               if seq > self.last_seq - self.seq_overlap}
+
+    def start(self, name="version-poller"):
+        """
+        Polls every `poll_interval` seconds in a daemon thread until `close`
+        """
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.poll_interval):
+            self.poll()
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()